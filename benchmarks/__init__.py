@@ -0,0 +1,6 @@
+"""
+Package: benchmarks
+
+Performance measurements for the Orders service. These are not part of the
+unit test suite; each module can be run on its own with ``python -m``.
+"""
@@ -0,0 +1,131 @@
+"""
+Throughput and tail latency: sync gunicorn vs. the async ASGI service
+
+Starts ``service:app`` under gunicorn sync workers and ``service.asgi:app``
+under uvicorn on the same database, seeds some orders, then keeps a fixed
+number of concurrent clients reading orders from each for a while and
+reports requests per second with the p50/p99 latency.
+
+The difference shows up when database round trips are slow compared with
+the CPU work per request, so point DATABASE_URI at the real PostgreSQL
+server rather than a local SQLite file for numbers that mean something.
+
+Usage:
+    python -m benchmarks.asgi_load [--concurrency 64] [--duration 15]
+        [--sync-workers 4] [--async-workers 1]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import subprocess
+import httpx
+
+os.environ.setdefault("DATABASE_URI", "sqlite:////tmp/asgi-load.db")
+
+
+def start_server(command: list, port: int, env: dict = None) -> subprocess.Popen:
+    """Starts a server process and waits until it answers /health"""
+    process = subprocess.Popen(  # pylint: disable=consider-using-with
+        command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env={**os.environ, **(env or {})}
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return process
+        except httpx.TransportError:
+            time.sleep(0.2)
+    process.terminate()
+    sys.exit(f"{' '.join(command)} did not come up on port {port}")
+
+
+def seed(port: int, count: int) -> list:
+    """Creates `count` orders with a few items and returns their ids"""
+    ids = []
+    with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+        for _ in range(count):
+            order = {"customer_id": random.randint(1, 50), "status": "submitted", "total_price": 0}
+            order_id = client.post("/api/orders", json=order).json()["id"]
+            for _ in range(random.randint(1, 5)):
+                item = {"order_id": order_id, "name": "tool", "price": 9.99, "description": "load test", "quantity": 1}
+                client.post(f"/api/orders/{order_id}/items", json=item)
+            ids.append(order_id)
+    return ids
+
+
+async def drive(port: int, ids: list, concurrency: int, duration: float) -> dict:
+    """Keeps `concurrency` clients reading orders for `duration` seconds"""
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+    limits = httpx.Limits(max_connections=concurrency)
+
+    async def client_loop(client):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                resp = await client.get(f"/api/orders/{random.choice(ids)}")
+                succeeded = resp.status_code == 200
+            except httpx.HTTPError:
+                succeeded = False
+            if succeeded:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors += 1
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    latencies.sort()
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": len(latencies) / duration,
+        "p50": quantiles[49],
+        "p99": quantiles[98],
+    }
+
+
+def main():
+    """Runs the same read load against both servers and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--sync-workers", type=int, default=4)
+    parser.add_argument("--async-workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    servers = {
+        f"gunicorn sync x{args.sync_workers}": (
+            ["gunicorn", "--workers", str(args.sync_workers), "--bind", "127.0.0.1:8301", "service:app"],
+            8301,
+        ),
+        f"uvicorn async x{args.async_workers}": (
+            ["uvicorn", "--workers", str(args.async_workers), "--port", "8302", "--log-level", "warning",
+             "service.asgi:app"],
+            8302,
+        ),
+    }
+    ids = None
+    print(f"{args.concurrency} clients for {args.duration:.0f}s each against {os.environ['DATABASE_URI'].split(':')[0]}")
+    print(f"{'server':<22}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for name, (command, port) in servers.items():
+        process = start_server(command, port)
+        try:
+            ids = ids or seed(port, args.orders)
+            result = asyncio.run(drive(port, ids, args.concurrency, args.duration))
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{name:<22}{result['rps']:>10.0f}{result['p50']:>10.1f}{result['p99']:>10.1f}{result['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+"""
+Bytes on the wire for a large order listing
+
+Serializes a listing of factory-built orders the way the API does and
+reports the encoded size and compression time for every negotiable
+Content-Encoding at a few levels.
+
+Usage:
+    python -m benchmarks.compression [--orders 10000]
+"""
+import json
+import random
+import argparse
+import time
+from benchmarks.wire_formats import make_listing
+from service.common.compression import ENCODERS
+from service.common.representations import packb
+
+LEVELS = {"gzip": (1, 6, 9), "zstd": (1, 3, 10)}
+
+
+def measure(body: bytes) -> list:
+    """Returns (encoding, level, bytes, milliseconds) rows for one body"""
+    rows = [("identity", "-", len(body), 0.0)]
+    for encoding, encoder in ENCODERS.items():
+        for level in LEVELS[encoding]:
+            start = time.perf_counter()
+            size = len(encoder(body, level))
+            rows.append((encoding, level, size, (time.perf_counter() - start) * 1000))
+    return rows
+
+
+def main():
+    """Prints the size table for JSON and MessagePack bodies"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    listing = make_listing(args.orders)
+    bodies = {
+        "json": json.dumps(listing).encode("utf-8"),
+        "msgpack": packb(listing),
+    }
+    print(f"{args.orders} orders")
+    print(f"{'body':<9}{'encoding':<10}{'level':>6}{'bytes':>12}{'ratio':>8}{'ms':>9}")
+    for name, body in bodies.items():
+        for encoding, level, size, elapsed in measure(body):
+            print(
+                f"{name:<9}{encoding:<10}{level:>6}{size:>12}"
+                f"{size / len(bodies['json']):>8.1%}{elapsed:>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
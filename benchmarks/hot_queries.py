@@ -0,0 +1,93 @@
+"""
+Per-lookup overhead of the hot order queries
+
+Runs the ``find`` and ``find_by_customer_id`` lookups the way the API does at high request rates
+and compares the old ORM Query API form, which is rebuilt and re-compiled
+in Python on every call, with the cached lambda statements in
+``service.models``. Against PostgreSQL it also compares psycopg sending
+every query for parsing and planning with server-side prepared statements.
+
+Usage:
+    python -m benchmarks.hot_queries [--orders 1000] [--lookups 5000]
+    DATABASE_URI=postgresql+psycopg://... python -m benchmarks.hot_queries
+"""
+import os
+import random
+import argparse
+import time
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+# pylint: disable=wrong-import-position
+from service import create_app  # noqa: E402
+from service.models import db, Order, init_db  # noqa: E402
+from tests.factories import OrderFactory  # noqa: E402
+
+
+def query_api_lookup(order_id: int, customer_id: int) -> int:
+    """The lookups as they were written against the Query API"""
+    return (
+        len(Order.query.filter(Order.customer_id == customer_id).all())
+        + Order.query.get(order_id).id
+    )
+
+
+def cached_lookup(order_id: int, customer_id: int) -> int:
+    """The lookups through the cached statements in the model"""
+    return len(Order.find_by_customer_id(customer_id)) + Order.find(order_id).id
+
+
+def measure(lookup, keys: list) -> float:
+    """Returns the mean microseconds per lookup pair"""
+    start = time.perf_counter()
+    for order_id, customer_id in keys:
+        lookup(order_id, customer_id)
+        db.session.rollback()  # one short transaction per request
+    return (time.perf_counter() - start) * 1_000_000 / len(keys)
+
+
+def set_prepare_threshold(threshold) -> bool:
+    """Switches psycopg server-side preparing; False when not on psycopg"""
+    connection = db.session.connection().connection.driver_connection
+    if not hasattr(connection, "prepare_threshold"):
+        return False
+    connection.prepare_threshold = threshold
+    return True
+
+
+def main():
+    """Seeds orders and prints the per-lookup cost of each variant"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--lookups", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    init_db(create_app())
+    db.session.add_all(OrderFactory.build_batch(args.orders))
+    db.session.commit()
+    rows = db.session.execute(db.select(Order.id, Order.customer_id)).all()
+    keys = [tuple(random.choice(rows)) for _ in range(args.lookups)]
+
+    variants = [("query api", query_api_lookup, None), ("cached statements", cached_lookup, None)]
+    if set_prepare_threshold(None):
+        variants = [
+            ("query api, unprepared", query_api_lookup, None),
+            ("cached, unprepared", cached_lookup, None),
+            ("cached, prepared", cached_lookup, 0),
+        ]
+
+    print(f"{args.lookups} lookup pairs over {args.orders} orders on {db.engine.dialect.name}")
+    results = {}
+    for name, lookup, threshold in variants:
+        set_prepare_threshold(threshold)
+        measure(lookup, keys[:100])  # warm the caches
+        results[name] = measure(lookup, keys)
+        print(f"{name:<24}{results[name]:>10.1f} us{1_000_000 / results[name]:>10.0f} /s")
+    baseline, best = list(results.values())[0], list(results.values())[-1]
+    print(f"{1 - best / baseline:.0%} less time per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Load test and replay harness
+
+Starts ``service:app`` under gunicorn with the settings in gunicorn.conf.py
+(or uses a server already listening with --no-server), seeds some orders
+and drives a mix of API requests at it: listing, getting and creating
+orders, adding items, cancelling and repeating. It reports the throughput,
+p50/p95/p99 latency and error rate of every kind of request.
+
+The mix is synthetic, weighted with --mix, or replayed from a JSON lines
+file of recorded requests with --replay. A request line looks like
+
+    {"name": "add_item", "method": "POST", "path": "/api/orders/{order_id}/items",
+     "json": {"order_id": "{order_id}", "name": "tool", ...}}
+
+where ``{order_id}`` is filled in with one of the seeded orders when the
+request is sent. --record saves the synthetic requests in that format so a
+run can be repeated exactly.
+
+Without --rate every client sends its next request as soon as the last one
+is answered. With --rate the requests are started on a fixed schedule and
+the latency is measured from the scheduled time, so a server that falls
+behind shows it in the percentiles instead of quietly getting less load.
+
+Usage:
+    python -m benchmarks.load [--concurrency 32] [--duration 30] [--rate 200]
+        [--mix get=50,list=20,create=10,add_item=10,cancel=5,repeat=5]
+        [--replay requests.jsonl | --record requests.jsonl] [--json results.json]
+    GUNICORN_WORKER_CLASS=gevent WEB_CONCURRENCY=4 python -m benchmarks.load
+"""
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import statistics
+from collections import defaultdict
+import httpx
+
+os.environ.setdefault("DATABASE_URI", "sqlite:////tmp/load.db")
+
+# pylint: disable=wrong-import-position
+from benchmarks.asgi_load import start_server, seed  # noqa: E402
+
+MIX = "get=50,list=20,create=10,add_item=10,cancel=5,repeat=5"
+ORDER_ID = "{order_id}"
+NUMBER = re.compile(r"/\d+")
+
+ITEM = {"order_id": ORDER_ID, "name": "tool", "price": 9.99, "description": "load test", "quantity": 1}
+OPERATIONS = {
+    "get": lambda: {"method": "GET", "path": f"/api/orders/{ORDER_ID}"},
+    "list": lambda: {"method": "GET", "path": f"/api/orders?customer_id={random.randint(1, 50)}"},
+    "create": lambda: {
+        "method": "POST",
+        "path": "/api/orders",
+        "json": {"customer_id": random.randint(1, 50), "status": "submitted", "total_price": 0},
+    },
+    "add_item": lambda: {"method": "POST", "path": f"/api/orders/{ORDER_ID}/items", "json": ITEM},
+    "cancel": lambda: {"method": "PUT", "path": f"/api/orders/{ORDER_ID}/cancel"},
+    "repeat": lambda: {"method": "POST", "path": f"/api/orders/{ORDER_ID}/repeat"},
+}
+
+
+def parse_mix(mix: str) -> dict:
+    """Reads "name=weight,..." into a dict of operation weights"""
+    weights = {name.strip(): float(weight) for name, _, weight in (entry.partition("=") for entry in mix.split(","))}
+    unknown = set(weights) - set(OPERATIONS)
+    if unknown:
+        raise SystemExit(f"Unknown operations {', '.join(sorted(unknown))}, use {', '.join(OPERATIONS)}")
+    return weights
+
+
+def synthetic(weights: dict):
+    """Endless request templates drawn from the weighted operations"""
+    names, values = list(weights), list(weights.values())
+    while True:
+        name = random.choices(names, values)[0]
+        yield {"name": name, **OPERATIONS[name]()}
+
+
+def replay(path: str):
+    """Endless request templates read from a JSON lines file, in order"""
+    with open(path, encoding="utf-8") as recorded:
+        templates = [json.loads(line) for line in recorded if line.strip()]
+    for template in templates:
+        template.setdefault("name", f"{template['method']} {NUMBER.sub('/{id}', template['path'].split('?')[0])}")
+    return itertools.cycle(templates)
+
+
+def fill(template: dict, order_id: int) -> tuple:
+    """The name and httpx arguments of the request a template describes for an order"""
+    body = template.get("json")
+    if isinstance(body, dict):
+        body = {key: order_id if value == ORDER_ID else value for key, value in body.items()}
+    url = template["path"].replace(ORDER_ID, str(order_id))
+    return template["name"], {"method": template["method"], "url": url, "json": body}
+
+
+async def send(client, request: tuple, started: float, samples: list):
+    """Sends a request, adding its (name, succeeded, milliseconds since `started`) sample"""
+    name, arguments = request
+    try:
+        succeeded = (await client.request(**arguments)).status_code < 400
+    except httpx.HTTPError:
+        succeeded = False
+    samples.append((name, succeeded, (time.perf_counter() - started) * 1000))
+
+
+async def closed_loop(client, requests, deadline: float, samples: list):
+    """A client that sends its next request as soon as the last one is answered"""
+    while time.perf_counter() < deadline:
+        await send(client, next(requests), time.perf_counter(), samples)
+
+
+async def open_loop(client, scheduled: asyncio.Queue, samples: list):
+    """A client that sends the scheduled requests until it is handed None"""
+    while True:
+        request, started = await scheduled.get()
+        if request is None:
+            return
+        await send(client, request, started, samples)
+
+
+async def schedule(scheduled: asyncio.Queue, requests, rate: float, deadline: float, clients: int):
+    """Queues a request every 1 / rate seconds until the deadline, then stops the clients"""
+    start = time.perf_counter()
+    for number in itertools.count():
+        due = start + number / rate
+        if due >= deadline:
+            break
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        scheduled.put_nowait((next(requests), due))
+    for _ in range(clients):
+        scheduled.put_nowait((None, None))
+
+
+async def drive(port: int, requests, concurrency: int, duration: float, rate: float) -> tuple:
+    """Sends requests for `duration` seconds
+
+    Returns the (name, succeeded, milliseconds) samples and the seconds it
+    took to answer them, more than `duration` when a server fell behind the
+    schedule and the backlog was still being sent.
+    """
+    samples = []
+    started = time.perf_counter()
+    deadline = started + duration
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=30) as client:
+        if rate:
+            scheduled = asyncio.Queue()
+            await asyncio.gather(
+                schedule(scheduled, requests, rate, deadline, concurrency),
+                *(open_loop(client, scheduled, samples) for _ in range(concurrency)),
+            )
+        else:
+            await asyncio.gather(*(closed_loop(client, requests, deadline, samples) for _ in range(concurrency)))
+    return samples, time.perf_counter() - started
+
+
+def summarize(samples: list, seconds: float) -> dict:
+    """Throughput over the `seconds` the run took, latency percentiles and error rate by request name, and in total"""
+    groups = defaultdict(list)
+    for name, succeeded, elapsed in samples:
+        groups[name].append((succeeded, elapsed))
+        groups["total"].append((succeeded, elapsed))
+    summary = {}
+    for name, group in sorted(groups.items(), key=lambda entry: (entry[0] == "total", entry[0])):
+        latencies = sorted(elapsed for _, elapsed in group)
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        errors = sum(1 for succeeded, _ in group if not succeeded)
+        summary[name] = {
+            "requests": len(group),
+            "rps": len(group) / seconds,
+            "p50": quantiles[49],
+            "p95": quantiles[94],
+            "p99": quantiles[98],
+            "errors": errors,
+            "error_rate": errors / len(group),
+        }
+    return summary
+
+
+def main():
+    """Runs the load and prints the results by kind of request"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--rate", type=float, default=0.0, help="Requests per second, 0 = as fast as answered")
+    parser.add_argument("--mix", default=MIX, help="Weights of the synthetic operations")
+    parser.add_argument("--replay", help="Send the requests in this JSON lines file instead")
+    parser.add_argument("--record", help="Save the synthetic requests sent to this JSON lines file")
+    parser.add_argument("--orders", type=int, default=200, help="Orders to seed")
+    parser.add_argument("--port", type=int, default=8304)
+    parser.add_argument("--no-server", action="store_true", help="Use the server already on --port")
+    parser.add_argument("--json", help="Save the summary to this file")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.replay:
+        templates = replay(args.replay)
+    else:
+        templates = synthetic(parse_mix(args.mix))
+    sent = []
+    if args.record:
+        templates = (sent.append(template) or template for template in templates)
+
+    process = None
+    if not args.no_server:
+        process = start_server(["gunicorn", "service:app"], args.port, {"GUNICORN_BIND": f"127.0.0.1:{args.port}"})
+    try:
+        ids = seed(args.port, args.orders)
+        requests = (fill(template, random.choice(ids)) for template in templates)
+        samples, elapsed = asyncio.run(drive(args.port, requests, args.concurrency, args.duration, args.rate))
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+    summary = summarize(samples, elapsed)
+    offered = f"{args.rate:.0f} req/s offered" if args.rate else "closed loop"
+    print(f"{args.concurrency} clients for {args.duration:.0f}s, {offered}, answered in {elapsed:.1f}s")
+    print(f"{'request':<28}{'count':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'errors':>9}")
+    for name, row in summary.items():
+        print(
+            f"{name:<28}{row['requests']:>8}{row['rps']:>9.1f}{row['p50']:>9.1f}{row['p95']:>9.1f}"
+            f"{row['p99']:>9.1f}{row['error_rate']:>9.1%}"
+        )
+    if args.record:
+        with open(args.record, "w", encoding="utf-8") as output:
+            output.writelines(json.dumps(template) + "\n" for template in sent)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as output:
+            json.dump({"concurrency": args.concurrency, "duration": args.duration, "elapsed": elapsed,
+                       "rate": args.rate, "endpoints": summary}, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
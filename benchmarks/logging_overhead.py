@@ -0,0 +1,111 @@
+"""
+Logging overhead per request
+
+Fetches orders through the test client with the app and model loggers
+writing to a file the way gunicorn's handlers do, and reports the mean
+time per request for each logging setup: logging off, text and JSON
+written on the request thread, JSON handed to the queue listener, and
+queued JSON with the default hot-path sampling. ``--write-delay-ms`` makes
+every write that slow, to show what a congested disk or pipe costs.
+
+Usage:
+    python -m benchmarks.logging_overhead [--requests 2000] [--write-delay-ms 0.2]
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import tempfile
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+# pylint: disable=wrong-import-position
+from service import config, create_app  # noqa: E402
+from service.models import db, Order, init_db  # noqa: E402
+from service.common import log_handlers  # noqa: E402
+from tests.factories import OrderFactory  # noqa: E402
+
+BENCH_LOGGER = "benchmarks.gunicorn"
+
+VARIANTS = [
+    ("off", logging.WARNING, {"LOG_FORMAT": "text", "LOG_QUEUE": False}, False),
+    ("text, sync", logging.INFO, {"LOG_FORMAT": "text", "LOG_QUEUE": False}, False),
+    ("json, sync", logging.INFO, {"LOG_FORMAT": "json", "LOG_QUEUE": False}, False),
+    ("json, queued", logging.INFO, {"LOG_FORMAT": "json", "LOG_QUEUE": True}, False),
+    ("json, queued, sampled", logging.INFO, {"LOG_FORMAT": "json", "LOG_QUEUE": True}, True),
+]
+
+
+class SlowFileHandler(logging.FileHandler):
+    """A file handler that takes at least `delay` seconds per record"""
+
+    def __init__(self, path: str, delay: float):
+        super().__init__(path, encoding="utf-8")
+        self.delay = delay
+
+    def emit(self, record):
+        super().emit(record)
+        if self.delay:
+            time.sleep(self.delay)
+
+
+def measure(client, ids: list) -> float:
+    """Returns the mean microseconds per request"""
+    start = time.perf_counter()
+    for order_id in ids:
+        client.get(f"/api/orders/{order_id}")
+    return (time.perf_counter() - start) * 1_000_000 / len(ids)
+
+
+def run_variant(app, ids: list, path: str, variant: tuple, delay: float) -> tuple:
+    """Returns the microseconds per request, lines written and records dropped"""
+    _, level, settings, sampled = variant
+    bench_logger = logging.getLogger(BENCH_LOGGER)
+    bench_logger.handlers = [SlowFileHandler(path, delay)]
+    bench_logger.setLevel(level)
+    app.config.update(settings)
+    app.config["LOG_SAMPLING"] = config.LOG_SAMPLING if sampled else {}
+    app.config["LOG_RATE_LIMITS"] = config.LOG_RATE_LIMITS if sampled else {}
+    log_handlers.init_logging(app, BENCH_LOGGER)
+    handler = app.logger.handlers[0]
+    elapsed = measure(app.test_client(), ids)
+    log_handlers.stop_queue()  # written out before the lines are counted
+    bench_logger.handlers[0].close()
+    with open(path, encoding="utf-8") as log:
+        lines = sum(1 for _ in log)
+    return elapsed, lines, getattr(handler, "dropped", 0)
+
+
+def main():
+    """Prints the per-request cost of every logging setup"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--write-delay-ms", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    app = create_app()
+    init_db(app)
+    db.session.add_all(OrderFactory.build_batch(args.orders))
+    db.session.commit()
+    order_ids = db.session.scalars(db.select(Order.id)).all()
+    ids = [random.choice(order_ids) for _ in range(args.requests)]
+    measure(app.test_client(), ids[:100])  # warm up
+
+    print(f"{args.requests} requests, {args.write_delay_ms} ms per write")
+    print(f"{'logging':<24}{'us/request':>12}{'overhead':>10}{'lines':>8}{'dropped':>9}")
+    baseline = None
+    with tempfile.TemporaryDirectory() as folder:
+        for variant in VARIANTS:
+            name = variant[0]
+            path = os.path.join(folder, name.replace(", ", "-") + ".log")
+            elapsed, lines, dropped = run_variant(app, ids, path, variant, args.write_delay_ms / 1000)
+            baseline = elapsed if baseline is None else baseline
+            print(f"{name:<24}{elapsed:>12.1f}{elapsed - baseline:>+10.1f}{lines:>8}{dropped:>9}")
+
+
+if __name__ == "__main__":
+    main()
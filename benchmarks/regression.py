@@ -0,0 +1,360 @@
+"""
+Performance regression check against committed baselines
+
+Runs the model microbenchmarks (benchmarks.model_operations) and every
+API endpoint through the test client against the same seeded data, and
+compares them with the baseline files in benchmarks/baselines:
+
+* SQL statements per request and response sizes are exact, so any extra
+  statement or a response more than --size-tolerance bigger is flagged.
+* Timings are noisy, so a median only counts as slower when it is more
+  than --threshold slower AND outside the noise band of both runs:
+  --sigmas standard errors of the median, estimated from each run's
+  standard deviation and number of rounds. Every case is timed --repeat
+  times; the baseline keeps a typical run and the check its fastest, and
+  how far the repeats disagree widens the band too.
+
+Current timings are scaled by how fast a fixed pure Python loop runs
+here compared with on the machine that recorded the baselines, which
+takes out most of the difference between machines, but they still
+compare best on that machine; --skip-timing checks just the statement
+counts and sizes, which hold anywhere.
+
+It needs nothing but the service's own requirements and an in-memory
+SQLite database, and exits with status 1 when anything regressed.
+
+Usage:
+    python -m benchmarks.regression [--skip-timing] [--threshold 0.25] [--repeat 3]
+    python -m benchmarks.regression --update   # record new baselines
+"""
+import os
+import re
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import statistics
+from datetime import datetime
+
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+# pylint: disable=wrong-import-position
+from service import create_app  # noqa: E402
+from service.models import db, init_db  # noqa: E402
+from service.seeding import OrderGenerator, load_chunk  # noqa: E402
+from benchmarks import model_operations  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines")
+MODEL_BASELINE = os.path.join(BASELINES, "model_operations.json")
+ENDPOINT_BASELINE = os.path.join(BASELINES, "endpoints.json")
+
+# what the baselines were recorded with, and what is compared against them
+MODEL_SETTINGS = {"items": "1,10,100", "table_sizes": "100,1000", "min_rounds": 5, "max_time": 0.5}
+SEED_ORDERS = 200
+SEED_DAY = datetime(2024, 6, 1)
+# (name, method, path, json body); reads run before writes so they see the seeded data
+ENDPOINTS = [
+    ("get_order", "GET", "/api/orders/{order_id}", None),
+    ("list_orders", "GET", "/api/orders", None),
+    ("list_by_customer", "GET", "/api/orders?customer_id=1", None),
+    ("list_by_status", "GET", "/api/orders?status=shipped", None),
+    ("list_by_date", "GET", "/api/orders?date=2024-05-30", None),
+    ("list_items", "GET", "/api/orders/{order_id}/items", None),
+    ("get_item", "GET", "/api/orders/{order_id}/items/{item_id}", None),
+    ("create_order", "POST", "/api/orders", {"customer_id": 1, "status": "submitted", "total_price": 0}),
+    ("add_item", "POST", "/api/orders/{last_id}/items",
+     {"order_id": "{last_id}", "name": "tool", "price": 9.99, "description": "regression", "quantity": 1}),
+    ("cancel_order", "PUT", "/api/orders/{last_id}/cancel", None),
+    ("repeat_order", "POST", "/api/orders/{order_id}/repeat", None),
+]
+QUERY_COUNT = re.compile(r'desc="(\d+) queries"')
+# timings are compared at the speed of the machine that recorded the baseline
+CALIBRATION_LOOP = 200000
+SCALED_STATS = ("min", "max", "mean", "median", "stddev")
+
+
+######################################################################
+# Measuring
+######################################################################
+def seed_endpoint_data() -> dict:
+    """Fills fresh tables with the same orders every time, returns ids for the paths"""
+    db.drop_all()
+    db.create_all()
+    load_chunk(OrderGenerator(42, (3, 3), 20, 30, SEED_DAY), 0, 1, SEED_ORDERS)
+    item_id = db.session.scalar(db.text("SELECT min(id) FROM item WHERE order_id = 1"))
+    db.session.remove()
+    return {"order_id": 1, "item_id": item_id, "last_id": SEED_ORDERS}
+
+
+def endpoint_request(template: tuple, ids: dict) -> dict:
+    """The test client arguments for an ENDPOINTS entry"""
+    _, method, path, body = template
+    if body:
+        body = {key: int(value.format(**ids)) if isinstance(value, str) and "{" in value else value
+                for key, value in body.items()}
+    return {"method": method, "path": path.format(**ids), "json": body}
+
+
+def measure_endpoints(client) -> list:
+    """Statement count, size and status of every endpoint, one request each"""
+    ids = seed_endpoint_data()
+    results = []
+    for template in ENDPOINTS:
+        response = client.open(**endpoint_request(template, ids))
+        found = QUERY_COUNT.search(response.headers.get("Server-Timing", ""))
+        results.append(
+            {
+                "name": template[0],
+                "status": response.status_code,
+                "queries": int(found.group(1)) if found else None,
+                "bytes": len(response.get_data()),
+            }
+        )
+    return results
+
+
+def time_endpoints(client, settings: dict) -> list:
+    """Timing stats of every endpoint, on freshly seeded data"""
+    ids = seed_endpoint_data()
+    timings = []
+    for template in ENDPOINTS:
+        arguments = endpoint_request(template, ids)
+        stats = model_operations.run(
+            lambda arguments=arguments: client.open(**arguments), None, settings["min_rounds"], settings["max_time"]
+        )
+        timings.append({"name": template[0], "stats": stats})
+    return timings
+
+
+def time_models(settings: dict) -> list:
+    """The model microbenchmarks, on fresh tables"""
+    db.drop_all()
+    db.create_all()
+    return model_operations.benchmark(argparse.Namespace(**settings))
+
+
+def merge_runs(runs: list, pick) -> list:
+    """Merges repeated runs of the same cases, keeping each case's `pick` run
+
+    The spread of the repeats' medians is kept as "drift", the noise
+    between runs that the rounds of a single run cannot show.
+    """
+    merged = []
+    for results in zip(*runs):
+        medians = [result["stats"]["median"] for result in results]
+        chosen = results[medians.index(pick(medians))]
+        merged.append({**chosen, "stats": {**chosen["stats"], "drift": max(medians) / min(medians) - 1}})
+    return merged
+
+
+def calibrate() -> float:
+    """Seconds a fixed pure Python loop takes, the fastest of five"""
+    times = []
+    for _ in range(5):
+        start = time.perf_counter()
+        sum(number * number for number in range(CALIBRATION_LOOP))
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def scaled(results: list, factor: float) -> list:
+    """Results with their timings multiplied by `factor`"""
+    return [
+        {**result, "stats": {**result["stats"], **{key: result["stats"][key] * factor for key in SCALED_STATS}}}
+        if "stats" in result else result
+        for result in results
+    ]
+
+
+def measure(app, settings: dict, repeat: int, pick) -> tuple:
+    """The endpoint results, with their timings, and the model results
+
+    Without `pick` only the statement counts and sizes are measured and
+    the model results are None.
+    """
+    client = app.test_client()
+    client.get("/health")  # the first request creates the tables
+    endpoints = measure_endpoints(client)
+    if not pick:
+        return endpoints, None
+    timings = merge_runs([time_endpoints(client, settings) for _ in range(repeat)], pick)
+    for result, timed in zip(endpoints, timings):
+        result["stats"] = timed["stats"]
+    models = merge_runs([time_models(settings) for _ in range(repeat)], pick)
+    return endpoints, models
+
+
+######################################################################
+# Comparing
+######################################################################
+def timing_change(current: dict, baseline: dict, threshold: float, sigmas: float) -> tuple:
+    """Returns the relative change in median and whether it is beyond the noise
+
+    The standard error of a median is about 1.25 standard deviations over
+    the square root of the rounds; the band is `sigmas` standard errors of
+    both runs combined, relative to their medians, and never narrower than
+    the drift between the repeats of either run.
+    """
+    change = current["median"] / baseline["median"] - 1
+
+    def relative_error(stats):
+        return 1.2533 * stats["stddev"] / stats["median"] / math.sqrt(stats["rounds"])
+
+    noise = sigmas * math.hypot(relative_error(current), relative_error(baseline))
+    drift = max(current.get("drift", 0.0), baseline.get("drift", 0.0))
+    return change, abs(change) > max(threshold, noise, drift)
+
+
+def compare_timings(name: str, current: dict, baseline: dict, args) -> dict:
+    """A report row for one timed case"""
+    change, significant = timing_change(current, baseline, args.threshold, args.sigmas)
+    verdict = "ok"
+    if significant:
+        verdict = "SLOWER" if change > 0 else "faster"
+    return {
+        "check": "time",
+        "name": name,
+        "baseline": f"{baseline['median'] * 1000:.3f} ms",
+        "current": f"{current['median'] * 1000:.3f} ms",
+        "change": f"{change:+.1%}",
+        "verdict": verdict,
+    }
+
+
+def compare_endpoint(current: dict, baseline: dict, args) -> list:
+    """Report rows for the statements, size, status and timing of one endpoint"""
+    name = current["name"]
+    rows = []
+    if current["status"] != baseline["status"]:
+        rows.append({"check": "status", "name": name, "baseline": baseline["status"], "current": current["status"],
+                     "change": "", "verdict": "CHANGED"})
+    queries, expected = current["queries"], baseline["queries"]
+    verdict = "MORE" if queries > expected else "fewer" if queries < expected else "ok"
+    rows.append({"check": "queries", "name": name, "baseline": expected, "current": queries,
+                 "change": f"{queries - expected:+d}", "verdict": verdict})
+    size_change = current["bytes"] / baseline["bytes"] - 1 if baseline["bytes"] else 0.0
+    verdict = "ok"
+    if abs(size_change) > args.size_tolerance:
+        verdict = "BIGGER" if size_change > 0 else "smaller"
+    rows.append({"check": "bytes", "name": name, "baseline": baseline["bytes"], "current": current["bytes"],
+                 "change": f"{size_change:+.1%}", "verdict": verdict})
+    if "stats" in current and "stats" in baseline:
+        rows.append(compare_timings(name, current["stats"], baseline["stats"], args))
+    return rows
+
+
+def compare(endpoints: list, models: list, baselines: dict, args) -> list:
+    """Report rows for everything measured, against the baselines"""
+    rows = []
+    saved = {entry["name"]: entry for entry in baselines["endpoints"]["endpoints"]}
+    for current in endpoints:
+        if current["name"] in saved:
+            rows.extend(compare_endpoint(current, saved[current["name"]], args))
+        else:
+            rows.append({"check": "endpoint", "name": current["name"], "baseline": "", "current": "",
+                         "change": "", "verdict": "new"})
+    if models is not None:
+        for current, old in model_operations.compare(models, baselines["models"]["benchmarks"]):
+            name = f"{current['group']}.{current['name']}[{current['param']}]"
+            if old is None:
+                rows.append({"check": "time", "name": name, "baseline": "", "current": "", "change": "",
+                             "verdict": "new"})
+            else:
+                rows.append(compare_timings(name, current["stats"], old["stats"], args))
+    return rows
+
+
+def regressed(row: dict) -> bool:
+    """True for the verdicts that fail the check, which are in capitals"""
+    return row["verdict"].isupper()
+
+
+def report(rows: list):
+    """Prints the regressions first, then the rest"""
+    print(f"{'':2}{'check':<9}{'case':<34}{'baseline':>14}{'current':>14}{'change':>9}  verdict")
+    for row in sorted(rows, key=lambda row: not regressed(row)):
+        mark = "!!" if regressed(row) else "  "
+        print(
+            f"{mark}{row['check']:<9}{row['name']:<34}{str(row['baseline']):>14}{str(row['current']):>14}"
+            f"{row['change']:>9}  {row['verdict']}"
+        )
+    failures = sum(1 for row in rows if regressed(row))
+    print(f"\n{failures} regressions in {len(rows)} checks" if failures else f"\nNo regressions in {len(rows)} checks")
+
+
+######################################################################
+# Baseline files
+######################################################################
+def machine_info() -> dict:
+    """Where a baseline was recorded"""
+    return {"python": sys.version.split()[0], "platform": sys.platform, "database": db.engine.dialect.name}
+
+
+def save(path: str, document: dict):
+    """Writes a baseline file"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as output:
+        json.dump({"datetime": datetime.now().isoformat(timespec="seconds"), "machine_info": machine_info(),
+                   **document}, output, indent=2)
+        output.write("\n")
+    print(f"Saved {path}")
+
+
+def load_baselines() -> dict:
+    """The committed baselines"""
+    baselines = {}
+    for key, path in (("endpoints", ENDPOINT_BASELINE), ("models", MODEL_BASELINE)):
+        if not os.path.exists(path):
+            raise SystemExit(f"No baseline at {path}, record one with --update")
+        with open(path, encoding="utf-8") as saved:
+            baselines[key] = json.load(saved)
+    return baselines
+
+
+def main():
+    """Measures, then compares with or replaces the baselines"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--skip-timing", action="store_true", help="Only check statement counts and sizes")
+    parser.add_argument("--threshold", type=float, default=0.25, help="Smallest slowdown that counts, 0.25 = 25%%")
+    parser.add_argument("--sigmas", type=float, default=3.0, help="Width of the noise band in standard errors")
+    parser.add_argument("--size-tolerance", type=float, default=0.02, help="Allowed growth of a response")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing runs, the fastest of each case counts")
+    parser.add_argument("--update", action="store_true", help="Record the baselines instead of comparing")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if args.update and args.skip_timing:
+        parser.error("--update records the timings too, drop --skip-timing")
+
+    random.seed(args.seed)
+    app = create_app()
+    for name in (app.logger.name, "flask.app"):
+        logging.getLogger(name).setLevel(logging.CRITICAL)  # e.g. the query warnings of repeat_order
+    init_db(app)
+    baselines = None if args.update else load_baselines()
+    settings = baselines["models"].get("settings", MODEL_SETTINGS) if baselines else MODEL_SETTINGS
+    if baselines and baselines["endpoints"]["machine_info"]["database"] != db.engine.dialect.name:
+        print(f"Warning: the baselines were recorded on {baselines['endpoints']['machine_info']['database']}")
+
+    calibration = calibrate()
+    # a slowdown counts when even the fastest repeat is slower than a typical baseline run
+    pick = statistics.median_low if args.update else min
+    endpoints, models = measure(app, settings, args.repeat, None if args.skip_timing else pick)
+    calibration = (calibration + calibrate()) / 2
+    if args.update:
+        save(ENDPOINT_BASELINE, {"settings": settings, "calibration": calibration, "endpoints": endpoints})
+        save(MODEL_BASELINE, {"settings": settings, "calibration": calibration, "benchmarks": models})
+        return
+    factor = baselines["models"].get("calibration", calibration) / calibration
+    if models:
+        print(f"\nTimings scaled by {factor:.2f} to the speed of the baseline machine")
+    rows = compare(scaled(endpoints, factor), models and scaled(models, factor), baselines, args)
+    report(rows)
+    if any(regressed(row) for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Wire format comparison: JSON vs. MessagePack
+
+Builds realistic order listings with the test factories and compares the
+payload size plus encode/decode time of both representations. Encoding uses
+the service's own encoders; decoding uses what a consuming service would
+call (``json.loads`` and ``msgpack.unpackb(..., timestamp=3)``).
+
+Usage:
+    python -m benchmarks.wire_formats [--orders 100] [--repeat 200]
+"""
+import os
+import json
+import random
+import argparse
+import timeit
+import msgpack
+
+# the factories import the models; keep their engine local
+os.environ.setdefault("DATABASE_URI", "sqlite://")
+
+# pylint: disable=wrong-import-position
+from service.common.representations import packb  # noqa: E402
+from tests.factories import OrderFactory, ItemFactory  # noqa: E402
+
+
+def make_listing(count: int) -> list:
+    """Returns `count` serialized orders with 1-20 items each"""
+    listing = []
+    for _ in range(count):
+        order = OrderFactory()
+        order.items = ItemFactory.build_batch(random.randint(1, 20), order=None)
+        for item in order.items:
+            item.order_id = order.id
+        order.total_price = order.get_total_price()
+        listing.append(order.serialize())
+    return listing
+
+
+def measure(listing: list, repeat: int) -> dict:
+    """Times both encoders and decoders over the same listing"""
+    json_body = json.dumps(listing).encode("utf-8")  # as restx output_json
+    msgpack_body = packb(listing)
+    per_call = 1_000_000 / repeat  # seconds for `repeat` calls -> usec per call
+    return {
+        "json": {
+            "bytes": len(json_body),
+            "encode_us": timeit.timeit(lambda: json.dumps(listing), number=repeat) * per_call,
+            "decode_us": timeit.timeit(lambda: json.loads(json_body), number=repeat) * per_call,
+        },
+        "msgpack": {
+            "bytes": len(msgpack_body),
+            "encode_us": timeit.timeit(lambda: packb(listing), number=repeat) * per_call,
+            "decode_us": timeit.timeit(
+                lambda: msgpack.unpackb(msgpack_body, timestamp=3), number=repeat
+            ) * per_call,
+        },
+    }
+
+
+def main():
+    """Runs the comparison and prints a small table"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--orders", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = measure(make_listing(args.orders), args.repeat)
+    print(f"{args.orders} orders, {args.repeat} rounds")
+    print(f"{'format':<10}{'bytes':>10}{'encode us':>12}{'decode us':>12}")
+    for name, row in results.items():
+        print(f"{name:<10}{row['bytes']:>10}{row['encode_us']:>12.1f}{row['decode_us']:>12.1f}")
+    ratio = results["msgpack"]["bytes"] / results["json"]["bytes"]
+    print(f"msgpack payload is {ratio:.0%} of JSON")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Throughput and tail latency of the gunicorn worker models
+
+Starts ``service:app`` under gunicorn once per worker class with the
+settings in gunicorn.conf.py, seeds some orders, then drives the same mix
+of order reads and writes against each and reports requests per second
+with the p50/p99 latency. Every model gets the same number of worker
+processes so the comparison is about how each one overlaps requests.
+
+Point DATABASE_URI at the real PostgreSQL server for numbers that mean
+something; SQLite serializes the writes.
+
+Usage:
+    python -m benchmarks.worker_models [--models sync,gthread,gevent]
+        [--workers 2] [--concurrency 32] [--duration 15]
+"""
+import os
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import httpx
+
+os.environ.setdefault("DATABASE_URI", "sqlite:////tmp/worker-models.db")
+
+# pylint: disable=wrong-import-position
+from benchmarks.asgi_load import start_server, seed  # noqa: E402
+
+PORT = 8303
+
+
+async def drive(ids: list, concurrency: int, duration: float, write_ratio: float) -> dict:
+    """Keeps `concurrency` clients reading and listing orders and adding items"""
+    latencies, errors = [], 0
+    deadline = time.monotonic() + duration
+
+    async def request(client):
+        order_id = random.choice(ids)
+        if random.random() < write_ratio:
+            item = {"order_id": order_id, "name": "tool", "price": 9.99, "description": "load test", "quantity": 1}
+            return await client.post(f"/api/orders/{order_id}/items", json=item)
+        if random.random() < 0.2:
+            return await client.get("/api/orders", params={"customer_id": random.randint(1, 50)})
+        return await client.get(f"/api/orders/{order_id}")
+
+    async def client_loop(client):
+        nonlocal errors
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                succeeded = (await request(client)).status_code in (200, 201)
+            except httpx.HTTPError:
+                succeeded = False
+            if succeeded:
+                latencies.append((time.perf_counter() - start) * 1000)
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{PORT}", limits=limits, timeout=30) as client:
+        await asyncio.gather(*(client_loop(client) for _ in range(concurrency)))
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0.0] * 99
+    return {"rps": len(latencies) / duration, "p50": quantiles[49], "p99": quantiles[98], "errors": errors}
+
+
+def main():
+    """Runs the same load against each worker model and prints the results"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--models", default="sync,gthread,gevent")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--orders", type=int, default=200)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    ids = None
+    print(f"{args.workers} workers, {args.concurrency} clients for {args.duration:.0f}s each "
+          f"against {os.environ['DATABASE_URI'].split(':')[0]}")
+    print(f"{'worker class':<14}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for model in args.models.split(","):
+        env = {"GUNICORN_WORKER_CLASS": model, "WEB_CONCURRENCY": str(args.workers), "GUNICORN_BIND": f"127.0.0.1:{PORT}"}
+        process = start_server(["gunicorn", "service:app"], PORT, env)
+        try:
+            ids = ids or seed(PORT, args.orders)
+            result = asyncio.run(drive(ids, args.concurrency, args.duration, args.write_ratio))
+        finally:
+            process.terminate()
+            process.wait()
+        print(f"{model:<14}{result['rps']:>10.0f}{result['p50']:>10.1f}{result['p99']:>10.1f}{result['errors']:>8}")
+
+
+if __name__ == "__main__":
+    main()
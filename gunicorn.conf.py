@@ -0,0 +1,94 @@
+"""
+Gunicorn Configuration
+
+gunicorn reads this file from the working directory, so the Procfile and
+the Docker image only name the app. Every setting can be changed through
+the environment:
+
+    GUNICORN_WORKER_CLASS     sync, gthread or gevent (default gthread)
+    WEB_CONCURRENCY           worker processes (default depends on the class)
+    GUNICORN_THREADS          threads per gthread worker (default 4)
+    GUNICORN_WORKER_CONNECTIONS  greenlets per gevent worker (default 100)
+    GUNICORN_PRELOAD          load the app once before forking (default true)
+    GUNICORN_MAX_REQUESTS     recycle a worker after this many requests (default 2000, 0 = never)
+    GUNICORN_MAX_REQUESTS_JITTER  random extra requests so workers do not recycle together
+    GUNICORN_TIMEOUT, GUNICORN_GRACEFUL_TIMEOUT, GUNICORN_KEEPALIVE
+
+The workers write their Prometheus metrics to PROMETHEUS_MULTIPROC_DIR,
+emptied at startup, so that /metrics adds up all of them.
+
+The database pool of each worker is sized to the requests the worker can
+run at once, within DB_MAX_CONNECTIONS for the whole server, unless
+DB_POOL_SIZE or DB_MAX_OVERFLOW are set explicitly.
+"""
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+if worker_class not in ("sync", "gthread", "gevent"):
+    raise RuntimeError(f"GUNICORN_WORKER_CLASS must be sync, gthread or gevent, not {worker_class}")
+
+if worker_class == "gevent":
+    # patch before the preloaded app creates any locks, sockets or threads
+    from gevent import monkey  # pylint: disable=wrong-import-position
+
+    monkey.patch_all()
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '8080')}")
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+cpus = multiprocessing.cpu_count()
+# gthread and gevent workers overlap requests, so fewer processes are needed
+workers = int(os.getenv("WEB_CONCURRENCY", str(cpus * 2 + 1 if worker_class == "sync" else cpus + 1)))
+threads = int(os.getenv("GUNICORN_THREADS", "4")) if worker_class == "gthread" else 1
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("true", "1", "yes")
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", "2000"))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", str(max_requests // 10)))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "30"))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+# Requests one worker runs at once, and so the connections it can use
+concurrency = {"sync": 1, "gthread": threads, "gevent": worker_connections}[worker_class]
+connections_per_worker = max(1, int(os.getenv("DB_MAX_CONNECTIONS", "80")) // workers)
+# service.config reads these when the app is loaded, after this file runs;
+# with a pooled connection per request, overflow would only break the budget
+os.environ.setdefault("DB_POOL_SIZE", str(min(concurrency, connections_per_worker)))
+os.environ.setdefault("DB_MAX_OVERFLOW", "0")
+
+# must be set before the app, and with it prometheus_client, is loaded
+metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "orders-metrics"))
+
+
+def on_starting(server):
+    """Starts with fresh metrics and logs the worker model the server runs with"""
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+    server.log.info(
+        "%d %s worker(s), %d concurrent request(s) and %s+%s database connections each",
+        workers, worker_class, concurrency, os.environ["DB_POOL_SIZE"], os.environ["DB_MAX_OVERFLOW"],
+    )
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Keeps a preloaded app's pooled connections out of the worker
+
+    A connection shared by two processes corrupts both sides of the
+    protocol, so the worker forgets what it inherited and connects anew.
+    """
+    flask_app = getattr(worker.app, "callable", None)
+    if flask_app is not None:
+        from service.models import dispose_engines  # pylint: disable=import-outside-toplevel
+
+        dispose_engines(flask_app)
+
+
+def child_exit(server, worker):  # pylint: disable=unused-argument
+    """Drops the live gauges of a worker that exited"""
+    from prometheus_client import multiprocess  # pylint: disable=import-outside-toplevel
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,54 +1,65 @@
 """
 Package: service
 Package for the application models and service routes
-This module creates and configures the Flask app and sets up the logging
-and SQL database
+This module holds the application factory, which creates and configures the
+Flask app and sets up the logging and SQL database.
+
+Creating the app does not touch the database: the engines connect on first
+use and the tables are created by the first request (or `flask db-init`).
+Importing the package stays cheap, so the ASGI app and scripts that only
+need the models do not build the Flask app at all, and gunicorn can
+preload the app before forking without sharing any database connections.
 """
-import sys
 from flask import Flask
-from flask_restx import Api
 from service import config
-from service.common import log_handlers
-
-# Create Flask application
-app = Flask(__name__)
-app.url_map.strict_slashes = False
-app.config.from_object(config)
-
-######################################################################
-# Configure Swagger before initializing it
-######################################################################
-api = Api(
-    app,
-    version="1.0.0",
-    title="Orders REST API Service",
-    description="This is a documentation for Orders REST APIs.",
-    default="orders",
-    default_label="Orders operations",
-    doc="/apidocs",  # default also could use doc='/apidocs/'
-    prefix="/api",
-)
-
-
-# Dependencies require we import the routes AFTER the Flask app is created
-# pylint: disable=wrong-import-position, wrong-import-order, cyclic-import
-from service import routes, models  # noqa: E402, E261
-
-# pylint: disable=wrong-import-position
-from service.common import error_handlers, cli_commands  # noqa: F401, E402
-
-# Set up logging for production
-log_handlers.init_logging(app, "gunicorn.error")
-
-app.logger.info(70 * "*")
-app.logger.info("  O R D E R S   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
-
-try:
-    models.init_db(app)  # make our SQLAlchemy tables
-except Exception as error:  # pylint: disable=broad-except
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
-
-app.logger.info("Service initialized!")
+
+# The app `gunicorn service:app` and the tests use, built by __getattr__
+app: Flask
+
+
+def create_app() -> Flask:
+    """Creates the Orders service Flask app"""
+    # Dependencies are imported here so importing the package stays cheap
+    # pylint: disable=import-outside-toplevel, cyclic-import
+    from service import routes, models
+    from service.common import log_handlers, compression, error_handlers, cli_commands
+    from service.common import deadlines, memory_profiling, metrics, profiling, query_stats, rate_limits, slow_queries
+    from service.common import tracing
+
+    flask_app = Flask(__name__)
+    flask_app.url_map.strict_slashes = False
+    flask_app.config.from_object(config)
+    # first, so the request span covers the other hooks
+    tracing.init_tracing(flask_app)
+    metrics.init_metrics(flask_app)
+    # before anything that could touch the database, and counted in the metrics
+    rate_limits.init_rate_limits(flask_app)
+    query_stats.init_query_stats(flask_app)
+    slow_queries.init_slow_queries(flask_app)
+    compression.init_compression(flask_app)
+    routes.init_routes(flask_app)
+    error_handlers.init_error_handlers(flask_app, routes.api)
+    deadlines.init_deadlines(flask_app)
+    flask_app.register_blueprint(cli_commands.blueprint)
+    profiling.init_profiling(flask_app)
+    memory_profiling.init_memory_profiling(flask_app)
+
+    # Set up logging for production
+    log_handlers.init_logging(flask_app, "gunicorn.error")
+
+    flask_app.logger.info(70 * "*")
+    flask_app.logger.info("  O R D E R S   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    flask_app.logger.info(70 * "*")
+
+    models.init_app(flask_app)
+
+    flask_app.logger.info("Service initialized!")
+    return flask_app
+
+
+def __getattr__(name):
+    """Creates the module level ``app`` (as in ``service:app``) on first use"""
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
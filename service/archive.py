@@ -0,0 +1,65 @@
+"""
+Archival of finished Orders
+
+Delivered and canceled orders that have not changed for ARCHIVE_AFTER_DAYS
+are moved, with their items, from the order and item tables into
+order_archive, one compact row per order with the items kept as JSON. The
+live tables and their indexes then only hold the orders that are still
+being worked on. Archived orders stay readable through the
+``include_archived`` switch of Order.find() and the find_by_* queries.
+
+Orders move in batches of ARCHIVE_BATCH_SIZE, each in its own short
+transaction, so the archiver never holds locks on many live rows at once.
+"""
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, delete, func
+from service.models import db, Order, Item, order_archive
+
+logger = logging.getLogger("flask.app")
+
+# Orders moved per transaction
+ARCHIVE_BATCH_SIZE = 1000
+
+ITEM_FIELDS = ("id", "order_id", "name", "price", "description", "quantity")
+
+
+def archive_orders(older_than_days: int, statuses, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Moves the finished orders into the archive, returns how many
+
+    Args:
+        older_than_days (int): only orders not updated for this many days
+        statuses (iterable): the finished statuses, compared case-insensitively
+        batch_size (int): orders moved per transaction
+    """
+    order_table, item_table = Order.__table__, Item.__table__
+    cutoff = datetime.now() - timedelta(days=older_than_days)
+    finished = (
+        func.lower(order_table.c.status).in_([status.lower() for status in statuses]),
+        order_table.c.last_updated_time < cutoff,
+    )
+    logger.info("Archiving %s orders last updated before %s", "/".join(statuses), cutoff)
+    moved = 0
+    while True:
+        with db.engine.begin() as connection:
+            ids = connection.execute(
+                select(order_table.c.id).where(*finished).order_by(order_table.c.id).limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+            items = {}
+            for item in connection.execute(select(item_table).where(item_table.c.order_id.in_(ids))).mappings():
+                items.setdefault(item["order_id"], []).append({name: item[name] for name in ITEM_FIELDS})
+            now = datetime.now()
+            connection.execute(
+                insert(order_archive),
+                [
+                    {**order, "items": items.get(order["id"], []), "archived_time": now}
+                    for order in connection.execute(select(order_table).where(order_table.c.id.in_(ids))).mappings()
+                ],
+            )
+            connection.execute(delete(item_table).where(item_table.c.order_id.in_(ids)))
+            connection.execute(delete(order_table).where(order_table.c.id.in_(ids)))
+        moved += len(ids)
+        logger.info("Archived %d orders so far", moved)
+    return moved
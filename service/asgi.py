@@ -0,0 +1,350 @@
+"""
+ASGI Entry Point
+
+Serves the /api/orders and items routes on an async SQLAlchemy engine, so a
+worker keeps handling other requests while it waits on the database instead
+of blocking on every round trip like the sync gunicorn workers behind
+``service:app``. The Order and Item models are the ones in service.models;
+only the session handling differs.
+
+Run with:
+    uvicorn --host 0.0.0.0 --port 8080 --workers 2 service.asgi:app
+
+The Swagger docs, the bulk export, the static UI and the operator endpoints
+are only served by the WSGI application.
+"""
+import json
+import logging
+from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import selectinload
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from service import config
+from service.common import status, db_pool
+from service.common.representations import MSGPACK_MIMETYPE, packb, unpackb
+from service.models import Order, Item, DataValidationError, create_schema
+
+logger = logging.getLogger("flask.app")
+
+# async drivers for the sync database URIs in the configuration
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+psycopg_async"}
+
+
+def async_database_uri(uri: str) -> str:
+    """Returns the configured database URI with an async driver"""
+    url = make_url(uri)
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+    return url.render_as_string(hide_password=False)
+
+
+def settings() -> dict:
+    """The configuration as a dict, like the Flask app's config"""
+    return {key: getattr(config, key) for key in dir(config) if key.isupper()}
+
+
+def engine_options(uri: str) -> dict:
+    """Sizes the async pool from the same DB_POOL_* settings as the sync one"""
+    if make_url(uri).get_backend_name() == "sqlite":
+        # keep aiosqlite connections (and their threads) instead of NullPool
+        return {"poolclass": AsyncAdaptedQueuePool}
+    configured = settings()
+    configured["SQLALCHEMY_DATABASE_URI"] = uri
+    options = db_pool.engine_options(configured, "async")
+    # the instrumented pool is a sync QueuePool; async engines adapt their own
+    options.pop("poolclass", None)
+    return options
+
+
+######################################################################
+# Helpers
+######################################################################
+def respond(request: Request, data, code: int = status.HTTP_200_OK, headers=None) -> Response:
+    """Answers in MessagePack when asked to, JSON otherwise"""
+    if MSGPACK_MIMETYPE in request.headers.get("accept", ""):
+        return Response(packb(data), code, headers, media_type=MSGPACK_MIMETYPE)
+    return JSONResponse(data, code, headers)
+
+
+async def payload(request: Request):
+    """Decodes a JSON or MessagePack request body"""
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith(MSGPACK_MIMETYPE):
+            return unpackb(body)
+        return json.loads(body)
+    except ValueError as error:
+        raise DataValidationError(f"Invalid request body: {error}") from error
+
+
+def not_found(kind: str, ident) -> HTTPException:
+    """The 404 for a missing Order or Item"""
+    return HTTPException(status.HTTP_404_NOT_FOUND, f"{kind} with id '{ident}' could not be found.")
+
+
+async def find_order(session, order_id: int) -> Order:
+    """Loads an Order with its Items, lazy loading is not available here"""
+    return await session.get(Order, order_id, options=[selectinload(Order.items)])
+
+
+######################################################################
+#  PATH: /orders
+######################################################################
+async def list_orders(request: Request):
+    """Returns all of the Orders, optionally by customer_id, date or status"""
+    args = request.query_params
+    statement = select(Order).options(selectinload(Order.items))
+    try:
+        if args.get("customer_id"):
+            statement = statement.where(Order.customer_id == int(args["customer_id"]))
+        elif args.get("date"):
+            start = datetime.strptime(args["date"], "%Y-%m-%d")
+            statement = statement.where(
+                Order.creation_time >= start, Order.creation_time < start + timedelta(days=1)
+            )
+        elif args.get("status"):
+            statement = statement.where(Order.status == args["status"])
+    except ValueError as error:
+        raise DataValidationError(str(error)) from error
+    async with request.app.state.session() as session:
+        orders = (await session.scalars(statement)).all()
+    return respond(request, [order.serialize() for order in orders])
+
+
+async def create_order(request: Request):
+    """Creates an Order"""
+    order = Order()
+    order.items = []  # so serialize() has no collection to lazy load
+    order.deserialize(await payload(request))
+    order.before_save(created=True)
+    async with request.app.state.session() as session:
+        session.add(order)
+        await session.commit()
+    logger.info("Order with ID [%s] created.", order.id)
+    location = str(request.url_for("order", order_id=order.id))
+    return respond(request, order.serialize(), status.HTTP_201_CREATED, {"Location": location})
+
+
+######################################################################
+#  PATH: /orders/{id}
+######################################################################
+async def get_order(request: Request):
+    """Retrieve a single Order"""
+    order_id = request.path_params["order_id"]
+    async with request.app.state.session() as session:
+        order = await find_order(session, order_id)
+    if not order:
+        raise not_found("Order", order_id)
+    return respond(request, order.serialize())
+
+
+async def update_order(request: Request):
+    """Update an Order"""
+    order_id = request.path_params["order_id"]
+    data = await payload(request)
+    async with request.app.state.session() as session:
+        order = await find_order(session, order_id)
+        if not order:
+            raise not_found("Order", order_id)
+        order.deserialize(data)
+        order.before_save()
+        await session.commit()
+    return respond(request, order.serialize())
+
+
+async def delete_order(request: Request):
+    """Deletes an Order"""
+    order_id = request.path_params["order_id"]
+    async with request.app.state.session() as session:
+        order = await session.get(Order, order_id)
+        if order:
+            await session.delete(order)
+            await session.commit()
+            logger.info("Order with id [%s] was deleted", order_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+async def cancel_order(request: Request):
+    """Cancel an Order"""
+    order_id = request.path_params["order_id"]
+    async with request.app.state.session() as session:
+        order = await find_order(session, order_id)
+        if not order:
+            raise not_found("Order", order_id)
+        order.status = "Canceled"
+        order.before_save()
+        await session.commit()
+    return respond(request, order.serialize())
+
+
+async def repeat_order(request: Request):
+    """Repeat an Order"""
+    order_id = request.path_params["order_id"]
+    async with request.app.state.session() as session:
+        order = await find_order(session, order_id)
+        if not order:
+            raise not_found("Order", order_id)
+        other = Order()
+        other.items = []
+        other.customer_id = order.customer_id
+        other.status = order.status
+        for item in order.items:
+            copy = Item()
+            copy.deserialize(item.serialize())
+            other.items.append(copy)
+        other.before_save(created=True)
+        session.add(other)
+        await session.commit()
+    return respond(request, other.serialize())
+
+
+######################################################################
+#  PATH: /orders/{id}/items
+######################################################################
+async def list_items(request: Request):
+    """Returns all of the items for an order"""
+    order_id = request.path_params["order_id"]
+    async with request.app.state.session() as session:
+        order = await find_order(session, order_id)
+    if not order:
+        raise not_found("Order", order_id)
+    return respond(request, [item.serialize() for item in order.items])
+
+
+async def create_item(request: Request):
+    """Create an item in order"""
+    order_id = request.path_params["order_id"]
+    data = await payload(request)
+    async with request.app.state.session() as session:
+        order = await find_order(session, order_id)
+        if not order:
+            raise not_found("Order", order_id)
+        item = Item()
+        item.deserialize(data)
+        order.items.append(item)
+        order.before_save()
+        await session.commit()
+    return respond(request, item.serialize(), status.HTTP_201_CREATED)
+
+
+######################################################################
+#  PATH: /orders/{id}/items/{item_id}
+######################################################################
+async def get_item(request: Request):
+    """Get an Item"""
+    item_id = request.path_params["item_id"]
+    async with request.app.state.session() as session:
+        item = await session.get(Item, item_id)
+    if not item:
+        raise not_found("Item", item_id)
+    return respond(request, item.serialize())
+
+
+async def update_item(request: Request):
+    """Update an Item"""
+    order_id, item_id = request.path_params["order_id"], request.path_params["item_id"]
+    data = await payload(request)
+    async with request.app.state.session() as session:
+        item = await session.get(Item, item_id)
+        if not item:
+            raise not_found("Item", item_id)
+        item.deserialize(data)
+        order = await find_order(session, order_id)
+        if order:
+            order.before_save()
+        await session.commit()
+    return respond(request, item.serialize())
+
+
+async def delete_item(request: Request):
+    """Delete an Item"""
+    order_id, item_id = request.path_params["order_id"], request.path_params["item_id"]
+    async with request.app.state.session() as session:
+        item = await session.get(Item, item_id)
+        order = await find_order(session, order_id)
+        if item:
+            if order and item in order.items:
+                order.items.remove(item)
+            await session.delete(item)
+        if order:
+            order.before_save()
+        await session.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+
+######################################################################
+# Health and errors
+######################################################################
+async def health(_request: Request):
+    """Health URL response"""
+    return JSONResponse({"status": "OK"})
+
+
+async def request_validation_error(_request: Request, error: DataValidationError):
+    """Handles bad data with 400_BAD_REQUEST, like service.common.error_handlers"""
+    message = str(error)
+    logger.warning(message)
+    return JSONResponse(
+        {"status": status.HTTP_400_BAD_REQUEST, "error": "Bad Request", "message": message},
+        status.HTTP_400_BAD_REQUEST,
+    )
+
+
+async def http_error(_request: Request, error: HTTPException):
+    """Answers aborts with a JSON message, like flask-restx"""
+    return JSONResponse({"message": error.detail}, error.status_code, error.headers)
+
+
+ROUTES = [
+    Route("/health", health),
+    Route("/api/orders", list_orders, methods=["GET"]),
+    Route("/api/orders", create_order, methods=["POST"]),
+    Route("/api/orders/{order_id:int}", get_order, methods=["GET"], name="order"),
+    Route("/api/orders/{order_id:int}", update_order, methods=["PUT"]),
+    Route("/api/orders/{order_id:int}", delete_order, methods=["DELETE"]),
+    Route("/api/orders/{order_id:int}/cancel", cancel_order, methods=["PUT"]),
+    Route("/api/orders/{order_id:int}/repeat", repeat_order, methods=["POST"]),
+    Route("/api/orders/{order_id:int}/items", list_items, methods=["GET"]),
+    Route("/api/orders/{order_id:int}/items", create_item, methods=["POST"]),
+    Route("/api/orders/{order_id:int}/items/{item_id:int}", get_item, methods=["GET"]),
+    Route("/api/orders/{order_id:int}/items/{item_id:int}", update_item, methods=["PUT"]),
+    Route("/api/orders/{order_id:int}/items/{item_id:int}", delete_item, methods=["DELETE"]),
+]
+
+
+def create_app(database_uri: str = config.DATABASE_URI) -> Starlette:
+    """Creates the ASGI application for a database
+
+    Args:
+        database_uri (string): the sync SQLAlchemy URI from the configuration
+    """
+
+    @asynccontextmanager
+    async def lifespan(application: Starlette):
+        uri = async_database_uri(database_uri)
+        engine = create_async_engine(uri, **engine_options(uri))
+        if config.DB_AUTO_CREATE:
+            # the same tables and partitions the Flask app creates
+            async with engine.begin() as connection:
+                await connection.run_sync(create_schema, settings())
+        # objects stay readable after commit without another round trip
+        application.state.session = async_sessionmaker(engine, expire_on_commit=False)
+        logger.info("Async service initialized on %s", engine.dialect.name)
+        yield
+        await engine.dispose()
+
+    return Starlette(
+        routes=ROUTES,
+        lifespan=lifespan,
+        exception_handlers={DataValidationError: request_validation_error, HTTPException: http_error},
+    )
+
+
+app = create_app()
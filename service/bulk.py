@@ -0,0 +1,439 @@
+"""
+Bulk data movement for Orders and Items
+
+Streams the order and item tables without going through ORM hydration or
+serialize(). On PostgreSQL with psycopg 3 the rows come straight out of
+``COPY ... TO STDOUT``; on any other backend a server-side cursor is read
+in batches. Either way memory use stays flat regardless of the table size.
+
+Imports read the same flat row-per-item format back. Rows are streamed into
+a temporary staging table (``COPY ... FROM STDIN`` on PostgreSQL), checked
+with set-based SQL and merged into the order and item tables in a single
+transaction, with total_price computed by the database.
+"""
+import io
+import csv
+import json
+import time
+import logging
+from datetime import datetime
+from sqlalchemy import (
+    MetaData,
+    Table,
+    Column,
+    Integer,
+    Float,
+    Numeric,
+    DateTime,
+    Text,
+    select,
+    insert,
+    update,
+    case,
+    cast,
+    func,
+    or_,
+    and_,
+    not_,
+    bindparam,
+)
+from service.models import db, Order, Item, DataValidationError, highest_order_id
+from service.common.replicas import read_engine
+
+# pylint cannot see through SQLAlchemy's func.* generator
+# pylint: disable=not-callable
+
+logger = logging.getLogger("flask.app")
+
+# Supported export formats and their mimetypes
+EXPORT_FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+# Rows fetched per round trip when COPY is not available
+EXPORT_BATCH_SIZE = 2000
+
+# One row per item, orders without items get a single row with empty item
+# columns. No ORDER BY so the database never has to sort the whole table.
+EXPORT_QUERY = select(
+    Order.id.label("order_id"),
+    Order.customer_id,
+    Order.status,
+    Order.creation_time,
+    Order.last_updated_time,
+    Order.total_price,
+    Item.id.label("item_id"),
+    Item.name,
+    Item.price,
+    Item.description,
+    Item.quantity,
+).select_from(Order.__table__.outerjoin(Item.__table__))
+
+
+def _supports_copy(engine) -> bool:
+    return engine.dialect.name == "postgresql" and engine.dialect.driver == "psycopg"
+
+
+def export_orders(fmt: str = "csv"):
+    """Returns an iterator of byte blocks holding every order and item row
+
+    Args:
+        fmt (string): one of EXPORT_FORMATS
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise DataValidationError(f"Unsupported export format: {fmt}")
+    logger.info("Processing %s export of all orders", fmt)
+    engine = read_engine(db.engine)
+    if _supports_copy(engine):
+        return _copy_export(engine, fmt)
+    return _cursor_export(engine, fmt)
+
+
+def _copy_export(engine, fmt: str):
+    """Streams the export with COPY ... TO STDOUT"""
+    query = str(EXPORT_QUERY.compile(dialect=engine.dialect))
+    if fmt == "csv":
+        copy_sql = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    else:
+        # a single JSON column, with quote and delimiter characters that
+        # row_to_json() always escapes, so the documents pass through untouched
+        copy_sql = (
+            f"COPY (SELECT row_to_json(r) FROM ({query}) AS r) TO STDOUT "
+            "WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')"
+        )
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            with cursor.copy(copy_sql) as copy:
+                for block in copy:
+                    yield bytes(block)
+    finally:
+        connection.close()
+
+
+def _cursor_export(engine, fmt: str):
+    """Streams the export from a server-side cursor, one batch at a time"""
+    with engine.connect() as connection:
+        result = connection.execution_options(yield_per=EXPORT_BATCH_SIZE).execute(
+            EXPORT_QUERY
+        )
+        columns = list(result.keys())
+        buffer = io.StringIO()
+        if fmt == "csv":
+            writer = csv.writer(buffer, lineterminator="\n")
+            writer.writerow(columns)
+            write_row = writer.writerow
+        else:
+
+            def write_row(row):
+                document = dict(zip(columns, row))
+                buffer.write(json.dumps(document, default=_isoformat) + "\n")
+
+        for batch in result.partitions():
+            for row in batch:
+                write_row(row)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        # the CSV header alone when the tables are empty
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8")
+
+
+def _isoformat(value):
+    """JSON encoder hook for the datetime columns"""
+    return value.isoformat()
+
+
+######################################################################
+# Import
+######################################################################
+
+# Rows inserted per round trip when COPY is not available
+IMPORT_BATCH_SIZE = 2000
+
+INTEGER_PATTERN = "^-?[0-9]{1,9}$"
+NUMBER_PATTERN = "^-?[0-9]+([.][0-9]+)?$"
+TIMESTAMP_PATTERN = "^[0-9]{4}-[0-9]{2}-[0-9]{2}([ T][0-9]{2}:[0-9]{2}:[0-9]{2}([.][0-9]{1,6})?)?$"
+TIMESTAMP_COLUMNS = ("creation_time", "last_updated_time")
+# staged text that would not fit its VARCHAR column
+TEXT_LIMITS = (
+    ("status", Order.__table__.c.status.type.length),
+    ("name", Item.__table__.c.name.type.length),
+    ("description", Item.__table__.c.description.type.length),
+)
+
+# Everything is staged as text so that a bad value becomes a rejected row
+# instead of aborting the whole load. Temporary tables are never written to
+# the WAL, are private to the session and vanish with it.
+staging_metadata = MetaData()
+staging = Table(
+    "order_import_staging",
+    staging_metadata,
+    Column("row_no", Integer),
+    Column("order_ref", Text),
+    Column("customer_id", Text),
+    Column("status", Text),
+    Column("creation_time", Text),
+    Column("last_updated_time", Text),
+    Column("name", Text),
+    Column("price", Text),
+    Column("description", Text),
+    Column("quantity", Text),
+    Column("error", Text),
+    prefixes=["TEMPORARY"],
+)
+# staged order_ref -> the id the new order will get
+import_keys = Table(
+    "order_import_keys",
+    staging_metadata,
+    Column("order_ref", Text, primary_key=True),
+    Column("order_id", Integer),
+    prefixes=["TEMPORARY"],
+)
+STAGED_COLUMNS = [column.name for column in staging.columns][1:-1]
+# the file calls the grouping key order_id, like the export does
+FILE_COLUMNS = {"order_ref": "order_id"}
+
+
+def import_orders(stream, fmt: str = "csv", rejects_path: str = None) -> dict:
+    """Loads orders and items from a CSV or NDJSON stream
+
+    Rows sharing an order_id become one new order; rows that fail validation
+    reject their whole order and are written to `rejects_path` as CSV.
+
+    Args:
+        stream (file): a text stream in the export format
+        fmt (string): one of EXPORT_FORMATS
+        rejects_path (string): where to write the rejected rows, if any
+    Returns:
+        dict: counts of rows read, orders and items imported, rows rejected
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise DataValidationError(f"Unsupported import format: {fmt}")
+    logger.info("Processing %s import of orders", fmt)
+    started = time.perf_counter()
+    engine = db.engine
+    with engine.begin() as connection:
+        staging_metadata.drop_all(connection)
+        staging_metadata.create_all(connection)
+        rows = _load_staging(connection, _read_rows(stream, fmt))
+        _validate_staging(connection)
+        rejected = _write_rejects(connection, rejects_path)
+        orders, items = _merge_staging(connection)
+        staging_metadata.drop_all(connection)
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "rows": rows,
+        "orders": orders,
+        "items": items,
+        "rejected": rejected,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows / elapsed) if elapsed else rows,
+    }
+    logger.info("Import finished: %s", summary)
+    return summary
+
+
+def _read_rows(stream, fmt: str):
+    """Yields staging tuples (row_no, columns..., error) from the input"""
+    if fmt == "csv":
+        records = ((record, None) for record in csv.DictReader(stream))
+    else:
+        records = (_parse_json_line(line) for line in stream if line.strip())
+    for row_no, (record, error) in enumerate(records, start=1):
+        values = [_text(record.get(FILE_COLUMNS.get(name, name))) for name in STAGED_COLUMNS]
+        yield (row_no, *values, error or _calendar_error(dict(zip(STAGED_COLUMNS, values))))
+
+
+def _calendar_error(values: dict):
+    """Catches timestamps that are not real dates, like 2024-13-45, before the merge casts them"""
+    for name in TIMESTAMP_COLUMNS:
+        if values[name] is not None:
+            try:
+                datetime.fromisoformat(values[name])
+            except ValueError:
+                return f"invalid {name}"
+    return None
+
+
+def _parse_json_line(line: str):
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return {}, "malformed JSON"
+    if not isinstance(record, dict):
+        return {}, "malformed JSON"
+    return record, None
+
+
+def _text(value):
+    """Stages every value as text, with empty strings as NULL"""
+    if value is None or value == "":
+        return None
+    return str(value)
+
+
+def _load_staging(connection, rows) -> int:
+    """Streams the rows into the staging table, returns how many"""
+    count = 0
+    names = [column.name for column in staging.columns]
+    if _supports_copy(connection.engine):
+        cursor = connection.connection.driver_connection.cursor()
+        with cursor.copy(f"COPY {staging.name} ({', '.join(names)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+                count += 1
+        # temporary tables are never auto-analyzed, the merge needs statistics
+        cursor.execute(f"ANALYZE {staging.name}")
+        return count
+
+    batch = []
+    for row in rows:
+        batch.append(dict(zip(names, row)))
+        if len(batch) == IMPORT_BATCH_SIZE:
+            connection.execute(insert(staging), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        connection.execute(insert(staging), batch)
+        count += len(batch)
+    return count
+
+
+def _invalid(column, pattern, required=True):
+    """True when a staged value is missing (if required) or malformed"""
+    malformed = not_(column.regexp_match(pattern))
+    if required:
+        return or_(column.is_(None), malformed)
+    return and_(column.isnot(None), malformed)
+
+
+def _validate_staging(connection):
+    """Marks every row that cannot be imported with the reason why"""
+    row = staging.c
+    has_item = or_(row.name.isnot(None), row.price.isnot(None), row.quantity.isnot(None))
+    connection.execute(
+        update(staging)
+        .where(row.error.is_(None))
+        .values(
+            error=case(
+                (row.order_ref.is_(None), "missing order_id"),
+                (_invalid(row.customer_id, INTEGER_PATTERN), "invalid customer_id"),
+                (row.status.is_(None), "missing status"),
+                *((func.length(row[name]) > length, f"{name} too long") for name, length in TEXT_LIMITS),
+                (_invalid(row.creation_time, TIMESTAMP_PATTERN, False), "invalid creation_time"),
+                (
+                    _invalid(row.last_updated_time, TIMESTAMP_PATTERN, False),
+                    "invalid last_updated_time",
+                ),
+                (and_(has_item, _invalid(row.price, NUMBER_PATTERN)), "invalid price"),
+                (and_(has_item, _invalid(row.quantity, INTEGER_PATTERN)), "invalid quantity"),
+                else_=None,
+            )
+        )
+    )
+    # every row of an order must agree on the order columns
+    conflicting = (
+        select(row.order_ref)
+        .group_by(row.order_ref)
+        .having(
+            or_(
+                func.count(row.customer_id.distinct()) > 1,
+                func.count(row.status.distinct()) > 1,
+            )
+        )
+    )
+    connection.execute(
+        update(staging)
+        .where(row.error.is_(None), row.order_ref.in_(conflicting))
+        .values(error="conflicting order columns")
+    )
+    # an order is imported whole or not at all
+    rejected = select(row.order_ref).where(row.error.isnot(None), row.order_ref.isnot(None))
+    connection.execute(
+        update(staging)
+        .where(row.error.is_(None), row.order_ref.in_(rejected))
+        .values(error="order has rejected rows")
+    )
+
+
+def _write_rejects(connection, rejects_path: str) -> int:
+    """Writes the rejected rows to a CSV side file, returns how many"""
+    rejected = select(staging).where(staging.c.error.isnot(None)).order_by(staging.c.row_no)
+    count = connection.execute(select(func.count()).select_from(rejected.subquery())).scalar()
+    if count and rejects_path:
+        result = connection.execution_options(yield_per=IMPORT_BATCH_SIZE).execute(rejected)
+        with open(rejects_path, "w", encoding="utf-8", newline="") as side_file:
+            writer = csv.writer(side_file, lineterminator="\n")
+            writer.writerow(result.keys())
+            writer.writerows(result)
+    return count
+
+
+def _timestamp(column, engine):
+    """Converts a staged ISO-8601 string into the backend's timestamp"""
+    if engine.dialect.name == "sqlite":
+        # SQLite keeps datetimes as text in "YYYY-MM-DD HH:MM:SS.ffffff" form
+        return func.replace(column, "T", " ")
+    return cast(column, DateTime)
+
+
+def _merge_staging(connection) -> tuple:
+    """Inserts the valid staged rows as new orders and items"""
+    row = staging.c
+    engine = connection.engine
+    order_table = Order.__table__
+    valid = row.error.is_(None)
+
+    # hand out the new order ids up front so items can be joined to them
+    if engine.dialect.name == "postgresql":
+        sequence = func.pg_get_serial_sequence(f'"{order_table.name}"', "id")
+        new_id = func.nextval(sequence)
+    else:
+        # past the archived orders too, whose ids are never handed out again
+        new_id = highest_order_id() + func.row_number().over(order_by=row.order_ref)
+    connection.execute(
+        insert(import_keys).from_select(
+            ["order_ref", "order_id"],
+            select(row.order_ref, new_id).where(valid).group_by(row.order_ref),
+        )
+    )
+
+    now = bindparam("now", datetime.now(), type_=DateTime)
+    line_total = cast(row.price, Float) * cast(row.quantity, Integer)
+    created = func.coalesce(_timestamp(func.min(row.creation_time), engine), now)
+    orders = connection.execute(
+        insert(order_table).from_select(
+            ["id", "customer_id", "status", "creation_time", "last_updated_time", "total_price"],
+            select(
+                import_keys.c.order_id,
+                cast(func.min(row.customer_id), Integer),
+                func.min(row.status),
+                created,
+                func.coalesce(_timestamp(func.min(row.last_updated_time), engine), created),
+                func.coalesce(func.round(cast(func.sum(line_total), Numeric), 2), 0.0),
+            )
+            .join_from(staging, import_keys, row.order_ref == import_keys.c.order_ref)
+            .where(valid)
+            .group_by(import_keys.c.order_id),
+        )
+    ).rowcount
+
+    items = connection.execute(
+        insert(Item.__table__).from_select(
+            ["order_id", "name", "price", "description", "quantity", "order_creation_time"],
+            select(
+                import_keys.c.order_id,
+                row.name,
+                cast(row.price, Float),
+                row.description,
+                cast(row.quantity, Integer),
+                order_table.c.creation_time,
+            )
+            .join_from(staging, import_keys, row.order_ref == import_keys.c.order_ref)
+            .join(order_table, order_table.c.id == import_keys.c.order_id)
+            # validation guarantees every item row has a price
+            .where(valid, row.price.isnot(None)),
+        )
+    ).rowcount
+    return orders, items
@@ -1,8 +1,17 @@
 """
 Flask CLI Command Extensions
 """
-from service import app
-from service.models import db
+from datetime import date, datetime
+import click
+from flask import Blueprint, current_app
+from service.models import db, create_tables
+from service.bulk import EXPORT_FORMATS, export_orders, import_orders
+from service.archive import ARCHIVE_BATCH_SIZE, archive_orders
+from service.seeding import OrderGenerator, parse_count, parse_range, seed_orders
+from service.common import memory_profiling, partitions, slow_queries
+
+# The commands are registered at the top level, e.g. `flask db-create`
+blueprint = Blueprint("cli", __name__, cli_group=None)
 
 
 ######################################################################
@@ -10,7 +19,7 @@ from service.models import db
 # Usage:
 #   flask db-create
 ######################################################################
-@app.cli.command("db-create")
+@blueprint.cli.command("db-create")
 def db_create():
     """
     Recreates a local database. You probably should not use this on
@@ -19,3 +28,241 @@ def db_create():
     db.drop_all()
     db.create_all()
     db.session.commit()
+
+
+######################################################################
+# Command to create any missing tables, e.g. before the first deploy
+# Usage:
+#   flask db-init
+######################################################################
+@blueprint.cli.command("db-init")
+def db_init():
+    """
+    Creates the tables (and partitions) that do not exist yet
+    """
+    create_tables(current_app)
+
+
+######################################################################
+# Command to export all orders and items
+# Usage:
+#   flask export-orders --format ndjson --output orders.ndjson
+######################################################################
+@blueprint.cli.command("export-orders")
+@click.option("--format", "fmt", type=click.Choice(list(EXPORT_FORMATS)), default="csv")
+@click.option("--output", type=click.File("wb"), default="-", help="Defaults to stdout")
+def export_orders_command(fmt, output):
+    """
+    Streams every order and item row to a CSV or NDJSON file
+    """
+    for block in export_orders(fmt):
+        output.write(block)
+
+
+######################################################################
+# Command to bulk load orders and items
+# Usage:
+#   flask import-orders orders.csv --rejects bad-rows.csv
+######################################################################
+@blueprint.cli.command("import-orders")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(list(EXPORT_FORMATS)), help="Defaults to the file extension")
+@click.option("--rejects", type=click.Path(dir_okay=False), help="Defaults to <file>.rejects.csv")
+def import_orders_command(file, fmt, rejects):
+    """
+    Loads orders and items from a CSV or NDJSON file in the export format
+    """
+    if fmt is None:
+        fmt = "ndjson" if file.name.endswith((".ndjson", ".jsonl")) else "csv"
+    rejects = rejects or f"{file.name}.rejects.csv"
+    summary = import_orders(file, fmt, rejects)
+    click.echo(
+        f"Imported {summary['orders']} orders with {summary['items']} items "
+        f"from {summary['rows']} rows in {summary['seconds']}s "
+        f"({summary['rows_per_second']} rows/sec)"
+    )
+    if summary["rejected"]:
+        click.echo(f"Rejected {summary['rejected']} rows, see {rejects}")
+
+
+######################################################################
+# Command to move finished orders to the archive
+# Usage:
+#   flask archive-orders --days 90
+######################################################################
+@blueprint.cli.command("archive-orders")
+@click.option("--days", type=int, help="Defaults to ARCHIVE_AFTER_DAYS")
+@click.option("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE, show_default=True)
+def archive_orders_command(days, batch_size):
+    """
+    Moves delivered and canceled orders into the archive tables
+    """
+    days = current_app.config["ARCHIVE_AFTER_DAYS"] if days is None else days
+    moved = archive_orders(days, current_app.config["ARCHIVE_STATUSES"], batch_size)
+    click.echo(f"Archived {moved} orders not updated for {days} days")
+
+
+######################################################################
+# Commands to manage the monthly order partitions
+# Usage:
+#   flask create-partitions --start 2024-01 --months 6
+#   flask detach-partitions --before 2023-01 --drop
+######################################################################
+NOT_PARTITIONED = "The order table is not partitioned, see ORDER_PARTITIONING"
+
+
+@blueprint.cli.command("create-partitions")
+@click.option("--start", type=click.DateTime(["%Y-%m"]), help="First month, defaults to this month")
+@click.option("--months", type=int, help="Defaults to PARTITION_MONTHS_AHEAD + 1")
+def create_partitions_command(start, months):
+    """
+    Pre-creates the monthly order and item partitions
+    """
+    start = start.date() if start else date.today()
+    months = months or current_app.config["PARTITION_MONTHS_AHEAD"] + 1
+    with db.engine.begin() as connection:
+        if not partitions.is_partitioned(connection):
+            raise click.ClickException(NOT_PARTITIONED)
+        created = partitions.create_partitions(connection, start, months)
+    click.echo(f"Partitions ready for {', '.join(month.strftime('%Y-%m') for month in created)}")
+
+
+@blueprint.cli.command("detach-partitions")
+@click.option("--before", type=click.DateTime(["%Y-%m"]), required=True, help="First month to keep")
+@click.option("--drop", is_flag=True, help="Drop the detached tables instead of keeping them")
+def detach_partitions_command(before, drop):
+    """
+    Detaches or drops the order and item partitions of old months
+    """
+    with db.engine.begin() as connection:
+        if not partitions.is_partitioned(connection):
+            raise click.ClickException(NOT_PARTITIONED)
+        detached = partitions.detach_partitions(connection, before.date(), drop)
+    action = "Dropped" if drop else "Detached"
+    click.echo(f"{action} {len(detached)} months: {', '.join(month.strftime('%Y-%m') for month in detached)}")
+
+
+######################################################################
+# Command to summarize the slow query log
+# Usage:
+#   flask slow-queries --limit 5 --plans
+######################################################################
+@blueprint.cli.command("slow-queries")
+@click.option("--limit", type=int, default=10, show_default=True, help="Statement shapes to show")
+@click.option("--log", "path", type=click.Path(dir_okay=False), help="Defaults to SLOW_QUERY_LOG")
+@click.option("--plans", is_flag=True, help="Show the plan of each shape's slowest explained run")
+def slow_queries_command(limit, path, plans):
+    """
+    Summarizes the slow query log, worst statement shapes first
+    """
+    path = path or current_app.config["SLOW_QUERY_LOG"]
+    records = slow_queries.read_log(path, current_app.config["SLOW_QUERY_LOG_BACKUPS"])
+    if not records:
+        click.echo(f"No slow queries in {path}")
+        return
+    click.echo(f"{len(records)} slow queries in {path}")
+    for rank, entry in enumerate(slow_queries.summarize(records, limit), 1):
+        click.echo(
+            f"\n#{rank} {entry['count']} runs, {entry['total_ms']:.1f} ms total, "
+            f"{entry['mean_ms']:.1f} ms mean, {entry['max_ms']:.1f} ms max"
+        )
+        click.echo(f"  routes: {', '.join(entry['routes'])}")
+        click.echo(f"  {entry['statement'][:500]}")
+        if "parameters" in entry["slowest"]:
+            click.echo(f"  slowest with: {entry['slowest']['parameters']}")
+        if plans and entry["plan"]:
+            for line in entry["plan"]:
+                click.echo(f"    {line}")
+
+
+######################################################################
+# Command to summarize the memory profile
+# Usage:
+#   flask memory-report --limit-mb 64 --sites 3
+######################################################################
+@blueprint.cli.command("memory-report")
+@click.option("--log", "path", type=click.Path(dir_okay=False), help="Defaults to MEMORY_PROFILE_LOG")
+@click.option("--limit-mb", type=float, help="Defaults to MEMORY_LIMIT_MB")
+@click.option("--sites", type=int, default=5, show_default=True, help="Allocation sites to show per route")
+def memory_report_command(path, limit_mb, sites):
+    """
+    Summarizes the memory profile by route, with the largest safe result
+    """
+    path = path or current_app.config["MEMORY_PROFILE_LOG"]
+    limit_mb = limit_mb or current_app.config["MEMORY_LIMIT_MB"]
+    records = slow_queries.read_log(path, current_app.config["MEMORY_PROFILE_LOG_BACKUPS"])
+    if not records:
+        click.echo(f"No memory profile in {path}, run with MEMORY_PROFILING=true")
+        return
+    describe = memory_profiling.describe
+    click.echo(f"{len(records)} requests in {path}, {limit_mb:g} MiB limit")
+    for entry in memory_profiling.summarize(records, int(limit_mb * memory_profiling.MIB), sites):
+        sizes = f", {entry['results'][0]}-{entry['results'][1]} results" if entry["results"] else ""
+        click.echo(
+            f"\n{entry['route']}: {entry['count']} requests{sizes}, "
+            f"peak {describe(entry['mean_peak'])} mean, {describe(entry['max_peak'])} max"
+        )
+        curve = entry["curve"]
+        if curve:
+            sign = "+" if curve["slope"] >= 0 else "-"
+            click.echo(
+                f"  peak ~ {describe(curve['intercept'])} {sign} {describe(abs(curve['slope']))} per result "
+                f"(r2 {curve['r_squared']:.2f})"
+            )
+        if entry["safe_results"] is not None:
+            resident = f" with {describe(entry['resident'])} resident" if entry["resident"] else ""
+            click.echo(f"  safe maximum: {entry['safe_results']} results{resident}")
+            if entry["resident"] and entry["resident"] >= limit_mb * memory_profiling.MIB:
+                click.echo("  the worker is over the limit before the request even starts")
+        for name, peak in entry["operations"].items():
+            click.echo(f"  {name}: {describe(peak)} max")
+        for site, size in entry["sites"]:
+            click.echo(f"  {describe(size):>10}  {site}")
+
+
+######################################################################
+# Command to fill the database with synthetic orders for benchmarks
+# Usage:
+#   flask seed-orders --orders 10M --items-per-order 1..20 --processes 4
+######################################################################
+def _parsed(parse):
+    """A click callback that reports a parse error as a bad parameter"""
+
+    def callback(_context, _parameter, value):
+        try:
+            return parse(value)
+        except ValueError as error:
+            raise click.BadParameter(str(error)) from error
+
+    return callback
+
+
+@blueprint.cli.command("seed-orders")
+@click.option("--orders", default="10000", callback=_parsed(parse_count), show_default=True, help="e.g. 250K or 10M")
+@click.option("--items-per-order", default="1..20", callback=_parsed(parse_range), show_default=True)
+@click.option("--customers", type=click.IntRange(min=1), default=100000, show_default=True)
+@click.option("--days", type=click.IntRange(min=0), default=365, show_default=True, help="Spread of creation times")
+@click.option("--seed", type=int, default=42, show_default=True)
+@click.option("--until", type=click.DateTime(["%Y-%m-%d"]), help="Latest creation date, defaults to today")
+@click.option("--processes", type=click.IntRange(min=1), default=1, show_default=True)
+def seed_orders_command(  # pylint: disable=too-many-arguments
+    orders, items_per_order, customers, days, seed, until, processes
+):
+    """
+    Adds synthetic orders and items with realistic distributions
+    """
+    until = until or datetime.combine(date.today(), datetime.min.time())
+    generator = OrderGenerator(seed, items_per_order, customers, days, until)
+    started = datetime.now()
+    summary = seed_orders(
+        current_app._get_current_object(),  # pylint: disable=protected-access
+        orders,
+        generator,
+        processes,
+        progress=lambda loaded: click.echo(f"\r{loaded}/{orders} orders", nl=False),
+    )
+    seconds = max((datetime.now() - started).total_seconds(), 0.001)
+    click.echo(
+        f"\nSeeded {summary['orders']} orders (ids {summary['first_id']}-{summary['last_id']}) "
+        f"with {summary['items']} items in {seconds:.1f}s ({summary['orders'] / seconds:.0f} orders/sec)"
+    )
@@ -0,0 +1,145 @@
+"""
+Response Compression
+
+Negotiated gzip/zstd compression for API responses above a size threshold,
+and serving of build-time precompressed static assets.
+
+The static files are compressed once when the image is built with:
+    python service/common/compression.py service/static
+which writes a ``.gz`` (and ``.zst`` when zstandard is installed) next to
+every text asset. This module deliberately imports nothing from ``service``
+so that it can run as a script without starting the application.
+"""
+import os
+import sys
+import gzip
+import mimetypes
+from flask import current_app, request, send_from_directory
+from werkzeug.security import safe_join
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# API representations worth compressing
+COMPRESSIBLE_MIMETYPES = frozenset(("application/json", "application/msgpack"))
+
+# Static assets that get precompressed (images are already compressed)
+PRECOMPRESS_EXTENSIONS = (".html", ".css", ".js")
+
+# Content-Encoding -> file suffix, in order of server preference
+SUFFIXES = {"zstd": ".zst", "gzip": ".gz"}
+
+
+def _gzip(data: bytes, level: int) -> bytes:
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _zstd(data: bytes, level: int) -> bytes:
+    # compressor objects are not thread safe, so make one per call
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+ENCODERS = {"gzip": _gzip}
+if zstandard is not None:
+    ENCODERS["zstd"] = _zstd
+
+
+def negotiate_encoding(available) -> str:
+    """Returns the client's preferred encoding out of `available`, if any"""
+    offers = [encoding for encoding in SUFFIXES if encoding in available]
+    if not offers:
+        return None
+    return request.accept_encodings.best_match(offers)
+
+
+######################################################################
+# Dynamic compression of API responses
+######################################################################
+def compress_response(response):
+    """Compresses large API responses with the negotiated encoding"""
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or not 200 <= response.status_code < 300
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_MIMETYPES
+    ):
+        return response
+
+    # the representation may change with Accept-Encoding even when this
+    # particular response stays small
+    response.vary.add("Accept-Encoding")
+    body = response.get_data()
+    if len(body) < current_app.config["COMPRESS_MIN_SIZE"]:
+        return response
+
+    encoding = negotiate_encoding(ENCODERS)
+    if encoding:
+        level = current_app.config[f"COMPRESS_LEVEL_{encoding.upper()}"]
+        response.set_data(ENCODERS[encoding](body, level))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+######################################################################
+# Precompressed static assets
+######################################################################
+def send_static(filename: str, max_age: int = None):
+    """Sends a static file, preferring a precompressed copy the client accepts"""
+    folder = current_app.static_folder
+    if max_age is None:
+        max_age = current_app.config["STATIC_MAX_AGE"]
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+    path = safe_join(folder, filename)
+    available = [
+        encoding
+        for encoding, suffix in SUFFIXES.items()
+        if path and os.path.isfile(path + suffix)
+    ]
+    encoding = negotiate_encoding(available)
+    if encoding:
+        response = send_from_directory(
+            folder, filename + SUFFIXES[encoding], mimetype=mimetype, max_age=max_age
+        )
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = send_from_directory(folder, filename, max_age=max_age)
+
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def init_compression(app):
+    """Sets up response compression and the precompressed static route"""
+    app.view_functions["static"] = send_static
+    app.after_request(compress_response)
+
+
+######################################################################
+# Build step
+######################################################################
+def precompress_static(folder: str) -> list:
+    """Writes a compressed copy of every text asset found under `folder`"""
+    written = []
+    for root, _, files in os.walk(folder):
+        for name in files:
+            if not name.endswith(PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as source:
+                data = source.read()
+            for encoding, encoder in ENCODERS.items():
+                target = path + SUFFIXES[encoding]
+                with open(target, "wb") as compressed:
+                    # build time, so spend the CPU on the highest ratio
+                    compressed.write(encoder(data, 9 if encoding == "gzip" else 19))
+                written.append(target)
+    return written
+
+
+if __name__ == "__main__":
+    for written_file in precompress_static(sys.argv[1] if len(sys.argv) > 1 else "service/static"):
+        print(written_file)
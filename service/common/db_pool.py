@@ -0,0 +1,167 @@
+"""
+Database Connection Pool
+
+Builds the SQLAlchemy engine options from the DB_POOL_* settings and
+instruments the pool so operators can see checkouts, overflow, timeouts
+and how long requests wait for a connection.
+"""
+import time
+import bisect
+import logging
+import threading
+from sqlalchemy import exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+logger = logging.getLogger("flask.app")
+
+# Upper bounds (milliseconds) of the checkout-wait histogram buckets
+WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Statistics per pool, keyed by pool_logging_name so they survive the pool
+# being recreated by engine.dispose()
+POOL_STATS = {}
+
+# Callables told about every checkout attempt as (pool, wait_ms, timed_out)
+# and every connection returned as (pool), e.g. service.common.metrics
+CHECKOUT_LISTENERS = []
+CHECKIN_LISTENERS = []
+
+
+class PoolStats:
+    """Thread-safe checkout counters and wait histogram for one pool"""
+
+    def __init__(self, warn_ms: float = 100.0, log_interval: float = 60.0):
+        self.warn_ms = warn_ms
+        self.log_interval = log_interval
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_sum_ms = 0.0
+        self.wait_max_ms = 0.0
+        self.wait_buckets = [0] * (len(WAIT_BUCKETS_MS) + 1)
+        self.last_logged = time.monotonic()
+
+    def observe(self, wait_ms: float, timed_out: bool = False):
+        """Records one checkout attempt"""
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            self.wait_sum_ms += wait_ms
+            self.wait_max_ms = max(self.wait_max_ms, wait_ms)
+            self.wait_buckets[bisect.bisect_left(WAIT_BUCKETS_MS, wait_ms)] += 1
+            now = time.monotonic()
+            due = now - self.last_logged >= self.log_interval
+            if due:
+                self.last_logged = now
+        return due
+
+    def snapshot(self) -> dict:
+        """Returns the counters with a cumulative histogram"""
+        with self.lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(WAIT_BUCKETS_MS + ("+Inf",), self.wait_buckets):
+                cumulative += count
+                buckets[str(bound)] = cumulative
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_ms": {
+                    "count": cumulative,
+                    "sum": round(self.wait_sum_ms, 3),
+                    "max": round(self.wait_max_ms, 3),
+                    "buckets": buckets,
+                },
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that times how long each checkout waits"""
+
+    _timing = threading.local()
+
+    @property
+    def stats(self) -> PoolStats:
+        """The statistics shared by every incarnation of this pool"""
+        return POOL_STATS.setdefault(self._orig_logging_name or "default", PoolStats())
+
+    def _do_get(self):
+        # QueuePool._do_get() calls itself again on overflow races
+        if getattr(self._timing, "active", False):
+            return super()._do_get()
+        self._timing.active = True
+        started = time.perf_counter()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            self._timing.active = False
+            self._observe((time.perf_counter() - started) * 1000, timed_out)
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        for listener in CHECKIN_LISTENERS:
+            listener(self)
+
+    def _observe(self, wait_ms: float, timed_out: bool):
+        for listener in CHECKOUT_LISTENERS:
+            listener(self, wait_ms, timed_out)
+        stats = self.stats
+        if stats.observe(wait_ms, timed_out):
+            logger.info("Connection pool statistics: %s", pool_statistics(self))
+        if timed_out:
+            logger.error("Timed out after %.0f ms waiting for a database connection: %s", wait_ms, self.status())
+        elif wait_ms >= stats.warn_ms:
+            logger.warning("Waited %.0f ms for a database connection: %s", wait_ms, self.status())
+
+
+def engine_options(config, name: str = "primary") -> dict:
+    """Returns SQLAlchemy engine options for the configured database
+
+    Args:
+        config (dict): the Flask application configuration
+        name (string): identifies the pool in the statistics
+    """
+    options = {"pool_pre_ping": config.get("DB_POOL_PRE_PING", True)}
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_driver_name() in ("psycopg", "psycopg_async"):
+        # server-side prepared statements for queries run repeatedly
+        options["connect_args"] = {"prepare_threshold": config.get("DB_PREPARE_THRESHOLD", 2)}
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        # in-memory SQLite lives in a single static connection
+        return options
+    POOL_STATS.setdefault(name, PoolStats())
+    POOL_STATS[name].warn_ms = config.get("DB_POOL_WAIT_WARN_MS", 100.0)
+    POOL_STATS[name].log_interval = config.get("DB_POOL_LOG_INTERVAL", 60.0)
+    options.update(
+        poolclass=InstrumentedQueuePool,
+        pool_logging_name=name,
+        pool_size=config.get("DB_POOL_SIZE", 5),
+        max_overflow=config.get("DB_MAX_OVERFLOW", 5),
+        pool_timeout=config.get("DB_POOL_TIMEOUT", 10.0),
+        pool_recycle=config.get("DB_POOL_RECYCLE", 1800),
+    )
+    return options
+
+
+def pool_statistics(pool) -> dict:
+    """Returns the live state of a pool plus its checkout statistics"""
+    if not isinstance(pool, InstrumentedQueuePool):
+        return {"pool": pool.status()}
+    statistics = {
+        "size": pool.size(),
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        # negative until the pool itself is full
+        "overflow": max(0, pool.overflow()),
+        "max_overflow": pool._max_overflow,  # pylint: disable=protected-access
+        "timeout": pool.timeout(),
+    }
+    statistics.update(pool.stats.snapshot())
+    return statistics
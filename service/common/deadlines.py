@@ -0,0 +1,83 @@
+"""
+Request Deadlines
+
+Every request gets a latency budget: REQUEST_DEADLINE_MS, or the entry for
+its endpoint in REQUEST_DEADLINES. A client can shorten it (never extend
+it) with an ``X-Request-Deadline`` header holding the milliseconds it is
+still willing to wait. Values that are not finite numbers are ignored,
+and larger ones than PostgreSQL takes as a timeout are cut down to it.
+
+Each database transaction the request begins is given what is left of the
+budget as the PostgreSQL ``statement_timeout``, set LOCAL so it ends with
+the transaction and never sticks to a pooled connection. A runaway query is
+then cancelled by the server instead of holding the worker and its
+connection. Other databases only get the budget checked as each
+transaction begins.
+
+A spent budget surfaces as DeadlineExceeded or as a cancelled statement,
+which service.common.error_handlers answer with 504_GATEWAY_TIMEOUT.
+"""
+import math
+import time
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from service.common.replicas import RoutingSession
+
+DEADLINE_HEADER = "X-Request-Deadline"
+
+# SQLSTATE of a statement cancelled by statement_timeout
+QUERY_CANCELED = "57014"
+# the largest statement_timeout PostgreSQL accepts, an int32 of milliseconds
+MAX_DEADLINE_MS = 2**31 - 1
+
+
+class DeadlineExceeded(Exception):
+    """Used when a request has used up its latency budget"""
+
+
+def _requested_ms():
+    try:
+        requested = float(request.headers[DEADLINE_HEADER])
+    except (KeyError, ValueError):
+        return None
+    return min(requested, MAX_DEADLINE_MS) if math.isfinite(requested) else None
+
+
+def start_deadline(app):
+    """Sets the deadline of the current request, before any work is done"""
+    g.deadline = None
+    budget = app.config["REQUEST_DEADLINES"].get(request.endpoint, app.config["REQUEST_DEADLINE_MS"]) or None
+    requested = _requested_ms()
+    if requested is not None:
+        budget = requested if budget is None else min(budget, requested)
+    if budget is None:
+        return
+    if budget <= 0:
+        raise DeadlineExceeded("The request deadline had passed before the request was started")
+    g.deadline = time.monotonic() + budget / 1000
+
+
+def remaining_ms():
+    """Returns the milliseconds left for the current request, None without a deadline"""
+    deadline = g.get("deadline") if has_request_context() else None
+    if deadline is None:
+        return None
+    return (deadline - time.monotonic()) * 1000
+
+
+def apply_statement_timeout(_session, _transaction, connection):
+    """Limits the statements of a new transaction to the time left"""
+    remaining = remaining_ms()
+    if remaining is None:
+        return
+    if remaining <= 0:
+        raise DeadlineExceeded("The request deadline was exceeded before querying the database")
+    if connection.dialect.name == "postgresql":
+        connection.exec_driver_sql(f"SET LOCAL statement_timeout = {max(1, int(remaining))}")
+
+
+def init_deadlines(app):
+    """Starts a deadline for every request and applies it to the database"""
+    app.before_request(lambda: start_deadline(app))
+    if not event.contains(RoutingSession, "after_begin", apply_statement_timeout):
+        event.listen(RoutingSession, "after_begin", apply_statement_timeout)
@@ -17,26 +17,51 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
+import math
+from flask import jsonify, current_app
+from sqlalchemy import exc
 from service.models import DataValidationError
-from service import app
+from service.common.deadlines import DeadlineExceeded, QUERY_CANCELED
+from service.common.rate_limits import RateLimited
 from . import status  # pylint: disable=no-name-in-module
 
+# Seconds a client should wait before retrying when no connection was free
+RETRY_AFTER = "1"
+
+
+def init_error_handlers(app, api=None):
+    """Registers the JSON error handlers with the app
+
+    The time out and rate limit handlers are registered with the flask-restx
+    api as well, which would otherwise answer those errors with a bare 500.
+    """
+    app.register_error_handler(DataValidationError, request_validation_error)
+    app.register_error_handler(status.HTTP_400_BAD_REQUEST, bad_request)
+    app.register_error_handler(status.HTTP_500_INTERNAL_SERVER_ERROR, internal_server_error)
+    api_handlers = {
+        DeadlineExceeded: deadline_exceeded,
+        exc.OperationalError: database_error,
+        exc.TimeoutError: connection_unavailable,
+        RateLimited: rate_limited,
+    }
+    for error, handler in api_handlers.items():
+        app.register_error_handler(error, handler)
+        if api is not None:
+            api.errorhandler(error)(handler)
+
 
 # ######################################################################
 # # Error Handlers
 # ######################################################################
-@app.errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
 
 
-@app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """Handles bad requests with 400_BAD_REQUEST"""
     message = str(error)
-    app.logger.warning(message)
+    current_app.logger.warning(message)
     return (
         jsonify(
             status=status.HTTP_400_BAD_REQUEST, error="Bad Request", message=message
@@ -101,11 +126,58 @@ def bad_request(error):
 #     )
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
+def deadline_exceeded(error):
+    """Handles requests that ran out of time with 504_GATEWAY_TIMEOUT"""
+    message = str(error)
+    current_app.logger.warning(message)
+    return (
+        {"status": status.HTTP_504_GATEWAY_TIMEOUT, "error": "Gateway Timeout", "message": message},
+        status.HTTP_504_GATEWAY_TIMEOUT,
+    )
+
+
+def database_error(error):
+    """Handles statements cancelled at the deadline, any other failure is a 500"""
+    if getattr(error.orig, "sqlstate", None) == QUERY_CANCELED:
+        return deadline_exceeded(DeadlineExceeded("The request deadline was exceeded while querying the database"))
+    current_app.logger.exception(error)
+    return (
+        {
+            "status": status.HTTP_500_INTERNAL_SERVER_ERROR,
+            "error": "Internal Server Error",
+            "message": "The database could not complete the request",
+        },
+        status.HTTP_500_INTERNAL_SERVER_ERROR,
+    )
+
+
+def connection_unavailable(error):
+    """Handles a connection pool with nothing free in time with 503_SERVICE_UNAVAILABLE"""
+    current_app.logger.error(str(error))
+    return (
+        {
+            "status": status.HTTP_503_SERVICE_UNAVAILABLE,
+            "error": "Service Unavailable",
+            "message": "No database connection was available, try again later",
+        },
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {"Retry-After": RETRY_AFTER},
+    )
+
+
+def rate_limited(error):
+    """Handles callers over their rate limit with 429_TOO_MANY_REQUESTS"""
+    return (
+        {"status": status.HTTP_429_TOO_MANY_REQUESTS, "error": "Too Many Requests", "message": str(error)},
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        {"Retry-After": str(math.ceil(error.retry_after))},
+    )
+
+
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
     message = str(error)
-    app.logger.error(message)
+    current_app.logger.error(message)
     return (
         jsonify(
             status=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -19,18 +19,240 @@ Log Handlers
 
 This module contains utility functions to set up logging
 consistently
+
+The app logger and the ``flask.app`` logger of the models and of
+service.common write through gunicorn's handlers, as text or, with
+LOG_FORMAT=json, as one JSON object per line carrying the trace and span
+ids of the request. With LOG_QUEUE the request thread only puts the record
+on a queue; a listener thread formats and writes it, so a slow disk or pipe
+never holds up a response. A full queue drops records rather than block,
+and the next record written says how many were lost.
+
+Hot-path messages can be sampled (LOG_SAMPLING) and rate limited
+(LOG_RATE_LIMITS) per logger and message template; warnings and errors
+always get through.
 """
+import os
+import json
+import queue
+import atexit
+import random
 import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from service.common import tracing
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+# Loggers set up alongside the app logger, the service modules use this one
+SERVICE_LOGGERS = ("flask.app",)
+
+# Record attributes added by the filters and the queue, copied into JSON
+EXTRA_FIELDS = ("trace_id", "span_id", "sample_rate", "suppressed", "dropped")
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as a single line JSON object"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "message": record.getMessage(),
+            "process": record.process,
+        }
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str)
+
+
+class TraceContextFilter(logging.Filter):
+    """Stamps records with the trace and span of the request that logs them"""
+
+    def filter(self, record):
+        span = tracing.current_span()
+        if span is not None:
+            record.trace_id = span.context.trace_id
+            record.span_id = span.context.span_id
+        return True
+
+
+class LogRule:
+    """Sampling rate and per second limit of one logger's messages"""
+
+    def __init__(self, prefix: str, rate: float = 1.0, per_second: float = 0.0):
+        self.prefix = prefix
+        self.rate = rate
+        self.per_second = per_second
+        self.suppressed = 0
+        self._tokens = per_second
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self, record) -> bool:
+        """Whether a record matching the rule is written"""
+        if self.rate < 1.0:
+            if random.random() >= self.rate:
+                return False
+            record.sample_rate = self.rate
+        if not self.per_second:
+            return True
+        with self._lock:
+            now = record.created
+            self._tokens = min(self.per_second, self._tokens + (now - self._last) * self.per_second)
+            self._last = now
+            if self._tokens < 1.0:
+                self.suppressed += 1
+                return False
+            self._tokens -= 1.0
+            if self.suppressed:
+                record.suppressed, self.suppressed = self.suppressed, 0
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Samples and rate limits the chatty messages of a logger, never warnings"""
+
+    def __init__(self, rules: list):
+        super().__init__()
+        # the most specific message template wins
+        self.rules = sorted(rules, key=lambda rule: len(rule.prefix), reverse=True)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        message = record.msg if isinstance(record.msg, str) else ""
+        for rule in self.rules:
+            if message.startswith(rule.prefix):
+                return rule.allow(record)
+        return True
+
+
+def sampling_rules(sampling: dict, rate_limits: dict) -> dict:
+    """Groups the "logger[:message]" settings into rules by logger name"""
+    rules = {}
+    for key in set(sampling) | set(rate_limits):
+        name, _, prefix = key.partition(":")
+        rules.setdefault(name, []).append(LogRule(prefix, sampling.get(key, 1.0), rate_limits.get(key, 0.0)))
+    return rules
+
+
+def init_sampling(sampling: dict, rate_limits: dict):
+    """Replaces the sampling filters of the loggers named in the settings"""
+    for logger in [logging.getLogger(name) for name in logging.root.manager.loggerDict] + [logging.root]:
+        if isinstance(logger, logging.Logger):
+            for old in [old for old in logger.filters if isinstance(old, SamplingFilter)]:
+                logger.removeFilter(old)
+    for name, rules in sampling_rules(sampling, rate_limits).items():
+        logging.getLogger(name).addFilter(SamplingFilter(rules))
+
+
+######################################################################
+# Queue
+######################################################################
+class NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the listener thread without ever waiting"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Merges the arguments now, they may change, and leaves the formatting to the listener"""
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.dropped = 0
+
+
+class DrainingQueueListener(QueueListener):
+    """A listener that can be stopped while the queue is full"""
+
+    def enqueue_sentinel(self):
+        # the listener thread is still emptying the queue, so this waits briefly
+        self.queue.put(self._sentinel)
+
+
+# The handler and listener of this process, at most one of each
+_queues = []
+
+
+def start_queue(handlers: list, size: int) -> NonBlockingQueueHandler:
+    """Starts a listener thread that writes to the handlers, returns the handler that feeds it"""
+    stop_queue()
+    handler = NonBlockingQueueHandler(queue.Queue(size))
+    listener = DrainingQueueListener(handler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    _queues.append((handler, listener))
+    return handler
+
+
+def stop_queue():
+    """Writes out what is still queued and stops the listener thread"""
+    while _queues:
+        _, listener = _queues.pop()
+        listener.stop()
+
+
+def _restart_after_fork():
+    """A forked worker gets a queue and listener thread of its own"""
+    if not _queues:
+        return
+    handler, listener = _queues.pop()
+    handler.queue = queue.Queue(handler.queue.maxsize)
+    listener = DrainingQueueListener(handler.queue, *listener.handlers, respect_handler_level=True)
+    listener.start()
+    _queues.append((handler, listener))
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+atexit.register(stop_queue)
 
 
 def init_logging(app, logger_name: str):
     """Set up logging for production"""
-    app.logger.propagate = False
     gunicorn_logger = logging.getLogger(logger_name)
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+    handlers = list(gunicorn_logger.handlers)
     # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
+    if app.config.get("LOG_FORMAT") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+    for handler in handlers:
         handler.setFormatter(formatter)
+    if handlers and app.config.get("LOG_QUEUE"):
+        handlers = [start_queue(handlers, app.config.get("LOG_QUEUE_SIZE", 10000))]
+    for logger in [app.logger] + [logging.getLogger(name) for name in SERVICE_LOGGERS]:
+        logger.propagate = False
+        logger.handlers = handlers
+        logger.setLevel(gunicorn_logger.level)
+        for old in [old for old in logger.filters if isinstance(old, TraceContextFilter)]:
+            logger.removeFilter(old)
+        logger.addFilter(TraceContextFilter())
+    init_sampling(app.config.get("LOG_SAMPLING", {}), app.config.get("LOG_RATE_LIMITS", {}))
     app.logger.info("Logging handler established")
@@ -0,0 +1,270 @@
+"""
+Memory Profiling
+
+The pods run with a 64Mi memory limit (k8s/deployment.yaml), so a request
+that builds a big enough result can get its worker OOM-killed. With
+MEMORY_PROFILING on, tracemalloc follows every allocation and each request
+writes one JSON line to the rotating MEMORY_PROFILE_LOG file with:
+
+* the peak of memory it allocated on top of what was held when it started,
+  and the worker's resident size at that point,
+* the peak of each model operation it called (the @traced methods),
+* the size of its result: the entries of a JSON list, or the items of an
+  order, and the bytes of the response,
+* the MEMORY_PROFILE_SITES source lines that still held the most new memory
+  once the response was ready.
+
+``flask memory-report`` groups the log by route, fits peak memory against
+result size and works out the largest result that still fits under
+MEMORY_LIMIT_MB, which is the safe maximum page size of list endpoints.
+
+tracemalloc makes every allocation several times slower and takes memory
+of its own, so this is for load tests and staging, not for production
+traffic. The peaks of concurrent requests in the same process add up, so
+measure with one thread per worker, e.g. the default sync workers.
+"""
+import os
+import json
+import time
+import logging
+import tracemalloc
+import contextlib
+import statistics
+from collections import defaultdict, Counter
+from logging.handlers import RotatingFileHandler
+from flask import g, request, has_request_context
+from service.common import tracing
+from service.common.profiling import relative_path
+
+logger = logging.getLogger("flask.app")
+
+# The memory profile records only, kept out of the application log
+memory_logger = logging.getLogger("memory_profile")
+memory_logger.propagate = False
+
+MIB = 1024 * 1024
+# allocations by the profiler and the import machinery are not the request's
+IGNORED = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+
+class MemoryScope:
+    """The memory held when a request or operation started, and its peak since"""
+
+    __slots__ = ("name", "start", "peak")
+
+    def __init__(self, name: str, start: int):
+        self.name = name
+        self.start = start
+        self.peak = start
+
+
+class RequestMemory:
+    """The allocations of one request and of the operations it calls
+
+    tracemalloc keeps a single peak for the process, so it is reset when an
+    operation starts and ends, and every scope keeps the highest peak seen
+    while it was open.
+    """
+
+    def __init__(self, sites: int):
+        self.sites = sites
+        self.scopes = []
+        self.operations = {}
+        self.snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED) if sites else None
+        self.resident = resident_bytes()
+        self.root = self.enter("request")
+
+    def enter(self, name: str) -> MemoryScope:
+        """Opens a scope, returns it for exit()"""
+        current, peak = tracemalloc.get_traced_memory()
+        if self.scopes:
+            self.scopes[-1].peak = max(self.scopes[-1].peak, peak)
+        tracemalloc.reset_peak()
+        scope = MemoryScope(name, current)
+        self.scopes.append(scope)
+        return scope
+
+    def exit(self, scope: MemoryScope) -> int:
+        """Closes a scope, returns the most it allocated at once in bytes"""
+        _, peak = tracemalloc.get_traced_memory()
+        scope.peak = max(scope.peak, peak)
+        self.scopes.remove(scope)
+        if self.scopes:
+            self.scopes[-1].peak = max(self.scopes[-1].peak, scope.peak)
+        tracemalloc.reset_peak()
+        return scope.peak - scope.start
+
+    def top_sites(self) -> list:
+        """The source lines holding the most memory allocated since the request started"""
+        if self.snapshot is None:
+            return []
+        now = tracemalloc.take_snapshot().filter_traces(IGNORED)
+        growth = [stat for stat in now.compare_to(self.snapshot, "lineno") if stat.size_diff > 0]
+        return [
+            {
+                "site": f"{relative_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                "bytes": stat.size_diff,
+                "blocks": stat.count_diff,
+            }
+            for stat in growth[: self.sites]
+        ]
+
+
+def resident_bytes():
+    """The resident size of this process less tracemalloc's own, None off Linux"""
+    try:
+        with open("/proc/self/statm", encoding="ascii") as statm:
+            pages = int(statm.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") - tracemalloc.get_tracemalloc_memory()
+
+
+def result_size(response):
+    """Entries of a JSON list, items of a JSON order, 1 for anything else JSON"""
+    if response.is_streamed or not response.is_json:
+        return None
+    payload = response.get_json(silent=True)
+    if isinstance(payload, list):
+        return len(payload)
+    if isinstance(payload, dict) and isinstance(payload.get("items"), list):
+        return len(payload["items"])
+    return None if payload is None else 1
+
+
+######################################################################
+# Request hooks
+######################################################################
+@contextlib.contextmanager
+def measure_operation(name: str):
+    """Records the peak allocation of a model operation in the current request"""
+    memory = g.get("memory") if has_request_context() else None
+    if memory is None or memory.scopes[-1].name == name:
+        yield
+        return
+    scope = memory.enter(name)
+    try:
+        yield
+    finally:
+        peak = memory.exit(scope)
+        memory.operations[name] = max(memory.operations.get(name, 0), peak)
+
+
+def start_measuring(app):
+    """Starts following the allocations of the current request"""
+    g.memory = RequestMemory(app.config["MEMORY_PROFILE_SITES"])
+
+
+def record_request(response):
+    """Writes the memory profile of the request to the log"""
+    memory = g.pop("memory", None)
+    if memory is None:
+        return response
+    peak = memory.exit(memory.root)
+    record = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "route": f"{request.method} {request.url_rule.rule if request.url_rule else request.path}",
+        "status": response.status_code,
+        "peak_bytes": peak,
+        "resident_bytes": memory.resident,
+        "results": result_size(response),
+        "response_bytes": None if response.is_streamed else response.content_length,
+        "operations": memory.operations,
+        "sites": memory.top_sites(),
+    }
+    memory_logger.warning(json.dumps(record))
+    return response
+
+
+######################################################################
+# Summaries
+######################################################################
+def fit(sizes: list, peaks: list):
+    """Least squares peak = intercept + slope * size, with r squared, or None"""
+    if len(set(sizes)) < 2:
+        return None
+    slope, intercept = statistics.linear_regression(sizes, peaks)
+    r_squared = statistics.correlation(sizes, peaks) ** 2 if len(set(peaks)) > 1 else 1.0
+    return {"intercept": intercept, "slope": slope, "r_squared": r_squared}
+
+
+def safe_results(curve, resident, limit_bytes: int):
+    """The largest result the curve says fits in the memory left, None without a curve"""
+    if curve is None or curve["slope"] <= 0:
+        return None
+    return max(int((limit_bytes - (resident or 0) - curve["intercept"]) / curve["slope"]), 0)
+
+
+def summarize(records: list, limit_bytes: int, sites: int = 5) -> list:
+    """Groups records by route, the biggest peak first"""
+    routes = defaultdict(list)
+    for record in records:
+        routes[record["route"]].append(record)
+    summary = []
+    for route, group in routes.items():
+        peaks = [record["peak_bytes"] for record in group]
+        sized = [record for record in group if record.get("results") is not None]
+        residents = [record["resident_bytes"] for record in group if record.get("resident_bytes")]
+        resident = statistics.median(residents) if residents else None
+        curve = fit([record["results"] for record in sized], [record["peak_bytes"] for record in sized])
+        operations = defaultdict(list)
+        site_bytes = Counter()
+        for record in group:
+            for name, peak in record["operations"].items():
+                operations[name].append(peak)
+            for site in record["sites"]:
+                site_bytes[site["site"]] += site["bytes"]
+        summary.append(
+            {
+                "route": route,
+                "count": len(group),
+                "results": (min(r["results"] for r in sized), max(r["results"] for r in sized)) if sized else None,
+                "mean_peak": statistics.fmean(peaks),
+                "max_peak": max(peaks),
+                "resident": resident,
+                "curve": curve,
+                "safe_results": safe_results(curve, resident, limit_bytes),
+                "operations": {name: max(values) for name, values in sorted(operations.items())},
+                "sites": site_bytes.most_common(sites),
+            }
+        )
+    summary.sort(key=lambda entry: entry["max_peak"], reverse=True)
+    return summary
+
+
+######################################################################
+# Set up
+######################################################################
+def open_log(path: str, max_bytes: int, backups: int):
+    """Writes the memory profile records to a file rotated at max_bytes"""
+    for handler in list(memory_logger.handlers):
+        memory_logger.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    memory_logger.addHandler(handler)
+    memory_logger.setLevel(logging.WARNING)
+
+
+def init_memory_profiling(app):
+    """Profiles the memory of every request when MEMORY_PROFILING is on"""
+    if not app.config["MEMORY_PROFILING"]:
+        return
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    open_log(app.config["MEMORY_PROFILE_LOG"], app.config["MEMORY_PROFILE_LOG_BYTES"],
+             app.config["MEMORY_PROFILE_LOG_BACKUPS"])
+    app.before_request(lambda: start_measuring(app))
+    app.after_request(record_request)
+    if measure_operation not in tracing.operation_hooks:
+        tracing.operation_hooks.append(measure_operation)
+    logger.info("Profiling the memory of every request into %s", app.config["MEMORY_PROFILE_LOG"])
+
+
+def describe(size: float) -> str:
+    """A byte count in KiB or MiB"""
+    return f"{size / MIB:.1f} MiB" if abs(size) >= MIB else f"{size / 1024:.1f} KiB"
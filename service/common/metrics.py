@@ -0,0 +1,135 @@
+"""
+Prometheus Metrics
+
+Request counts and latency by route, method and status, database statement
+counts and durations, SQLAlchemy statement cache hits and the state of the
+connection pools, served by /metrics in the Prometheus text format.
+
+Every gunicorn worker is a process with counters of its own. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py does) the workers keep
+their values in files in that directory, and whichever worker answers the
+scrape adds up the files of all of them.
+"""
+import os
+import time
+from flask import g, request
+from sqlalchemy.engine import default
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from service.common import db_pool, sql_timing
+
+# Statements are labeled by their verb; anything else (DDL, SET, ...) is OTHER
+OPERATIONS = frozenset(("SELECT", "INSERT", "UPDATE", "DELETE"))
+CACHE_RESULTS = {default.CACHE_HIT: "hit", default.CACHE_MISS: "miss"}
+
+REQUESTS = Counter("http_requests_total", "HTTP requests answered", ["method", "route", "status"])
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time taken to answer HTTP requests",
+    ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+QUERY_LATENCY = Histogram(
+    "db_query_duration_seconds",
+    "Time taken to run database statements",
+    ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+)
+STATEMENT_CACHE = Counter(
+    "db_statement_cache_total", "SQLAlchemy compiled statement cache lookups", ["result"]
+)
+POOL_WAIT = Histogram(
+    "db_pool_checkout_wait_seconds",
+    "Time spent waiting for a pooled database connection",
+    ["pool"],
+    buckets=tuple(bound / 1000 for bound in db_pool.WAIT_BUCKETS_MS),
+)
+POOL_TIMEOUTS = Counter("db_pool_checkout_timeouts_total", "Checkouts that timed out", ["pool"])
+POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out", "Pooled connections in use", ["pool"], multiprocess_mode="livesum"
+)
+POOL_CHECKED_IN = Gauge(
+    "db_pool_checked_in", "Idle pooled connections", ["pool"], multiprocess_mode="livesum"
+)
+POOL_OVERFLOW = Gauge(
+    "db_pool_overflow", "Connections opened beyond the pool size", ["pool"], multiprocess_mode="livesum"
+)
+
+
+######################################################################
+# HTTP requests
+######################################################################
+def start_timer():
+    """Notes when the request started"""
+    g.metrics_start = time.perf_counter()
+
+
+def record_request(response):
+    """Counts the request and observes how long it took"""
+    # the rule, not the path, so that ids do not become labels
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    REQUESTS.labels(request.method, route, response.status_code).inc()
+    started = g.get("metrics_start")
+    if started is not None:
+        REQUEST_LATENCY.labels(request.method, route).observe(time.perf_counter() - started)
+    return response
+
+
+######################################################################
+# Database statements and pools
+######################################################################
+def observe_statement(statement, _cursor):
+    """Observes the duration of a statement and whether its SQL came from the cache"""
+    verb = statement.text.lstrip().split(None, 1)[0].upper() if statement.text.strip() else ""
+    QUERY_LATENCY.labels(verb if verb in OPERATIONS else "OTHER").observe(statement.seconds)
+    context = statement.context
+    if context is not None and context.compiled is not None:
+        STATEMENT_CACHE.labels(CACHE_RESULTS.get(context.cache_hit, "uncached")).inc()
+
+
+def update_pool_gauges(pool):
+    """Sets the gauges of a pool to its current state"""
+    name = pool.logging_name or "default"
+    POOL_CHECKED_OUT.labels(name).set(pool.checkedout())
+    POOL_CHECKED_IN.labels(name).set(pool.checkedin())
+    POOL_OVERFLOW.labels(name).set(max(0, pool.overflow()))
+
+
+def observe_checkout(pool, wait_ms: float, timed_out: bool):
+    """Records a checkout attempt reported by an instrumented pool"""
+    POOL_WAIT.labels(pool.logging_name or "default").observe(wait_ms / 1000)
+    if timed_out:
+        POOL_TIMEOUTS.labels(pool.logging_name or "default").inc()
+    update_pool_gauges(pool)
+
+
+######################################################################
+# Exposition
+######################################################################
+def render() -> tuple:
+    """Returns the metrics of every worker in the text format, and its content type"""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def init_metrics(app):
+    """Times every request and starts listening to the database"""
+    app.before_request(start_timer)
+    app.after_request(record_request)
+    sql_timing.listen(finished=observe_statement)
+    if observe_checkout not in db_pool.CHECKOUT_LISTENERS:
+        db_pool.CHECKOUT_LISTENERS.append(observe_checkout)
+    if update_pool_gauges not in db_pool.CHECKIN_LISTENERS:
+        db_pool.CHECKIN_LISTENERS.append(update_pool_gauges)
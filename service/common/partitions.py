@@ -0,0 +1,166 @@
+"""
+Monthly Partitions
+
+Optional PostgreSQL range partitioning of the order and item tables by
+month of the order's creation_time (ORDER_PARTITIONING). Items carry a copy
+of their order's creation_time in order_creation_time so they land in the
+matching month, which lets date filtered queries prune both tables and an
+old month be detached or dropped as a whole instead of deleted row by row.
+
+The partitioned tables are created here instead of by db.create_all(),
+which cannot put the partition key into the primary and foreign keys; the
+columns must be kept in step with service.models.
+"""
+import re
+import logging
+from datetime import date
+from sqlalchemy import text
+
+logger = logging.getLogger("flask.app")
+
+TABLES = ("order", "item")
+PARTITION_NAME = re.compile(r"^(order|item)_p(\d{4})_(\d{2})$")
+
+PARTITIONED_TABLES_DDL = (
+    """
+    CREATE TABLE IF NOT EXISTS "order" (
+        id SERIAL,
+        customer_id INTEGER,
+        creation_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        last_updated_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        total_price FLOAT,
+        status VARCHAR(32),
+        PRIMARY KEY (id, creation_time)
+    ) PARTITION BY RANGE (creation_time)
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS item (
+        id SERIAL,
+        order_id INTEGER NOT NULL,
+        name VARCHAR(64),
+        price FLOAT,
+        description VARCHAR(128),
+        quantity INTEGER,
+        order_creation_time TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+        PRIMARY KEY (id, order_creation_time),
+        CONSTRAINT item_order_fk FOREIGN KEY (order_id, order_creation_time)
+            REFERENCES "order" (id, creation_time) ON DELETE CASCADE
+    ) PARTITION BY RANGE (order_creation_time)
+    """,
+    'CREATE INDEX IF NOT EXISTS order_customer_id_idx ON "order" (customer_id)',
+    "CREATE INDEX IF NOT EXISTS item_order_id_idx ON item (order_id)",
+    # rows outside every monthly partition land here instead of failing
+    'CREATE TABLE IF NOT EXISTS order_default PARTITION OF "order" DEFAULT',
+    "CREATE TABLE IF NOT EXISTS item_default PARTITION OF item DEFAULT",
+)
+
+
+def month_start(day: date) -> date:
+    """Returns the first day of the month of a date"""
+    return day.replace(day=1)
+
+
+def add_months(month: date, count: int) -> date:
+    """Returns the first day of the month `count` months later"""
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table: str, month: date) -> str:
+    """Names the partition of a table for a month, e.g. order_p2024_01"""
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+def partition_ddl(month: date) -> list:
+    """Returns the statements that create both partitions for a month"""
+    start, end = month_start(month), add_months(month, 1)
+    return [
+        f'CREATE TABLE IF NOT EXISTS {partition_name(table, start)} PARTITION OF "{table}" '
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        for table in TABLES
+    ]
+
+
+def is_partitioned(connection) -> bool:
+    """True when the order table is partitioned in this database"""
+    if connection.dialect.name != "postgresql":
+        return False
+    return bool(
+        connection.execute(
+            text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('\"order\"')")
+        ).scalar()
+    )
+
+
+def list_partitions(connection) -> list:
+    """Returns (month, table names) for every monthly partition, oldest first"""
+    names = connection.execute(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent IN (to_regclass('\"order\"'), to_regclass('item'))"
+        )
+    ).scalars()
+    months = {}
+    for name in names:
+        match = PARTITION_NAME.match(name)
+        if match:
+            month = date(int(match.group(2)), int(match.group(3)), 1)
+            months.setdefault(month, []).append(name)
+    return sorted(months.items())
+
+
+def create_partitions(connection, start: date, months: int) -> list:
+    """Creates the partitions for `months` months from `start`, returns the months"""
+    created = []
+    for count in range(months):
+        month = add_months(month_start(start), count)
+        for statement in partition_ddl(month):
+            connection.execute(text(statement))
+        created.append(month)
+    return created
+
+
+def detach_partitions(connection, before: date, drop: bool = False) -> list:
+    """Detaches (and optionally drops) the partitions of months before `before`
+
+    Items go first since they reference their orders. A detached item table
+    loses its foreign key so the order table can be detached after it; both
+    stay around as plain tables for archiving unless dropped.
+    """
+    detached = []
+    for month, _names in list_partitions(connection):
+        if month >= month_start(before):
+            continue
+        item, order = partition_name("item", month), partition_name("order", month)
+        connection.execute(text(f"ALTER TABLE item DETACH PARTITION {item}"))
+        if drop:
+            connection.execute(text(f"DROP TABLE {item}"))
+        else:
+            connection.execute(text(f"ALTER TABLE {item} DROP CONSTRAINT IF EXISTS item_order_fk"))
+        connection.execute(text(f'ALTER TABLE "order" DETACH PARTITION {order}'))
+        if drop:
+            connection.execute(text(f"DROP TABLE {order}"))
+        detached.append(month)
+        logger.info("%s partitions for %s", "Dropped" if drop else "Detached", month.strftime("%Y-%m"))
+    return detached
+
+
+def init_partitions(connection, months_ahead: int = 3) -> bool:
+    """Creates the partitioned tables plus partitions up to `months_ahead` months out
+
+    Runs in the caller's transaction. Returns False (and leaves the tables
+    to db.create_all()) when the database cannot be partitioned or already
+    holds plain tables.
+    """
+    if connection.dialect.name != "postgresql":
+        logger.warning("Order partitioning needs PostgreSQL, not %s", connection.dialect.name)
+        return False
+    exists = connection.execute(text("SELECT to_regclass('\"order\"') IS NOT NULL")).scalar()
+    if exists and not is_partitioned(connection):
+        logger.warning("The order table exists and is not partitioned, leaving it as it is")
+        return False
+    for statement in PARTITIONED_TABLES_DDL:
+        connection.execute(text(statement))
+    create_partitions(connection, date.today(), months_ahead + 1)
+    return True
@@ -0,0 +1,186 @@
+"""
+On-demand Request Profiling
+
+With PROFILING on, a request is profiled when it carries an ``X-Profile``
+header matching PROFILE_TOKEN, or at random for a PROFILE_SAMPLE_RATE
+share of the traffic. The whole WSGI call is covered: routing, the view,
+SQLAlchemy, restx marshalling, JSON encoding and the response body.
+
+Two profilers are available with PROFILE_MODE:
+
+    sample  looks at the request's stack every PROFILE_INTERVAL_MS from a
+            thread of its own, cheap enough for production traffic; the
+            weights are sample counts. Needs sync or gthread workers.
+    trace   records every Python and builtin call with sys.setprofile,
+            exact but several times slower; the weights are microseconds.
+
+Either way the profile is written to PROFILE_DIR in the collapsed stack
+format (``outer;inner;innermost weight`` per line) that flamegraph.pl and
+speedscope read, and its name is returned in the ``X-Profile-File``
+header. With PROFILING off nothing is installed and requests pay nothing.
+"""
+import os
+import re
+import sys
+import hmac
+import time
+import random
+import logging
+import threading
+from collections import Counter
+from werkzeug.wsgi import ClosingIterator
+
+logger = logging.getLogger("flask.app")
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_FILE_HEADER = "X-Profile-File"
+
+UNSAFE = re.compile(r"[^A-Za-z0-9]+")
+
+
+def relative_path(filename: str) -> str:
+    """A source file's path relative to the sys.path entry it was imported from"""
+    for folder in sorted(sys.path, key=len, reverse=True):
+        if folder and filename.startswith(folder + os.sep):
+            return filename[len(folder) + 1:]
+    return filename
+
+
+def _label(code) -> str:
+    """Names a frame as ``function (file:line)``, paths relative to sys.path"""
+    return f"{code.co_name} ({relative_path(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    """Counts the stacks a thread is seen in at a fixed interval"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.stacks = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+
+    def start(self):
+        """Starts sampling the calling thread"""
+        self._thread.start()
+
+    def stop(self):
+        """Stops sampling"""
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                stack.append(_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[tuple(reversed(stack))] += 1
+
+
+class CallTracer:
+    """Adds up the microseconds spent in every call stack of a thread"""
+
+    def __init__(self):
+        self.stacks = Counter()
+        self._stack = []
+        self._last = 0.0
+
+    def start(self):
+        """Starts tracing the calling thread"""
+        self._last = time.perf_counter()
+        sys.setprofile(self._event)
+
+    def stop(self):
+        """Stops tracing"""
+        sys.setprofile(None)
+        self.stacks = Counter({stack: round(seconds * 1e6) for stack, seconds in self.stacks.items()})
+
+    # runs as the profile hook, where coverage's tracer cannot see it
+    def _event(self, frame, event, arg):  # pragma: no cover
+        now = time.perf_counter()
+        if self._stack:
+            self.stacks[tuple(self._stack)] += now - self._last
+        if event == "call":
+            self._stack.append(_label(frame.f_code))
+        elif event == "c_call":
+            self._stack.append(f"{getattr(arg, '__qualname__', arg)} (builtin)")
+        elif self._stack:  # return, c_return, c_exception
+            self._stack.pop()
+        self._last = time.perf_counter()
+
+
+def write_collapsed(stacks: Counter, path: str):
+    """Writes stacks in the collapsed format flame graph tools read"""
+    with open(path, "w", encoding="utf-8") as output:
+        for stack, weight in stacks.most_common():
+            if weight > 0:
+                output.write(f"{';'.join(stack)} {weight}\n")
+
+
+class ProfilingMiddleware:
+    """WSGI middleware that profiles the requests that ask for it or are sampled"""
+
+    def __init__(self, wsgi_app, directory: str, token: str = "", rate: float = 0.0, mode: str = "sample",
+                 interval_ms: float = 1.0):
+        if mode not in ("sample", "trace"):
+            raise ValueError(f"PROFILE_MODE must be sample or trace, not {mode}")
+        self.wsgi_app = wsgi_app
+        self.directory = directory
+        self.token = token
+        self.rate = rate
+        self.mode = mode
+        self.interval = interval_ms / 1000
+
+    def wanted(self, environ) -> bool:
+        """Whether a request should be profiled"""
+        offered = environ.get("HTTP_" + PROFILE_HEADER.upper().replace("-", "_"))
+        if offered is not None and self.token:
+            return hmac.compare_digest(offered.encode(), self.token.encode())
+        return self.rate > 0 and random.random() < self.rate
+
+    def __call__(self, environ, start_response):
+        if not self.wanted(environ):
+            return self.wsgi_app(environ, start_response)
+
+        os.makedirs(self.directory, exist_ok=True)
+        method = environ.get("REQUEST_METHOD", "GET")
+        path = UNSAFE.sub("_", environ.get("PATH_INFO", "")).strip("_")[:60] or "root"
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}-{method}-{path}-{os.getpid()}-{time.perf_counter_ns() % 1000000}.collapsed"
+
+        def start_profiled_response(status, headers, exc_info=None):
+            return start_response(status, headers + [(PROFILE_FILE_HEADER, name)], exc_info)
+
+        profiler = StackSampler(self.interval) if self.mode == "sample" else CallTracer()
+        profiler.start()
+
+        def finish():
+            profiler.stop()
+            write_collapsed(profiler.stacks, os.path.join(self.directory, name))
+            logger.info("Profiled %s %s into %s", method, environ.get("PATH_INFO"), name)
+
+        try:
+            app_iter = self.wsgi_app(environ, start_profiled_response)
+        except BaseException:
+            finish()
+            raise
+        # the body may still be produced while it is sent, so stop when it is closed
+        return ClosingIterator(app_iter, [finish])
+
+
+def init_profiling(app):
+    """Wraps the app in the profiling middleware when PROFILING is on"""
+    if not app.config["PROFILING"]:
+        return
+    app.wsgi_app = ProfilingMiddleware(
+        app.wsgi_app,
+        app.config["PROFILE_DIR"],
+        token=app.config["PROFILE_TOKEN"],
+        rate=app.config["PROFILE_SAMPLE_RATE"],
+        mode=app.config["PROFILE_MODE"],
+        interval_ms=app.config["PROFILE_INTERVAL_MS"],
+    )
+    logger.info("Profiling requests in %s mode into %s", app.config["PROFILE_MODE"], app.config["PROFILE_DIR"])
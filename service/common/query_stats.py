@@ -0,0 +1,101 @@
+"""
+Per-request Query Accounting
+
+Counts the SQL statements every request runs and the time spent in them,
+and reports both to the client in a ``Server-Timing`` header:
+
+    Server-Timing: db;dur=3.1;desc="4 queries", app;dur=9.8
+
+Two patterns are flagged: more statements than the endpoint may run
+(QUERY_BUDGET, or its own entry in QUERY_BUDGETS), and one statement run
+QUERY_REPEAT_LIMIT times or more with different parameters, the mark of an
+N+1 lazy load. They are logged as warnings, or with QUERY_STRICT raised as
+QueryBudgetExceeded, which the test suites use to catch fan-outs early.
+"""
+import re
+import time
+import logging
+from collections import Counter
+from flask import g, request, has_request_context
+from service.common import sql_timing
+
+logger = logging.getLogger("flask.app")
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(Exception):
+    """Used when a request runs too many statements in strict mode"""
+
+
+class RequestQueries:
+    """The statements run by one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def record(self, statement: str, duration: float):
+        """Adds a statement; its text is its shape since the values are bound"""
+        self.count += 1
+        self.duration += duration
+        self.shapes[WHITESPACE.sub(" ", statement).strip()] += 1
+
+    def server_timing(self) -> str:
+        """Returns the Server-Timing header value for the request so far"""
+        elapsed = time.perf_counter() - self.started
+        return f'db;dur={self.duration * 1000:.1f};desc="{self.count} queries", app;dur={elapsed * 1000:.1f}'
+
+    def problems(self, budget: int, repeat_limit: int) -> list:
+        """Describes how the request went over its budget or repeated itself"""
+        problems = []
+        if budget and self.count > budget:
+            problems.append(f"{self.count} queries, over its budget of {budget}")
+        for statement, times in self.shapes.most_common():
+            if not repeat_limit or times < repeat_limit:
+                break
+            problems.append(f"{times} times: {statement[:200]}")
+        return problems
+
+
+######################################################################
+# Engine events
+######################################################################
+def count_statement(statement, _cursor):
+    """Adds a statement to the accounting of the current request"""
+    queries = g.get("queries") if has_request_context() else None
+    if queries is not None:
+        queries.record(statement.text, statement.seconds)
+
+
+######################################################################
+# Request hooks
+######################################################################
+def start_accounting():
+    """Starts counting the statements of the current request"""
+    g.queries = RequestQueries()
+
+
+def check_queries(app, response):
+    """Adds the Server-Timing header and flags budget breaches and repeats"""
+    queries = g.get("queries")
+    if queries is None:
+        return response
+    response.headers.add("Server-Timing", queries.server_timing())
+    budget = app.config["QUERY_BUDGETS"].get(request.endpoint, app.config["QUERY_BUDGET"])
+    problems = queries.problems(budget, app.config["QUERY_REPEAT_LIMIT"])
+    if problems:
+        message = f"{request.method} {request.path} ran " + "; ".join(problems)
+        if app.config["QUERY_STRICT"]:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+    return response
+
+
+def init_query_stats(app):
+    """Counts the statements of every request"""
+    app.before_request(start_accounting)
+    app.after_request(lambda response: check_queries(app, response))
+    sql_timing.listen(finished=count_statement)
@@ -0,0 +1,232 @@
+"""
+Rate Limiting
+
+Each caller gets a token bucket per endpoint: it holds up to `capacity`
+requests and refills at `rate` requests a second, so a caller can burst
+up to the capacity and then keep to the rate. RATE_LIMITS sets them as
+``endpoint=capacity:rate`` entries, with ``*`` for every endpoint not
+listed and a rate of 0 for no limit on one:
+
+    RATE_LIMITS="*=60:10,orders_collection=20:2,export_resource=2:0.05"
+
+Every request takes a token from the bucket of its ``ip`` and, when it
+has one, from the bucket of the first other of RATE_LIMIT_KEYS it has:
+``api_key`` (the X-Api-Key header, only when it is one of the
+RATE_LIMIT_API_KEYS, stored hashed) or ``customer_id`` (from the query
+string or the JSON body). The client picks those keys, so a new one for
+every request would be a new bucket every time; the ip bucket holds it
+to the limit anyway. The check runs before any other work of the
+request, and a caller over either limit gets 429_TOO_MANY_REQUESTS with
+a Retry-After header, without touching the database.
+
+Behind an ingress or load balancer every request comes from the proxy's
+address, which would put all callers in one bucket. With
+RATE_LIMIT_TRUSTED_PROXIES set to the number of proxies in front of the
+service, werkzeug's ProxyFix takes the ``ip`` from that many entries of
+X-Forwarded-For instead. Leave it at 0 when clients reach the service
+directly, since they could then write the header themselves.
+
+RATE_LIMIT_BACKEND picks where the buckets live:
+
+    memory  in the worker, so every gunicorn worker allows the full rate
+    redis   shared by every worker and pod through RATE_LIMIT_REDIS_URL,
+            needs the redis package
+    module:factory
+            any callable taking the app and returning an object with a
+            ``take(key, capacity, rate)`` method, like TokenBuckets
+
+A shared backend that fails lets the request through rather than failing
+it. The health, metrics and pool endpoints are never limited by ``*``.
+"""
+import math
+import time
+import hashlib
+import logging
+import importlib
+import threading
+from flask import request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+logger = logging.getLogger("flask.app")
+
+API_KEY_HEADER = "X-Api-Key"
+CALLER_KEYS = ("api_key", "customer_id", "ip")
+# probes and scrapes are limited only when listed by name
+EXEMPT_ENDPOINTS = ("service.health", "service.metrics", "service.pool_stats", "static", "restx_doc.static")
+
+
+class RateLimited(Exception):
+    """Used when a caller has used up its requests for now"""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBuckets:
+    """Token buckets kept in the process
+
+    Buckets that have filled up again are the same as new ones, so they are
+    dropped once more than `max_keys` callers are being tracked.
+    """
+
+    def __init__(self, max_keys: int = 10000):
+        self.max_keys = max_keys
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        """Takes a token, returns 0 or the seconds until one is available"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _ = self._buckets.get(key, (capacity, now, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now, now + (capacity - tokens) / rate)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+        return wait
+
+    def _prune(self, now: float):
+        full = [key for key, (_, _, full_at) in self._buckets.items() if full_at <= now]
+        for key in full or list(self._buckets)[: len(self._buckets) // 2]:
+            del self._buckets[key]
+
+
+# Refills, takes and expires a bucket in one round trip; the time comes from
+# the caller, the result is a string since Redis turns Lua numbers into integers
+REDIS_TAKE = """
+local capacity, rate, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RedisTokenBuckets:
+    """Token buckets shared through Redis"""
+
+    def __init__(self, client, prefix: str = "rate:"):
+        self.prefix = prefix
+        self._take = client.register_script(REDIS_TAKE)
+
+    def take(self, key: str, capacity: float, rate: float) -> float:
+        """Takes a token, returns 0 or the seconds until one is available"""
+        return float(self._take(keys=[self.prefix + key], args=[capacity, rate, time.time()]))
+
+
+def redis_buckets(app):
+    """Connects to RATE_LIMIT_REDIS_URL"""
+    import redis  # pylint: disable=import-outside-toplevel, import-error
+
+    client = redis.Redis.from_url(app.config["RATE_LIMIT_REDIS_URL"], socket_timeout=0.05)
+    return RedisTokenBuckets(client)
+
+
+BACKENDS = {"memory": lambda _app: TokenBuckets(), "redis": redis_buckets}
+
+
+def load_backend(app):
+    """Builds the backend RATE_LIMIT_BACKEND names"""
+    name = app.config["RATE_LIMIT_BACKEND"]
+    if name in BACKENDS:
+        return BACKENDS[name](app)
+    module, _, factory = name.partition(":")
+    if not factory:
+        raise ValueError(f"RATE_LIMIT_BACKEND must be memory, redis or module:factory, not {name}")
+    return getattr(importlib.import_module(module), factory)(app)
+
+
+class RateLimiter:
+    """Checks every request against the bucket of its caller and endpoint"""
+
+    def __init__(self, backend, limits: dict, keys, api_keys=()):
+        self.backend = backend
+        self.limits = limits
+        self.keys = keys
+        self.api_keys = frozenset(_digest(key) for key in api_keys)
+
+    def limit(self, endpoint: str):
+        """The (capacity, rate) of an endpoint, None when it is not limited"""
+        if endpoint in self.limits:
+            capacity, rate = self.limits[endpoint]
+        elif endpoint in EXEMPT_ENDPOINTS or "*" not in self.limits:
+            return None
+        else:
+            capacity, rate = self.limits["*"]
+        return (max(capacity, 1), rate) if rate > 0 else None
+
+    def check(self):
+        """Raises RateLimited when the caller of the current request is over its limit"""
+        limit = self.limit(request.endpoint)
+        callers = caller_keys(self.keys, self.api_keys) if limit else []
+        if not callers:
+            return
+        try:
+            wait = max(self.backend.take(f"{request.endpoint}|{caller}", *limit) for caller in callers)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Rate limit not checked, the backend failed: %s", error)
+            return
+        if wait > 0:
+            logger.info("Rate limited %s on %s for %.1fs", " and ".join(callers), request.endpoint, wait)
+            raise RateLimited(f"Too many requests, try again in {math.ceil(wait)}s", wait)
+
+
+def _digest(api_key: str) -> str:
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def caller_keys(keys, api_keys=frozenset()) -> list:
+    """Names the buckets of the current request's caller
+
+    The first of `keys` other than ip that the request has, with api_key
+    only when its digest is in `api_keys`, and then always the ip, which
+    the client cannot pick.
+    """
+    callers = []
+    for kind in keys:
+        value = None
+        if kind == "api_key":
+            value = request.headers.get(API_KEY_HEADER)
+            value = _digest(value) if value else None
+            value = value[:32] if value in api_keys else None
+        elif kind == "customer_id":
+            value = request.args.get("customer_id")
+            if value is None and request.is_json:
+                body = request.get_json(silent=True)
+                value = body.get("customer_id") if isinstance(body, dict) else None
+        if value is not None and value != "":
+            callers.append(f"{kind}:{value}")
+            break
+    if request.remote_addr:
+        callers.append(f"ip:{request.remote_addr}")
+    return callers
+
+
+def init_rate_limits(app):
+    """Checks every request against its caller's limit when RATE_LIMITS is set"""
+    if not app.config["RATE_LIMITS"]:
+        return
+    unknown = set(app.config["RATE_LIMIT_KEYS"]) - set(CALLER_KEYS)
+    if unknown:
+        raise ValueError(f"RATE_LIMIT_KEYS may hold {', '.join(CALLER_KEYS)}, not {', '.join(sorted(unknown))}")
+    limiter = RateLimiter(
+        load_backend(app), app.config["RATE_LIMITS"], app.config["RATE_LIMIT_KEYS"], app.config["RATE_LIMIT_API_KEYS"]
+    )
+    app.extensions["rate_limiter"] = limiter
+    proxies = app.config["RATE_LIMIT_TRUSTED_PROXIES"]
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies)
+    app.before_request(limiter.check)
+    logger.info("Rate limiting %s by %s and ip in %s", app.config["RATE_LIMITS"], ", ".join(limiter.keys),
+                app.config["RATE_LIMIT_BACKEND"])
@@ -0,0 +1,127 @@
+"""
+Read Replicas
+
+Routes the database reads of safe (GET/HEAD/OPTIONS) requests to one of the
+configured read replicas, while writes stay on the primary. A client that
+has just written keeps reading from the primary for READ_YOUR_WRITES_SECONDS
+so that it always sees its own changes; the time of its last write travels
+in the ``last_write`` cookie or, for clients without cookies, in an echoed
+``X-Last-Write`` header.
+"""
+import time
+import logging
+import itertools
+from flask import g, request, has_request_context
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from service.common import db_pool
+
+logger = logging.getLogger("flask.app")
+
+SAFE_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+LAST_WRITE_COOKIE = "last_write"
+LAST_WRITE_HEADER = "X-Last-Write"
+
+
+class ReplicaSet:
+    """The replica engines and the policy for picking one"""
+
+    def __init__(self, engines: list, balancing: str = "round_robin"):
+        if balancing not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown replica balancing: {balancing}")
+        self.engines = engines
+        self.balancing = balancing
+        self._counter = itertools.count()
+
+    def choose(self):
+        """Returns the engine the next read should use"""
+        if not self.engines:
+            return None
+        if self.balancing == "least_connections":
+            return min(self.engines, key=_checked_out)
+        return self.engines[next(self._counter) % len(self.engines)]
+
+    def dispose(self, close: bool = True):
+        """Closes every replica connection, or just forgets them with close=False"""
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+
+def _checked_out(engine) -> int:
+    checkedout = getattr(engine.pool, "checkedout", None)
+    return checkedout() if checkedout else 0
+
+
+class RoutingSession(Session):
+    """A Session that sends the reads of safe requests to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        """Uses the request's replica unless flushing or explicitly bound"""
+        if bind is None and not self._flushing and has_request_context():
+            replica = g.get("read_replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_engine(primary):
+    """Returns the engine that reads in this context should use"""
+    if has_request_context() and g.get("read_replica") is not None:
+        return g.read_replica
+    return primary
+
+
+######################################################################
+# Request hooks
+######################################################################
+def _last_write() -> float:
+    value = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def route_reads(app):
+    """Picks the replica, if any, for the current request"""
+    g.read_replica = None
+    replicas = app.extensions.get("replicas")
+    if not replicas or not replicas.engines or request.method not in SAFE_METHODS:
+        return
+    if time.time() - _last_write() < app.config["READ_YOUR_WRITES_SECONDS"]:
+        return
+    g.read_replica = replicas.choose()
+
+
+def remember_writes(app, response):
+    """Tells the client when it last wrote so its next reads see the write"""
+    replicas = app.extensions.get("replicas")
+    if replicas and replicas.engines and request.method not in SAFE_METHODS and response.status_code < 400:
+        now = f"{time.time():.3f}"
+        response.headers[LAST_WRITE_HEADER] = now
+        response.set_cookie(
+            LAST_WRITE_COOKIE,
+            now,
+            max_age=max(1, int(app.config["READ_YOUR_WRITES_SECONDS"])),
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
+def init_replicas(app):
+    """Creates the replica engines listed in DATABASE_REPLICA_URIS"""
+    previous = app.extensions.get("replicas")
+    if previous is not None:
+        previous.dispose()
+    else:
+        app.before_request(lambda: route_reads(app))
+        app.after_request(lambda response: remember_writes(app, response))
+
+    engines = []
+    for number, uri in enumerate(app.config.get("DATABASE_REPLICA_URIS", [])):
+        config = dict(app.config, SQLALCHEMY_DATABASE_URI=uri)
+        engines.append(create_engine(uri, **db_pool.engine_options(config, f"replica-{number}")))
+    app.extensions["replicas"] = ReplicaSet(engines, app.config.get("REPLICA_BALANCING", "round_robin"))
+    if engines:
+        logger.info("Routing reads to %d replica(s) by %s", len(engines), app.extensions["replicas"].balancing)
@@ -0,0 +1,91 @@
+"""
+Module: representations
+
+Alternate wire formats for the REST API. JSON remains the default; clients
+that send ``Accept: application/msgpack`` get MessagePack responses and may
+send MessagePack bodies with ``Content-Type: application/msgpack``.
+"""
+from datetime import datetime, timedelta, timezone
+import msgpack
+from flask import request, make_response
+from service.models import DataValidationError
+
+MSGPACK_MIMETYPE = "application/msgpack"
+
+# serialize() renders these as ISO-8601 strings; on the MessagePack wire they
+# travel as Timestamp extension values instead (6-10 bytes vs. 26 characters)
+DATETIME_FIELDS = frozenset(("creation_time", "last_updated_time"))
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _to_timestamp(value: str):
+    """Converts an ISO-8601 string into a msgpack Timestamp"""
+    try:
+        moment = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+    if moment.tzinfo is None:
+        # the database stores naive wall-clock times, ship them tagged as UTC
+        moment = moment.replace(tzinfo=timezone.utc)
+    # Timestamp.from_datetime() goes through a float and drops microseconds
+    delta = moment - EPOCH
+    return msgpack.Timestamp(
+        delta.days * 86400 + delta.seconds, delta.microseconds * 1000
+    )
+
+
+def _pack_datetimes(data):
+    """Replaces the known datetime fields with msgpack Timestamps"""
+    # responses are a resource or a list of resources and the timestamps only
+    # live at that level, so there is no need to walk nested item lists
+    if isinstance(data, list):
+        return [_pack_datetimes(value) for value in data]
+    if isinstance(data, dict) and not DATETIME_FIELDS.isdisjoint(data):
+        data = dict(data)
+        for key in DATETIME_FIELDS:
+            if isinstance(data.get(key), str):
+                data[key] = _to_timestamp(data[key])
+    return data
+
+
+def _unpack_datetimes(data):
+    """Turns decoded datetimes back into the ISO-8601 strings JSON clients send"""
+    if isinstance(data, list):
+        return [_unpack_datetimes(value) for value in data]
+    if isinstance(data, dict):
+        return {key: _unpack_datetimes(value) for key, value in data.items()}
+    if isinstance(data, msgpack.Timestamp):
+        delta = timedelta(seconds=data.seconds, microseconds=data.nanoseconds // 1000)
+        return (EPOCH + delta).replace(tzinfo=None).isoformat()
+    return data
+
+
+def packb(data) -> bytes:
+    """Encodes serialized resources as MessagePack"""
+    return msgpack.packb(_pack_datetimes(data), use_bin_type=True)
+
+
+def unpackb(body: bytes):
+    """Decodes a MessagePack body into the same shape as a JSON payload"""
+    return _unpack_datetimes(msgpack.unpackb(body, raw=False))
+
+
+def output_msgpack(data, code, headers=None):
+    """Makes a Flask response with a MessagePack encoded body
+
+    Registered as the flask-restx representation of MSGPACK_MIMETYPE
+    """
+    resp = make_response(packb(data), code)
+    resp.headers.extend(headers or {})
+    return resp
+
+
+def request_payload():
+    """Returns the request body decoded from either JSON or MessagePack"""
+    if request.mimetype == MSGPACK_MIMETYPE:
+        try:
+            return unpackb(request.get_data())
+        except (ValueError, msgpack.UnpackException) as error:
+            raise DataValidationError(f"Invalid MessagePack body: {error}") from error
+    return request.get_json()
@@ -0,0 +1,206 @@
+"""
+Slow Query Log
+
+Statements that take longer than SLOW_QUERY_MS are written, one JSON object
+per line, to the rotating SLOW_QUERY_LOG file with their SQL, duration and
+the route that ran them. The bind parameters hold customer data, so they
+are only written with SLOW_QUERY_PARAMETERS on. A SLOW_QUERY_EXPLAIN_RATE
+sample of the slow SELECTs (none by default) also gets its plan:
+``EXPLAIN (ANALYZE, BUFFERS)`` on PostgreSQL, ``EXPLAIN QUERY PLAN`` on
+SQLite.
+
+EXPLAIN ANALYZE runs the query a second time, so plans are only captured
+for statements that read, on a connection of their own and, inside a
+request, once the response has been sent. ``flask slow-queries``
+summarizes the log by statement shape.
+"""
+import os
+import re
+import json
+import time
+import random
+import logging
+from collections import defaultdict
+from logging.handlers import RotatingFileHandler
+from flask import g, request, has_request_context
+from service.common import sql_timing
+
+logger = logging.getLogger("flask.app")
+
+# The slow query records only, kept out of the application log
+slow_logger = logging.getLogger("slow_queries")
+slow_logger.propagate = False
+
+WHITESPACE = re.compile(r"\s+")
+EXPLAIN = {"postgresql": "EXPLAIN (ANALYZE, BUFFERS) ", "sqlite": "EXPLAIN QUERY PLAN "}
+# Longest parameter list written, long IN lists and bulk inserts are cut
+MAX_PARAMETERS = 50
+
+
+class SlowQueryLog:
+    """Decides which statements are slow and writes them down"""
+
+    def __init__(self, threshold_ms: float = 0.0, explain_rate: float = 0.0, parameters: bool = False):
+        self.threshold_ms = threshold_ms
+        self.explain_rate = explain_rate
+        self.parameters = parameters
+
+    def observe(self, conn, statement: str, parameters, duration_ms: float):
+        """Records a statement if it was slow, explaining a sample of them"""
+        if not self.threshold_ms or duration_ms < self.threshold_ms:
+            return
+        record = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "duration_ms": round(duration_ms, 3),
+            "route": _route(),
+            "statement": statement,
+        }
+        if self.parameters:
+            record["parameters"] = _truncate(parameters)
+        if self._should_explain(conn, statement):
+            if has_request_context():
+                # the client is not kept waiting for the second run
+                g.setdefault("slow_queries", []).append((conn.engine, parameters, record))
+                return
+            record["plan"] = explain(conn.engine, statement, parameters)
+        write(record)
+
+    def _should_explain(self, conn, statement: str) -> bool:
+        return (
+            conn.dialect.name in EXPLAIN
+            and statement.lstrip()[:6].upper() in ("SELECT", "WITH ")
+            and random.random() < self.explain_rate
+        )
+
+
+def _route():
+    if not has_request_context():
+        return None
+    return f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+
+
+def _truncate(parameters):
+    if isinstance(parameters, (list, tuple)) and len(parameters) > MAX_PARAMETERS:
+        return list(parameters[:MAX_PARAMETERS]) + [f"... {len(parameters) - MAX_PARAMETERS} more"]
+    return parameters
+
+
+def explain(engine, statement: str, parameters) -> list:
+    """Returns the plan of a statement as lines, run on its own connection"""
+    connection = engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(EXPLAIN[engine.dialect.name] + statement, parameters)
+        plan = [" ".join(str(column) for column in row) for row in cursor.fetchall()]
+        cursor.close()
+        connection.rollback()
+        return plan
+    except Exception as error:  # pylint: disable=broad-except
+        logger.warning("Could not explain a slow query: %s", error)
+        return [f"EXPLAIN failed: {error}"]
+    finally:
+        connection.close()
+
+
+def write(record: dict):
+    """Appends a slow query record to the log"""
+    slow_logger.warning(json.dumps(record, default=str))
+
+
+def explain_later(response):
+    """Explains the slow queries of the request once the response is sent"""
+    pending = g.pop("slow_queries", None)
+    if pending:
+        response.call_on_close(lambda: explain_all(pending))
+    return response
+
+
+def explain_all(pending: list):
+    """Explains and writes held back slow queries"""
+    for engine, parameters, record in pending:
+        record["plan"] = explain(engine, record["statement"], parameters)
+        write(record)
+
+
+######################################################################
+# Summaries
+######################################################################
+def shape(statement: str) -> str:
+    """The statement with its layout normalized, the values are bound"""
+    return WHITESPACE.sub(" ", statement).strip()
+
+
+def read_log(path: str, backups: int = 0) -> list:
+    """Returns the records of a log file and its rotated backups, oldest first"""
+    records = []
+    for name in [f"{path}.{number}" for number in range(backups, 0, -1)] + [path]:
+        if not os.path.exists(name):
+            continue
+        with open(name, encoding="utf-8") as log:
+            for line in log:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def summarize(records: list, limit: int = 10) -> list:
+    """Groups records by statement shape, worst total time first"""
+    shapes = defaultdict(list)
+    for record in records:
+        shapes[shape(record["statement"])].append(record)
+    summary = []
+    for statement, group in shapes.items():
+        durations = [record["duration_ms"] for record in group]
+        slowest = max(group, key=lambda record: record["duration_ms"])
+        plans = [record for record in group if record.get("plan")]
+        summary.append(
+            {
+                "statement": statement,
+                "count": len(group),
+                "total_ms": round(sum(durations), 3),
+                "mean_ms": round(sum(durations) / len(durations), 3),
+                "max_ms": slowest["duration_ms"],
+                "routes": sorted({record["route"] or "-" for record in group}),
+                "slowest": slowest,
+                "plan": max(plans, key=lambda record: record["duration_ms"])["plan"] if plans else None,
+            }
+        )
+    summary.sort(key=lambda entry: entry["total_ms"], reverse=True)
+    return summary[:limit]
+
+
+######################################################################
+# Set up
+######################################################################
+# Fed by the statements of every engine in the process
+recorder = SlowQueryLog()
+
+
+def observe_statement(statement, _cursor):
+    """Hands a finished statement to the recorder"""
+    recorder.observe(statement.conn, statement.text, statement.parameters, statement.seconds * 1000)
+
+
+def open_log(path: str, max_bytes: int, backups: int):
+    """Writes the slow query records to a file rotated at max_bytes"""
+    for handler in list(slow_logger.handlers):
+        slow_logger.removeHandler(handler)
+        handler.close()
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8", delay=True)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    slow_logger.addHandler(handler)
+    slow_logger.setLevel(logging.WARNING)
+
+
+def init_slow_queries(app):
+    """Starts writing the slow statements to the SLOW_QUERY_LOG file"""
+    recorder.threshold_ms = app.config["SLOW_QUERY_MS"]
+    recorder.explain_rate = app.config["SLOW_QUERY_EXPLAIN_RATE"]
+    recorder.parameters = app.config["SLOW_QUERY_PARAMETERS"]
+    if not recorder.threshold_ms:
+        return
+    open_log(app.config["SLOW_QUERY_LOG"], app.config["SLOW_QUERY_LOG_BYTES"], app.config["SLOW_QUERY_LOG_BACKUPS"])
+    app.after_request(explain_later)
+    sql_timing.listen(finished=observe_statement)
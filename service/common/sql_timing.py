@@ -0,0 +1,84 @@
+"""
+SQL Statement Timing
+
+One set of engine listeners times every SQL statement and hands it to the
+listeners other modules add with listen(), so they share one clock and
+one place to clean up. The statements running on a connection are kept
+in a stack in its info dict, and handle_error takes a failed one off
+again, so a pooled connection never keeps an entry behind.
+"""
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Called with the Statement before it runs, after it ran (and the cursor)
+# and when it failed (and the error)
+STARTED_LISTENERS = []
+FINISHED_LISTENERS = []
+FAILED_LISTENERS = []
+
+RUNNING = "sql_timing"
+
+
+class Statement:  # pylint: disable=too-few-public-methods
+    """A statement on its way through the database, with its duration once done
+
+    Listeners keep what they need from its start to its end in `state`.
+    """
+
+    __slots__ = ("conn", "text", "parameters", "context", "started", "seconds", "state")
+
+    def __init__(self, conn, text: str, parameters, context):
+        self.conn = conn
+        self.text = text
+        self.parameters = parameters
+        self.context = context
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.state = {}
+
+    def finish(self):
+        """Notes how long the statement took"""
+        self.seconds = time.perf_counter() - self.started
+
+
+def _before_cursor_execute(conn, _cursor, statement, parameters, context, _executemany):
+    running = Statement(conn, statement, parameters, context)
+    conn.info.setdefault(RUNNING, []).append(running)
+    for listener in STARTED_LISTENERS:
+        listener(running)
+
+
+def _after_cursor_execute(conn, cursor, _statement, _parameters, _context, _executemany):
+    running = conn.info[RUNNING].pop()
+    running.finish()
+    for listener in FINISHED_LISTENERS:
+        listener(running, cursor)
+
+
+def _handle_error(context):
+    stack = context.connection.info.get(RUNNING) if context.connection is not None else None
+    if not stack:
+        return
+    running = stack.pop()
+    running.finish()
+    for listener in FAILED_LISTENERS:
+        listener(running, context.original_exception)
+
+
+def listen(started=None, finished=None, failed=None):
+    """Adds the listeners of a module, once, and times the statements of every engine"""
+    for listeners, listener in (
+        (STARTED_LISTENERS, started),
+        (FINISHED_LISTENERS, finished),
+        (FAILED_LISTENERS, failed),
+    ):
+        if listener is not None and listener not in listeners:
+            listeners.append(listener)
+    for name, listener in (
+        ("before_cursor_execute", _before_cursor_execute),
+        ("after_cursor_execute", _after_cursor_execute),
+        ("handle_error", _handle_error),
+    ):
+        if not event.contains(Engine, name, listener):
+            event.listen(Engine, name, listener)
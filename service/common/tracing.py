@@ -0,0 +1,340 @@
+"""
+Distributed Tracing
+
+Every sampled request is a trace of spans: one for the request and its
+route handler, one for each Order/Item model operation it calls and one for
+each SQL statement those run, nested as they were called. A request that
+carries a W3C ``traceparent`` header joins the caller's trace and follows
+its sampling decision; otherwise TRACE_SAMPLE_RATE of the requests start a
+trace of their own. Unsampled requests create no spans at all, which keeps
+the cost of tracing to a header lookup and a random number.
+
+Finished spans go to the exporter named by TRACE_EXPORTER:
+
+    none    tracing is off and nothing is installed (the default)
+    file    JSON lines appended to TRACE_FILE
+    memory  kept in a list, for tests
+    module:factory
+            any callable taking the app and returning an object with an
+            ``export(span)`` method, e.g. one that ships spans to a collector
+
+The span fields follow OpenTelemetry so exported spans map onto it.
+"""
+import re
+import json
+import time
+import random
+import logging
+import importlib
+import threading
+import functools
+import contextlib
+from contextvars import ContextVar
+from typing import NamedTuple, Optional
+from flask import g, request
+from service.common import sql_timing
+
+logger = logging.getLogger("flask.app")
+
+TRACEPARENT_HEADER = "traceparent"
+TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+SAMPLED_FLAG = 0x01
+# Longest SQL kept on a statement span
+MAX_STATEMENT = 2000
+
+# The innermost open span of the running request, thread and greenlet safe
+_current: ContextVar = ContextVar("current_span", default=None)
+
+
+def _new_id(bits: int) -> str:
+    """A random non-zero id as lowercase hex, cheaper than secrets for this"""
+    return f"{random.getrandbits(bits) or 1:0{bits // 4}x}"
+
+
+class SpanContext(NamedTuple):
+    """What a span passes on to its children and to other services"""
+
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+    @property
+    def traceparent(self) -> str:
+        """The W3C traceparent header value for this span"""
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: Optional[str]) -> Optional[SpanContext]:
+    """Reads a traceparent header, None when it is missing or invalid"""
+    match = TRACEPARENT.match((value or "").strip().lower())
+    if not match:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == "ff" or trace_id == "0" * 32 or span_id == "0" * 16:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & SAMPLED_FLAG))
+
+
+class Span:
+    """One timed operation of a trace"""
+
+    __slots__ = ("tracer", "name", "kind", "context", "parent_id", "attributes", "start", "end", "status", "_token")
+
+    def __init__(self, tracer, name: str, context: SpanContext, parent_id: Optional[str], kind: str, attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.kind = kind
+        self.context = context
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end = None
+        self.status = "UNSET"
+        self._token = None
+
+    def set_attribute(self, key: str, value):
+        """Adds a detail to the span"""
+        self.attributes[key] = value
+
+    def record_exception(self, error: BaseException):
+        """Marks the span as failed by an exception"""
+        self.status = "ERROR"
+        self.attributes["exception.type"] = type(error).__name__
+        self.attributes["exception.message"] = str(error)[:500]
+
+    def activate(self):
+        """Makes this the span new spans are children of"""
+        self._token = _current.set(self)
+
+    def finish(self):
+        """Ends the span, restores its parent as current and exports it"""
+        if self.end is not None:
+            return
+        self.end = time.time_ns()
+        if self._token is not None:
+            try:
+                _current.reset(self._token)
+            except ValueError:  # finished in another context, e.g. a streamed body
+                _current.set(None)
+            self._token = None
+        self.tracer.export(self)
+
+    def to_dict(self) -> dict:
+        """The span as a JSON-serializable dict"""
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start,
+            "end_time": self.end,
+            "duration_ms": round((self.end - self.start) / 1e6, 3) if self.end else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+class Tracer:
+    """Starts spans and hands the finished ones to the exporter"""
+
+    def __init__(self, exporter=None, sample_rate: float = 0.0):
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def start_trace(self, name: str, parent: Optional[SpanContext] = None, **attributes) -> Optional[Span]:
+        """Starts the root span of a request, None when it is not sampled"""
+        if self.exporter is None:
+            return None
+        if parent is None:
+            if random.random() >= self.sample_rate:
+                return None
+            parent_id, trace_id = None, _new_id(128)
+        elif parent.sampled:
+            parent_id, trace_id = parent.span_id, parent.trace_id
+        else:
+            return None
+        span = Span(self, name, SpanContext(trace_id, _new_id(64), True), parent_id, "SERVER", attributes)
+        span.activate()
+        return span
+
+    def start_span(self, name: str, kind: str = "INTERNAL", activate: bool = True, **attributes) -> Optional[Span]:
+        """Starts a child of the current span, None outside a sampled trace"""
+        parent = _current.get()
+        if parent is None:
+            return None
+        context = SpanContext(parent.context.trace_id, _new_id(64), True)
+        span = Span(self, name, context, parent.context.span_id, kind, attributes)
+        if activate:
+            span.activate()
+        return span
+
+    def export(self, span: Span):
+        """Passes a finished span on, never failing the traced work"""
+        try:
+            self.exporter.export(span)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.warning("Could not export span %s: %s", span.name, error)
+
+
+def current_span() -> Optional[Span]:
+    """The innermost open span, None outside a sampled trace"""
+    return _current.get()
+
+
+######################################################################
+# Exporters
+######################################################################
+class InMemoryExporter:
+    """Keeps the finished spans in a list"""
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span: Span):
+        """Keeps a span"""
+        self.spans.append(span)
+
+    def clear(self):
+        """Forgets the spans kept so far"""
+        self.spans.clear()
+
+
+class JsonFileExporter:
+    """Appends the finished spans to a file, one JSON object per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span):
+        """Writes a span"""
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock, open(self.path, "a", encoding="utf-8") as output:
+            output.write(line)
+
+
+EXPORTERS = {
+    "file": lambda app: JsonFileExporter(app.config["TRACE_FILE"]),
+    "memory": lambda app: InMemoryExporter(),
+}
+
+
+def load_exporter(app):
+    """Builds the exporter TRACE_EXPORTER names"""
+    name = app.config["TRACE_EXPORTER"]
+    if name in EXPORTERS:
+        return EXPORTERS[name](app)
+    module, _, factory = name.partition(":")
+    if not factory:
+        raise ValueError(f"TRACE_EXPORTER must be none, file, memory or module:factory, not {name}")
+    return getattr(importlib.import_module(module), factory)(app)
+
+
+# Traces the requests and statements of the whole process
+tracer = Tracer()
+
+
+######################################################################
+# Instrumentation
+######################################################################
+# Context manager factories entered with the operation name around every
+# @traced model method, tracing or not, e.g. by the memory profiler
+operation_hooks = []
+
+
+def traced(function):
+    """Wraps a model method in a span named after its class and itself"""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        parent = _current.get()
+        if parent is None and not operation_hooks:
+            return function(*args, **kwargs)
+        owner = args[0] if isinstance(args[0], type) else type(args[0])
+        name = f"{owner.__name__}.{function.__name__}"
+        with contextlib.ExitStack() as hooks:
+            for hook in operation_hooks:
+                hooks.enter_context(hook(name))
+            if parent is None or parent.name == name:
+                # untraced, or an override calling super() where one span is enough
+                return function(*args, **kwargs)
+            span = tracer.start_span(name)
+            try:
+                return function(*args, **kwargs)
+            except Exception as error:
+                span.record_exception(error)
+                raise
+            finally:
+                span.finish()
+
+    return wrapper
+
+
+def start_statement_span(statement):
+    """Starts the span of a statement, when its request is traced"""
+    statement.state["span"] = tracer.start_span(
+        statement.text.lstrip().split(" ", 1)[0].upper(),
+        kind="CLIENT",
+        activate=False,
+        **{"db.system": statement.conn.dialect.name, "db.statement": statement.text[:MAX_STATEMENT]},
+    )
+
+
+def finish_statement_span(statement, cursor):
+    """Finishes the span of a statement with the rows it touched"""
+    span = statement.state.get("span")
+    if span is not None:
+        if cursor.rowcount >= 0:
+            span.set_attribute("db.rows", cursor.rowcount)
+        span.finish()
+
+
+def fail_statement_span(statement, error):
+    """Finishes the span of a statement that failed"""
+    span = statement.state.get("span")
+    if span is not None:
+        span.record_exception(error)
+        span.finish()
+
+
+def start_request_trace():
+    """Starts the span of the current request"""
+    rule = request.url_rule.rule if request.url_rule else request.path
+    g.trace = tracer.start_trace(
+        f"{request.method} {rule}",
+        parse_traceparent(request.headers.get(TRACEPARENT_HEADER)),
+        **{"http.method": request.method, "http.route": rule, "http.target": request.full_path.rstrip("?")},
+    )
+
+
+def record_response(response):
+    """Adds the response status to the span of the request"""
+    span = g.get("trace")
+    if span is not None:
+        span.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            span.status = "ERROR"
+    return response
+
+
+def end_request_trace(error=None):
+    """Finishes the span of the request"""
+    span = g.pop("trace", None)
+    if span is not None:
+        if error is not None:
+            span.record_exception(error)
+        span.finish()
+
+
+def init_tracing(app):
+    """Traces a sample of the requests when TRACE_EXPORTER is set"""
+    if app.config["TRACE_EXPORTER"] == "none":
+        return
+    tracer.exporter = load_exporter(app)
+    tracer.sample_rate = app.config["TRACE_SAMPLE_RATE"]
+    app.before_request(start_request_trace)
+    app.after_request(record_response)
+    app.teardown_request(end_request_trace)
+    sql_timing.listen(started=start_statement_span, finished=finish_statement_span, failed=fail_statement_span)
+    logger.info("Tracing %s of the requests to %s", tracer.sample_rate, app.config["TRACE_EXPORTER"])
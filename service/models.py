@@ -4,15 +4,110 @@ Models for YourResourceModel
 All of the models are stored in this module
 """
 import logging
+import threading
 from abc import abstractmethod
 from datetime import datetime, timedelta
+from flask import current_app, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, select, lambda_stmt, text, union_all
+from sqlalchemy.orm import selectinload
+from service.common import db_pool, replicas, partitions
+from service.common.tracing import traced
 
 
 logger = logging.getLogger("flask.app")
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_app()
+db = SQLAlchemy(session_options={"class_": replicas.RoutingSession})
+
+
+def init_app(app):
+    """Registers SQLAlchemy with the app without touching the database
+
+    Engines only connect when first used. With DB_AUTO_CREATE the first
+    request creates any missing tables; otherwise run `flask db-init`.
+    """
+    _init_sqlalchemy(app)
+    if not app.config.get("DB_AUTO_CREATE", True):
+        return
+    lock = threading.Lock()
+    pending = [True]
+
+    @app.before_request
+    def create_tables_once():
+        if pending:
+            with lock:
+                if pending:
+                    create_tables(app)
+                    pending.clear()
+
+
+def _init_sqlalchemy(app):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = db_pool.engine_options(app.config)
+    db.init_app(app)
+    replicas.init_replicas(app)
+    PersistentBase.database_uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+
+
+def create_tables(app):
+    """Creates the tables that do not exist yet, partitioned when configured"""
+    with app.app_context(), db.engine.begin() as connection:
+        create_schema(connection, app.config)
+
+
+def create_schema(connection, config):
+    """Creates the missing tables on a connection, in its transaction
+
+    Shared by the Flask app and the ASGI one, which runs it through the
+    async connection's run_sync().
+
+    Args:
+        connection (Connection): a sync connection to the database
+        config (dict): the ORDER_PARTITIONING and PARTITION_MONTHS_AHEAD settings
+    """
+    if config.get("ORDER_PARTITIONING"):
+        partitions.init_partitions(connection, config.get("PARTITION_MONTHS_AHEAD", 3))
+    db.metadata.create_all(connection)
+    _add_missing_columns(connection)
+
+
+# Columns added to tables that earlier versions of the service created
+ADDED_COLUMNS = {"item": ("order_creation_time",)}
+
+
+def _add_missing_columns(connection):
+    """Adds the ADDED_COLUMNS that create_all() leaves out of existing tables"""
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table_name, names in ADDED_COLUMNS.items():
+        table = db.metadata.tables[table_name]
+        existing = {column["name"] for column in inspector.get_columns(table_name)}
+        for column in (table.c[name] for name in names if name not in existing):
+            logger.info("Adding the %s column to the %s table", column.name, table_name)
+            connection.execute(
+                text(
+                    f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN "
+                    f"{preparer.format_column(column)} {column.type.compile(connection.dialect)}"
+                )
+            )
+
+
+def partitioned() -> bool:
+    """Whether the order and item tables are partitioned (ORDER_PARTITIONING)"""
+    return has_app_context() and bool(current_app.config.get("ORDER_PARTITIONING"))
+
+
+def dispose_engines(app):
+    """Drops the pooled connections a forked worker inherited from its parent
+
+    The connections are left open (close=False) since the parent process
+    still owns them; the worker simply opens its own on first use.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    if "replicas" in app.extensions:
+        app.extensions["replicas"].dispose(close=False)
 
 
 # Function to initialize the database
@@ -21,6 +116,21 @@ def init_db(app):
     Order.init_db(app)
 
 
+# Cold storage for finished orders (see service.archive): one row per order
+# with its items folded into a JSON column, and only the customer_id index
+order_archive = db.Table(
+    "order_archive",
+    db.Column("id", db.Integer, primary_key=True, autoincrement=False),
+    db.Column("customer_id", db.Integer, index=True),
+    db.Column("creation_time", db.DateTime(), nullable=False),
+    db.Column("last_updated_time", db.DateTime(), nullable=False),
+    db.Column("total_price", db.Float),
+    db.Column("status", db.String(32)),
+    db.Column("items", db.JSON, nullable=False),
+    db.Column("archived_time", db.DateTime(), nullable=False),
+)
+
+
 class DataValidationError(Exception):
     """Used for an data validation errors when deserializing"""
 
@@ -28,6 +138,8 @@ class DataValidationError(Exception):
 class PersistentBase:
     """Base class added persistent methods"""
 
+    database_uri = None
+
     def __init__(self):
         self.id = None  # pylint: disable=invalid-name
 
@@ -39,6 +151,7 @@ class PersistentBase:
     def deserialize(self, data: dict) -> None:
         """Convert a dictionary into an object"""
 
+    @traced
     def delete(self):
         """Removes an Order from the data store"""
         logger.info("Deleting an Order %d", self.id)
@@ -47,25 +160,38 @@ class PersistentBase:
 
     @classmethod
     def init_db(cls, app):
-        """Initializes the database session"""
+        """Initializes the database session and creates the tables now
+
+        For tests and scripts that use the models outside of requests, so it
+        also pushes an application context. The service itself starts with
+        init_app() and never waits on the database.
+        """
         logger.info("Initializing database")
         cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+        # Flask rejects new setup hooks once the app has served a request,
+        # so only initialize again when pointed at a different database
+        uri = app.config.get("SQLALCHEMY_DATABASE_URI")
+        if app.extensions.get("sqlalchemy") is not db or PersistentBase.database_uri != uri:
+            _init_sqlalchemy(app)
+        if not has_app_context() or current_app._get_current_object() is not app:  # pylint: disable=protected-access
+            app.app_context().push()
+        create_tables(app)  # make our sqlalchemy tables
 
     @classmethod
+    @traced
     def all(cls):
         """Returns all of the records in the database"""
         logger.info("Processing all records")
         return cls.query.all()
 
     @classmethod
+    @traced
     def find(cls, by_id):
         """Finds a record by it's ID"""
         logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        # Session.get() checks the identity map first and loads through a
+        # statement SQLAlchemy caches per class
+        return db.session.get(cls, by_id)
 
 
 class Item(db.Model, PersistentBase):
@@ -82,6 +208,9 @@ class Item(db.Model, PersistentBase):
     price = db.Column(db.Float)
     description = db.Column(db.String(128))
     quantity = db.Column(db.Integer)
+    # copied from the Order so items share its monthly partition, only
+    # filled in when the tables are partitioned
+    order_creation_time = db.Column(db.DateTime())
 
     def __repr__(self):
         return f"<Item {self.name} id=[{self.id}] order[{self.order_id}]>"
@@ -125,6 +254,7 @@ class Item(db.Model, PersistentBase):
             ) from error
         return self
 
+    @traced
     def create(self):
         """
         Creates an Order to the database
@@ -134,6 +264,7 @@ class Item(db.Model, PersistentBase):
         db.session.add(self)
         db.session.commit()
 
+    @traced
     def update(self):
         """
         Updates an Order to the database
@@ -141,6 +272,7 @@ class Item(db.Model, PersistentBase):
         logger.info("Updating an Order %d", self.id)
         db.session.commit()
 
+    @traced
     def copy(self):
         """
         Create an copy of an item and save to the database
@@ -229,75 +361,158 @@ class Order(db.Model, PersistentBase):
         total = round(total, 2)
         return total
 
-    def create(self):
-        """
-        Creates an Order to the database
+    def before_save(self, created: bool = False):
         """
-        logger.info("Creating an order")
-        self.id = None  # id must be none to generate next primary key
+        Stamps the times and recalculates the total_price of an Order
 
-        # Set the creation_time and last_updated_time as the time this function is called.
-        self.creation_time = datetime.now()
-        self.last_updated_time = self.creation_time
+        Args:
+            created (bool): whether the Order is being created
+        """
+        # Set the times as the time this function is called.
+        self.last_updated_time = datetime.now()
+        if created:
+            self.creation_time = self.last_updated_time
 
         # Calculate the total_price for the order
-
         self.total_price = self.get_total_price()
 
+    @traced
+    def create(self):
+        """
+        Creates an Order to the database
+        """
+        logger.info("Creating an order")
+        self.id = None  # id must be none to generate next primary key
+        self.before_save(created=True)
         db.session.add(self)
         db.session.commit()
 
+    @traced
     def update(self):
         """
         Updates an Order to the database
         """
         logger.info("Updating an Order %d", self.id)
+        self.before_save()
+        db.session.commit()
 
-        # Set the last_updated_time as the time this function is called.
-        self.last_updated_time = datetime.now()
+    @classmethod
+    @traced
+    def all(cls, include_archived: bool = False):
+        """Returns all of the Orders, archived ones only when asked for"""
+        logger.info("Processing all records")
+        # the lists serialize every Order's items, so load them all with one
+        # more SELECT (here and in the find_by_* queries) instead of one per Order
+        orders = db.session.scalars(select(cls).options(selectinload(cls.items))).all()
+        if include_archived:
+            orders += cls.find_archived()
+        return orders
 
-        # Calculate the total_price for the order
+    @classmethod
+    @traced
+    def find(cls, by_id, include_archived: bool = False):
+        """Finds an Order by it's ID, looking in the archive when asked to"""
+        order = super().find(by_id)
+        if order is None and include_archived:
+            order = next(iter(cls.find_archived(order_archive.c.id == by_id)), None)
+        return order
 
-        self.total_price = self.get_total_price()
-        # print(self.total_price)
+    @classmethod
+    @traced
+    def find_archived(cls, *conditions) -> list:
+        """Returns the archived Orders matching the conditions
 
-        db.session.commit()
+        Args:
+            conditions: filters on the order_archive columns
+        """
+        rows = db.session.execute(select(order_archive).where(*conditions)).all()
+        return [cls.from_archive(row) for row in rows]
+
+    @classmethod
+    def from_archive(cls, row):
+        """Rebuilds a read-only, unsaved Order from its order_archive row"""
+        order = cls()
+        order.id = row.id
+        order.customer_id = row.customer_id
+        order.creation_time = row.creation_time
+        order.last_updated_time = row.last_updated_time
+        order.total_price = row.total_price
+        order.status = row.status
+        for data in row.items:
+            item = Item()
+            item.deserialize(data)
+            item.id = data["id"]
+            order.items.append(item)
+        return order
 
     @classmethod
-    def find_by_customer_id(cls, customer_id):
+    @traced
+    def find_by_customer_id(cls, customer_id, include_archived: bool = False):
         """Returns all Orders with the given customer_id
 
         Args:
             customer_id (integer): the customer_id of the Order you want to match
+            include_archived (bool): whether to also search the archive
         """
         logger.info("Processing customer_id query for %d ...", customer_id)
-        return cls.query.filter(cls.customer_id == customer_id).all()
+        # lambda statements are built and compiled once, later calls only
+        # swap in the bound parameters
+        orders = db.session.scalars(
+            lambda_stmt(lambda: select(cls).options(selectinload(cls.items)).where(cls.customer_id == customer_id))
+        ).all()
+        if include_archived:
+            orders += cls.find_archived(order_archive.c.customer_id == customer_id)
+        return orders
 
     @classmethod
-    def find_by_date(cls, date):
+    @traced
+    def find_by_date(cls, date, include_archived: bool = False):
         """Returns all Orders placed on a given date
 
         Args:
             date (string): the date of the Order you want to match
+            include_archived (bool): whether to also search the archive
         """
         logger.info("Processing date query for %s ...", date)
         date_format = "%Y-%m-%d"
-        date_obj = datetime.strptime(date, date_format)
-        return cls.query.filter(
-            cls.creation_time >= date_obj,
-            cls.creation_time < date_obj + timedelta(days=1),
-        ).all()
+        start = datetime.strptime(date, date_format)
+        end = start + timedelta(days=1)
+        if partitioned():
+            # the items of those Orders are in the same months, so only their
+            # partitions are scanned
+            items = cls.items.and_(Item.order_creation_time >= start, Item.order_creation_time < end)
+            statement = select(cls).options(selectinload(items)).where(cls.creation_time >= start, cls.creation_time < end)
+        else:
+            statement = lambda_stmt(
+                lambda: select(cls)
+                .options(selectinload(cls.items))
+                .where(cls.creation_time >= start, cls.creation_time < end)
+            )
+        orders = db.session.scalars(statement).all()
+        if include_archived:
+            orders += cls.find_archived(
+                order_archive.c.creation_time >= start, order_archive.c.creation_time < end
+            )
+        return orders
 
     @classmethod
-    def find_by_status(cls, status):
+    @traced
+    def find_by_status(cls, status, include_archived: bool = False):
         """Returns all Orders placed on a given status
 
         Args:
             status (string): the status of the Order you want to match
+            include_archived (bool): whether to also search the archive
         """
         logger.info("processing status query for %s ...", status)
-        return cls.query.filter(cls.status == status).all()
+        orders = db.session.scalars(
+            lambda_stmt(lambda: select(cls).options(selectinload(cls.items)).where(cls.status == status))
+        ).all()
+        if include_archived:
+            orders += cls.find_archived(order_archive.c.status == status)
+        return orders
 
+    @traced
     def delete(self):
         """
         Deletes an Order in the database
@@ -306,6 +521,7 @@ class Order(db.Model, PersistentBase):
         db.session.delete(self)
         db.session.commit()
 
+    @traced
     def copy(self):
         """
         Creates a copy of an order and save to DB
@@ -315,14 +531,37 @@ class Order(db.Model, PersistentBase):
         other = Order()
         other.customer_id = self.customer_id
         other.status = self.status
-        # I delegate the handling of all other fields to create()
+        for item in self.items:
+            # the relationship points the copies at the new Order on insert
+            other.items.append(Item().deserialize(item.serialize()))
+        # I delegate the handling of all other fields to create(), which
+        # saves the Order and its Items in a single commit
         other.create()
-
-        other.items = [item.copy() for item in self.items]
-        for item in other.items:
-            item.order_id = other.id
-        other.update()
-        # other.total_price = other.total_price
-        # for item in other.items:
-        #     item.price = item.price
         return other
+
+
+def highest_order_id():
+    """The highest order id ever handed out, live or archived, as a scalar subquery
+
+    Archived orders keep their ids, so new ids given out by hand start past
+    both tables rather than reusing the id of an archived order.
+    """
+    highest = union_all(
+        select(db.func.max(Order.id).label("id")), select(db.func.max(order_archive.c.id).label("id"))
+    ).subquery()
+    return select(db.func.coalesce(db.func.max(highest.c.id), 0)).scalar_subquery()
+
+
+@event.listens_for(Item, "before_insert")
+@event.listens_for(Item, "before_update")
+def copy_order_creation_time(_mapper, _connection, item):
+    """Copies the creation_time of the Item's Order when the tables are partitioned
+
+    A plain value, so the Items of an Order are still inserted in one batch;
+    the Order is in the session already when it is saved along with them.
+    """
+    state = inspect(item)
+    if not partitioned() or (state.persistent and not state.attrs.order_id.history.has_changes()):
+        return
+    order = state.session.get(Order, item.order_id)
+    item.order_creation_time = order.creation_time if order else None
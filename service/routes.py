@@ -19,25 +19,60 @@ DELETE /orders/{id}/items/{item id} -
 deletes an Item record with a given item id in the Order with a given id number
 POST /orders/{id}/repeat - creates a copy of an existing Order in the database
 PUT /orders/{id}/cancel - cancels an order
+GET /orders/export - streams every Order and Item row as CSV or NDJSON
+
+GET /orders and GET /orders/{id} only read live Orders unless called with
+?include_archived=true.
+
+All /api endpoints answer in JSON by default, or in MessagePack when the
+request carries "Accept: application/msgpack".
 """
 
-from flask import jsonify, abort
-from flask_restx import Resource, fields, reqparse
+import hmac
+from flask import Blueprint, current_app, jsonify, abort, request, Response, stream_with_context
+from flask_restx import Api, Resource, fields, reqparse, inputs
 from service.common import status  # HTTP Status Codes
-from service.models import Order, Item
+from service.common.db_pool import pool_statistics
+from service.common.metrics import render as render_metrics
+from service.common.compression import send_static
+from service.common.representations import MSGPACK_MIMETYPE, output_msgpack, request_payload
+from service.models import db, Order, Item
+from service.bulk import EXPORT_FORMATS, export_orders
+
+# The non-API routes
+blueprint = Blueprint("service", __name__)
+
+######################################################################
+# Configure Swagger before initializing it
+######################################################################
+api = Api(
+    version="1.0.0",
+    title="Orders REST API Service",
+    description="This is a documentation for Orders REST APIs.",
+    default="orders",
+    default_label="Orders operations",
+    doc="/apidocs",  # default also could use doc='/apidocs/'
+    prefix="/api",
+)
+# JSON stays the default, it was registered first
+api.representation(MSGPACK_MIMETYPE)(output_msgpack)
 
-# Import Flask application
-from . import app, api
+
+def init_routes(app):
+    """Registers the routes and the REST API with the app"""
+    app.register_blueprint(blueprint)
+    api.init_app(app)
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
+@blueprint.route("/")
 def index():
     """Root URL response"""
-    app.logger.info("Request for Root URL")
-    return app.send_static_file("index.html")
+    current_app.logger.info("Request for Root URL")
+    # revalidated on every visit, answered with 304 when unchanged
+    return send_static("index.html", max_age=0)
 
 
 # Define the model so that the docs reflect what can be sent
@@ -93,6 +128,36 @@ orders_args.add_argument(
     help="List Orders by status",
 )
 
+orders_args.add_argument(
+    "include_archived",
+    type=inputs.boolean,
+    location="args",
+    required=False,
+    default=False,
+    help="Also list archived Orders",
+)
+
+order_args = reqparse.RequestParser()
+order_args.add_argument(
+    "include_archived",
+    type=inputs.boolean,
+    location="args",
+    required=False,
+    default=False,
+    help="Also look for the Order in the archive",
+)
+
+export_args = reqparse.RequestParser()
+export_args.add_argument(
+    "format",
+    type=str,
+    location="args",
+    required=False,
+    default="csv",
+    choices=tuple(EXPORT_FORMATS),
+    help="Export file format",
+)
+
 ######################################################################
 #  R E S T   A P I   E N D P O I N T S
 ######################################################################
@@ -101,10 +166,10 @@ orders_args.add_argument(
 ######################################################################
 # CHECK HEALTH
 ######################################################################
-@app.route("/health")
+@blueprint.route("/health")
 def health():
     """Health URL response"""
-    app.logger.info("Request for Health URL")
+    current_app.logger.info("Request for Health URL")
     return (
         jsonify(
             status="OK",
@@ -113,6 +178,45 @@ def health():
     )
 
 
+######################################################################
+# CONNECTION POOL STATISTICS
+######################################################################
+POOL_TOKEN_HEADER = "X-Pool-Token"
+
+
+@blueprint.route("/internal/pool")
+def pool_stats():
+    """Live database connection pool statistics for operators
+
+    Served on the public app, so only to callers sending DB_POOL_STATS_TOKEN
+    in the X-Pool-Token header, and not at all without a token configured.
+    """
+    token = current_app.config["DB_POOL_STATS_TOKEN"]
+    if not token:
+        abort(status.HTTP_404_NOT_FOUND, "Pool statistics are not enabled.")
+    offered = request.headers.get(POOL_TOKEN_HEADER, "")
+    if not hmac.compare_digest(offered.encode(), token.encode()):
+        abort(status.HTTP_403_FORBIDDEN, "A valid X-Pool-Token header is required.")
+    statistics = pool_statistics(db.engine.pool)
+    replica_set = current_app.extensions.get("replicas")
+    if replica_set and replica_set.engines:
+        statistics["replicas"] = {
+            engine.pool.logging_name or str(number): pool_statistics(engine.pool)
+            for number, engine in enumerate(replica_set.engines)
+        }
+    return jsonify(statistics), status.HTTP_200_OK
+
+
+######################################################################
+# PROMETHEUS METRICS
+######################################################################
+@blueprint.route("/metrics")
+def metrics():
+    """Request, database and pool metrics of every worker for Prometheus"""
+    body, content_type = render_metrics()
+    return Response(body, status.HTTP_200_OK, content_type=content_type)
+
+
 ######################################################################
 #  PATH: /orders/{id}
 ######################################################################
@@ -133,15 +237,16 @@ class OrdersResource(Resource):
     # ------------------------------------------------------------------
     @api.doc("get_order")
     @api.response(404, "Order not found")
+    @api.expect(order_args, validate=False)
     def get(self, order_id):
         """
         Retrieve a single Order
 
         This endpoint will return an Order based on it's id
         """
-        app.logger.info("Request for Order with id: %s", order_id)
+        current_app.logger.info("Request for Order with id: %s", order_id)
         # See if the order exists and abort if it doesn't
-        order = Order.find(order_id)
+        order = Order.find(order_id, order_args.parse_args()["include_archived"])
         if not order:
             abort(
                 status.HTTP_404_NOT_FOUND,
@@ -164,7 +269,7 @@ class OrdersResource(Resource):
 
         This endpoint will update an Order based the body that is posted
         """
-        app.logger.info("Request to update order with id: %s", order_id)
+        current_app.logger.info("Request to update order with id: %s", order_id)
 
         # See if the order exists and abort if it doesn't
         order = Order.find(order_id)
@@ -174,7 +279,7 @@ class OrdersResource(Resource):
             )
 
         # Update from the json in the body of the request
-        order.deserialize(api.payload)
+        order.deserialize(request_payload())
         order.id = order_id
         order.update()
 
@@ -190,13 +295,13 @@ class OrdersResource(Resource):
         Deletes an Order
         This endpoint will delete an Order with the ID given.
         """
-        app.logger.info("Request to delete an order with order ID %s", order_id)
+        current_app.logger.info("Request to delete an order with order ID %s", order_id)
 
         # See if the order exists and delete if it exists
         order = Order.find(order_id)
         if order:
             order.delete()
-            app.logger.info("Order with id [%s] was deleted", order_id)
+            current_app.logger.info("Order with id [%s] was deleted", order_id)
 
         return "", status.HTTP_204_NO_CONTENT
 
@@ -216,20 +321,21 @@ class OrdersCollection(Resource):
     # @api.marshal_list_with(orders_model)
     def get(self):
         """Returns all of the Orders"""
-        app.logger.info("Request for Order list")
+        current_app.logger.info("Request for Order list")
         orders = []
         args = orders_args.parse_args()
         customer_id = args["customer_id"]
         date = args["date"]
         order_status = args["status"]
+        include_archived = args["include_archived"]
         if customer_id:
-            orders = Order.find_by_customer_id(customer_id)
+            orders = Order.find_by_customer_id(customer_id, include_archived)
         elif date:
-            orders = Order.find_by_date(date)
+            orders = Order.find_by_date(date, include_archived)
         elif order_status:
-            orders = Order.find_by_status(order_status)
+            orders = Order.find_by_status(order_status, include_archived)
         else:
-            orders = Order.all()
+            orders = Order.all(include_archived)
 
         # Return as an array of dictionaries
         results = [order.serialize() for order in orders]
@@ -247,17 +353,41 @@ class OrdersCollection(Resource):
         Creates an Order
         This endpoint will create an Order based the data in the body that is posted
         """
-        app.logger.info("Request to create an order")
+        current_app.logger.info("Request to create an order")
         order = Order()
-        order.deserialize(api.payload)
+        order.deserialize(request_payload())
         order.create()
         message = order.serialize()
         location_url = api.url_for(OrdersResource, order_id=order.id, _external=True)
 
-        app.logger.info("Order with ID [%s] created.", order.id)
+        current_app.logger.info("Order with ID [%s] created.", order.id)
         return message, status.HTTP_201_CREATED, {"Location": location_url}
 
 
+######################################################################
+#  PATH: /orders/export
+######################################################################
+@api.route("/orders/export")
+class ExportResource(Resource):
+    """Bulk export of all Orders and their Items"""
+
+    @api.doc("export_orders")
+    @api.expect(export_args, validate=False)
+    def get(self):
+        """
+        Export all Orders
+        This endpoint streams one row per Item (joined with its Order) as CSV or NDJSON
+        """
+        args = export_args.parse_args()
+        fmt = args["format"]
+        current_app.logger.info("Request to export orders as %s", fmt)
+        return Response(
+            stream_with_context(export_orders(fmt)),
+            mimetype=EXPORT_FORMATS[fmt],
+            headers={"Content-Disposition": f"attachment; filename=orders.{fmt}"},
+        )
+
+
 ######################################################################
 #  PATH: /orders/{id}/cancel
 ######################################################################
@@ -273,7 +403,7 @@ class CancelResource(Resource):
         Cancel an Order
         This endpoint will cancel an Order with the ID given.
         """
-        app.logger.info("Request to cancel an order with order ID %s", order_id)
+        current_app.logger.info("Request to cancel an order with order ID %s", order_id)
 
         # See if the order exists and delete if it exists
         order = Order.find(order_id)
@@ -304,7 +434,7 @@ class RepeatResource(Resource):
         Repeat an Order
         This endpoint will repeat an Order with the ID given.
         """
-        app.logger.info("Request to repeat an order with order ID %s", order_id)
+        current_app.logger.info("Request to repeat an order with order ID %s", order_id)
 
         # See if the order exists and delete if it exists
         order = Order.find(order_id)
@@ -377,7 +507,7 @@ class ItemsResource(Resource):
 
         This endpoint returns just an item
         """
-        app.logger.info("Request to get Item %s for Order id: %s", item_id, order_id)
+        current_app.logger.info("Request to get Item %s for Order id: %s", item_id, order_id)
 
         # See if the item exists and abort if it doesn't
         item = Item.find(item_id)
@@ -403,7 +533,7 @@ class ItemsResource(Resource):
 
         This endpoint will update an item based the body that is posted
         """
-        app.logger.info("Request to update item %s for order id: %s", item_id, order_id)
+        current_app.logger.info("Request to update item %s for order id: %s", item_id, order_id)
 
         # See if the item exists and abort if it doesn't
         item = Item.find(item_id)
@@ -412,12 +542,15 @@ class ItemsResource(Resource):
                 status.HTTP_404_NOT_FOUND,
                 f"Item with id '{item_id}' could not be found.",
             )
-        order = Order.find(order_id)
         # Update from the json in the body of the request
-        item.deserialize(api.payload)
+        item.deserialize(request_payload())
         item.id = item_id
-        item.update()
-        order.update()
+        order = Order.find(order_id)
+        if order:
+            # one commit saves the Item along with its Order's new total
+            order.update()
+        else:
+            item.update()
 
         return item.serialize(), status.HTTP_200_OK
 
@@ -432,7 +565,7 @@ class ItemsResource(Resource):
 
         This endpoint will delete an Item based the item id specified in the path
         """
-        app.logger.info("Request to delete Item %s for Order id: %s", item_id, order_id)
+        current_app.logger.info("Request to delete Item %s for Order id: %s", item_id, order_id)
 
         # See if the item exists and delete it if it does
         item = Item.find(item_id)
@@ -459,7 +592,7 @@ class ItemsCollection(Resource):
     @api.marshal_list_with(items_model)
     def get(self, order_id):
         """Returns all of the items for an order"""
-        app.logger.info("Request for all items for order with id: %s", order_id)
+        current_app.logger.info("Request for all items for order with id: %s", order_id)
 
         # See if the order exists and abort if it doesn't
         order = Order.find(order_id)
@@ -488,7 +621,7 @@ class ItemsCollection(Resource):
 
         This endpoint will create an item to an order
         """
-        app.logger.info("Request to create an item for order with id: %s", order_id)
+        current_app.logger.info("Request to create an item for order with id: %s", order_id)
 
         # See if the order exists and abort if it doesn't
         order = Order.find(order_id)
@@ -500,7 +633,7 @@ class ItemsCollection(Resource):
 
         # Create an item from the json data
         item = Item()
-        item.deserialize(api.payload)
+        item.deserialize(request_payload())
 
         # Append the item to the order
         order.items.append(item)
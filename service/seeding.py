@@ -0,0 +1,220 @@
+"""
+Synthetic Orders for benchmarks
+
+Fills the order and item tables with millions of made-up but realistic
+orders, far faster than building them one at a time with the factories:
+a few customers place most of the orders (a Zipf distribution), statuses
+follow a typical mix, creation times lean towards the recent end of the
+window and items are drawn from a catalog where some products sell far
+more than others.
+
+Orders are generated and loaded in chunks of SEED_CHUNK_SIZE, each drawn
+whole with ``random.choices(..., k=n)`` from a generator seeded with the
+seed and the chunk number, so the same seed always gives the same data no
+matter how many processes share the work. Each chunk goes in with
+``COPY ... FROM STDIN`` on PostgreSQL with psycopg 3 and multi-row inserts
+elsewhere, in a transaction of its own, so memory use stays flat.
+"""
+import re
+import random
+import logging
+import itertools
+import multiprocessing
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select, text
+from service.models import db, Order, Item, dispose_engines, highest_order_id
+from service.bulk import _supports_copy
+
+logger = logging.getLogger("flask.app")
+
+# Orders generated and committed together
+SEED_CHUNK_SIZE = 10000
+
+# (status, share of orders)
+STATUS_MIX = (
+    ("delivered", 0.55),
+    ("shipped", 0.15),
+    ("submitted", 0.10),
+    ("finished", 0.10),
+    ("cancelled", 0.10),
+)
+CATALOG_SIZE = 500
+QUANTITY_WEIGHTS = (60, 20, 10, 5, 5)  # of 1 to 5 of a product
+
+ORDER_COLUMNS = ["id", "customer_id", "status", "creation_time", "last_updated_time", "total_price"]
+ITEM_COLUMNS = ["order_id", "name", "price", "description", "quantity", "order_creation_time"]
+
+COUNT_PATTERN = re.compile(r"^(\d+)([KMB]?)$", re.IGNORECASE)
+SUFFIXES = {"": 1, "K": 1000, "M": 1000000, "B": 1000000000}
+
+
+def parse_count(value: str) -> int:
+    """Reads counts like "5000", "250K" or "10M" """
+    match = COUNT_PATTERN.match(str(value).strip())
+    if not match:
+        raise ValueError(f"Invalid count: {value}")
+    return int(match.group(1)) * SUFFIXES[match.group(2).upper()]
+
+
+def parse_range(value: str) -> tuple:
+    """Reads "1..20" as (1, 20) and "3" as (3, 3)"""
+    low, _, high = str(value).partition("..")
+    try:
+        low, high = int(low), int(high or low)
+    except ValueError as error:
+        raise ValueError(f"Invalid range: {value}") from error
+    if low < 0 or high < low:
+        raise ValueError(f"Invalid range: {value}")
+    return low, high
+
+
+def _cumulative(weights) -> list:
+    return list(itertools.accumulate(weights))
+
+
+class OrderGenerator:
+    """Draws the rows of synthetic orders, one chunk at a time
+
+    Args:
+        seed (int): the same seed always produces the same orders
+        items_per_order (tuple): the least and most items an order has
+        customers (int): customer ids run from 1 to this
+        days (int): orders are spread over this many days before `now`
+        now (datetime): the end of the time window
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+        self, seed: int, items_per_order: tuple, customers: int, days: int, now: datetime
+    ):
+        self.seed = seed
+        self.items_per_order = items_per_order
+        self.now = now
+        self.window = days * 86400
+        ids = range(1, customers + 1)
+        self.customers = (ids, _cumulative(1 / rank for rank in ids))
+        catalog = random.Random(f"{seed}:catalog")
+        products = [
+            (f"product-{number}", round(catalog.lognormvariate(3, 1), 2), f"Synthetic product {number}")
+            for number in range(1, CATALOG_SIZE + 1)
+        ]
+        self.products = (products, _cumulative(1 / rank for rank in range(1, CATALOG_SIZE + 1)))
+        self.statuses = [status for status, _ in STATUS_MIX]
+
+    def draw(self, number: int, count: int) -> list:
+        """Draws (customer_id, status, created, updated, [(product, quantity)]) for the orders of a chunk"""
+        rng = random.Random(f"{self.seed}:{number}")
+        low, high = self.items_per_order
+        counts = [rng.randint(low, high) for _ in range(count)]
+        customers = rng.choices(self.customers[0], cum_weights=self.customers[1], k=count)
+        statuses = rng.choices(self.statuses, [share for _, share in STATUS_MIX], k=count)
+        lines = zip(
+            rng.choices(self.products[0], cum_weights=self.products[1], k=sum(counts)),
+            rng.choices(range(1, 6), QUANTITY_WEIGHTS, k=sum(counts)),
+        )
+        return [
+            (customer_id, status, *self._times(rng, status), list(itertools.islice(lines, item_count)))
+            for customer_id, status, item_count in zip(customers, statuses, counts)
+        ]
+
+    def _times(self, rng, status: str) -> tuple:
+        # a triangular spread with its mode at `now`: business grows
+        created = self.now - timedelta(seconds=rng.triangular(0, self.window, 0))
+        if status == "submitted":
+            return created, created
+        return created, min(created + timedelta(seconds=rng.uniform(0, 7 * 86400)), self.now)
+
+    def chunk(self, number: int, first_id: int, count: int) -> tuple:
+        """Returns the order and item rows of one chunk as lists of tuples"""
+        orders, items = [], []
+        for order_id, (customer_id, status, created, updated, lines) in zip(
+            itertools.count(first_id), self.draw(number, count)
+        ):
+            items.extend((order_id, *product, quantity, created) for product, quantity in lines)
+            total = sum(product[1] * quantity for product, quantity in lines)
+            orders.append((order_id, customer_id, status, created, updated, round(total, 2)))
+        return orders, items
+
+
+def _load(connection, table, columns: list, rows: list):
+    """Bulk inserts rows of a chunk into a table"""
+    if _supports_copy(connection.engine):
+        cursor = connection.connection.driver_connection.cursor()
+        with cursor.copy(f'COPY "{table.name}" ({", ".join(columns)}) FROM STDIN') as copy:
+            for row in rows:
+                copy.write_row(row)
+    elif rows:
+        connection.execute(insert(table), [dict(zip(columns, row)) for row in rows])
+
+
+def load_chunk(generator: OrderGenerator, number: int, first_id: int, count: int) -> int:
+    """Generates and commits one chunk, returns how many items it had"""
+    orders, items = generator.chunk(number, first_id, count)
+    with db.engine.begin() as connection:
+        _load(connection, Order.__table__, ORDER_COLUMNS, orders)
+        _load(connection, Item.__table__, ITEM_COLUMNS, items)
+    return len(items)
+
+
+# Set in each worker process by _init_worker
+_worker = {}
+
+
+def _init_worker(app, generator):
+    dispose_engines(app)  # the parent's pooled connections are not ours
+    _worker["context"] = app.app_context()
+    _worker["context"].push()
+    _worker["generator"] = generator
+
+
+def _load_in_worker(arguments: tuple) -> tuple:
+    number, first_id, count = arguments
+    return count, load_chunk(_worker["generator"], number, first_id, count)
+
+
+def seed_orders(app, orders: int, generator: OrderGenerator, processes: int = 1, progress=None) -> dict:
+    """Adds `orders` synthetic orders after the highest order id, archived ones included
+
+    Args:
+        app (Flask): the app whose database is filled
+        generator (OrderGenerator): draws the rows
+        processes (int): load chunks in this many processes at once
+        progress (callable): called with the orders loaded so far after each chunk
+    Returns:
+        dict: the first and last order ids and how many orders and items were added
+    """
+    first_id = db.session.scalar(select(highest_order_id())) + 1
+    db.session.remove()
+    chunks = [
+        (number, first_id + start, min(SEED_CHUNK_SIZE, orders - start))
+        for number, start in enumerate(range(0, orders, SEED_CHUNK_SIZE))
+    ]
+    logger.info("Seeding %d orders in %d chunks from id %d", orders, len(chunks), first_id)
+    loaded, items = 0, 0
+    if processes > 1:
+        # fork, so the workers inherit the app instead of importing it again
+        with multiprocessing.get_context("fork").Pool(processes, _init_worker, (app, generator)) as pool:
+            for count, item_count in pool.imap_unordered(_load_in_worker, chunks):
+                loaded, items = loaded + count, items + item_count
+                if progress:
+                    progress(loaded)
+    else:
+        for number, start, count in chunks:
+            items += load_chunk(generator, number, start, count)
+            loaded += count
+            if progress:
+                progress(loaded)
+
+    if db.engine.dialect.name == "postgresql":
+        _after_load()
+    return {"first_id": first_id, "last_id": first_id + orders - 1, "orders": loaded, "items": items}
+
+
+def _after_load():
+    """Moves the order id sequence past the loaded ids, never back, and refreshes the statistics"""
+    with db.engine.begin() as connection:
+        sequence = db.func.pg_get_serial_sequence('"order"', "id")
+        connection.execute(
+            select(db.func.setval(sequence, db.func.greatest(highest_order_id(), db.func.nextval(sequence))))
+        )
+        connection.execute(text('ANALYZE "order"'))
+        connection.execute(text("ANALYZE item"))
@@ -0,0 +1,13 @@
+"""
+Test Suites
+
+The logs the service writes by default go to a temporary folder, so test
+runs leave nothing behind in the working directory.
+"""
+import os
+import atexit
+import tempfile
+
+_logs = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+atexit.register(_logs.cleanup)
+os.environ.setdefault("SLOW_QUERY_LOG", os.path.join(_logs.name, "slow_queries.log"))
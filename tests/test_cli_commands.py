@@ -2,15 +2,39 @@
 CLI Command Extensions for Flask
 """
 import os
+import json
+import tempfile
+from datetime import date, datetime
 from unittest import TestCase
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, ANY
 from click.testing import CliRunner
-from service.common.cli_commands import db_create
+from service import app
+from service.common.cli_commands import (
+    db_create,
+    export_orders_command,
+    import_orders_command,
+    archive_orders_command,
+    create_partitions_command,
+    detach_partitions_command,
+    slow_queries_command,
+    seed_orders_command,
+    memory_report_command,
+)
 
 
 class TestFlaskCLI(TestCase):
     """Test Flask CLI Commands"""
 
+    @classmethod
+    def setUpClass(cls):
+        """The commands run inside the app context the flask CLI provides"""
+        cls.context = app.app_context()
+        cls.context.push()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.context.pop()
+
     def setUp(self):
         self.runner = CliRunner()
 
@@ -21,3 +45,146 @@ class TestFlaskCLI(TestCase):
         with patch.dict(os.environ, {"FLASK_APP": "service:app"}, clear=True):
             result = self.runner.invoke(db_create)
             self.assertEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.export_orders')
+    def test_export_orders(self, export_mock):
+        """It should stream the export to the output file"""
+        export_mock.return_value = iter([b"order_id,customer_id\n", b"1,2\n"])
+        result = self.runner.invoke(export_orders_command, ["--format", "csv"])
+        self.assertEqual(result.exit_code, 0)
+        export_mock.assert_called_once_with("csv")
+        self.assertEqual(result.output, "order_id,customer_id\n1,2\n")
+
+    def test_export_orders_bad_format(self):
+        """It should reject an unknown export format"""
+        result = self.runner.invoke(export_orders_command, ["--format", "xml"])
+        self.assertNotEqual(result.exit_code, 0)
+
+    @patch('service.common.cli_commands.import_orders')
+    def test_import_orders(self, import_mock):
+        """It should import a file and report the throughput"""
+        import_mock.return_value = {
+            "rows": 3, "orders": 2, "items": 1, "rejected": 1, "seconds": 0.5, "rows_per_second": 6
+        }
+        with self.runner.isolated_filesystem():
+            with open("orders.ndjson", "w", encoding="utf-8") as orders:
+                orders.write("{}\n")
+            result = self.runner.invoke(import_orders_command, ["orders.ndjson"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(import_mock.call_args.args[1], "ndjson")
+        self.assertEqual(import_mock.call_args.args[2], "orders.ndjson.rejects.csv")
+        self.assertIn("6 rows/sec", result.output)
+        self.assertIn("Rejected 1 rows", result.output)
+
+    @patch('service.common.cli_commands.import_orders')
+    def test_import_orders_csv(self, import_mock):
+        """It should default to CSV and honor --rejects"""
+        import_mock.return_value = {
+            "rows": 1, "orders": 1, "items": 0, "rejected": 0, "seconds": 0.1, "rows_per_second": 10
+        }
+        with self.runner.isolated_filesystem():
+            with open("orders.txt", "w", encoding="utf-8") as orders:
+                orders.write("order_id\n")
+            result = self.runner.invoke(import_orders_command, ["orders.txt", "--rejects", "bad.csv"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(import_mock.call_args.args[1:], ("csv", "bad.csv"))
+        self.assertNotIn("Rejected", result.output)
+
+    @patch('service.common.cli_commands.partitions')
+    def test_create_partitions(self, partitions_mock):
+        """It should pre-create the requested monthly partitions"""
+        partitions_mock.is_partitioned.return_value = True
+        partitions_mock.create_partitions.return_value = [date(2024, 1, 1), date(2024, 2, 1)]
+        result = self.runner.invoke(create_partitions_command, ["--start", "2024-01", "--months", "2"])
+        self.assertEqual(result.exit_code, 0)
+        partitions_mock.create_partitions.assert_called_once_with(ANY, date(2024, 1, 1), 2)
+        self.assertIn("2024-01, 2024-02", result.output)
+
+    @patch('service.common.cli_commands.partitions')
+    def test_detach_partitions(self, partitions_mock):
+        """It should drop the partitions of months before the cutoff"""
+        partitions_mock.is_partitioned.return_value = True
+        partitions_mock.detach_partitions.return_value = [date(2023, 11, 1)]
+        result = self.runner.invoke(detach_partitions_command, ["--before", "2023-12", "--drop"])
+        self.assertEqual(result.exit_code, 0)
+        partitions_mock.detach_partitions.assert_called_once_with(ANY, date(2023, 12, 1), True)
+        self.assertIn("Dropped 1 months: 2023-11", result.output)
+
+    @patch('service.common.cli_commands.partitions')
+    def test_partitions_not_partitioned(self, partitions_mock):
+        """It should refuse to manage partitions of plain tables"""
+        partitions_mock.is_partitioned.return_value = False
+        result = self.runner.invoke(detach_partitions_command, ["--before", "2023-12"])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn("not partitioned", result.output)
+        result = self.runner.invoke(create_partitions_command, [])
+        self.assertEqual(result.exit_code, 1)
+
+    @patch('service.common.cli_commands.archive_orders')
+    def test_archive_orders(self, archive_mock):
+        """It should archive finished orders older than the given days"""
+        archive_mock.return_value = 12
+        result = self.runner.invoke(archive_orders_command, ["--days", "30", "--batch-size", "5"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual(archive_mock.call_args.args[0], 30)
+        self.assertEqual(archive_mock.call_args.args[2], 5)
+        self.assertIn("Archived 12 orders", result.output)
+
+    def test_slow_queries(self):
+        """It should summarize the slow query log with the plans"""
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "slow.log")
+            result = self.runner.invoke(slow_queries_command, ["--log", path])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn("No slow queries", result.output)
+            with open(path, "w", encoding="utf-8") as log:
+                for duration in (250.0, 350.0):
+                    record = {"statement": "SELECT * FROM item", "duration_ms": duration, "route": "GET /api/orders",
+                              "parameters": [], "plan": ["SCAN item"]}
+                    log.write(json.dumps(record) + "\n")
+            result = self.runner.invoke(slow_queries_command, ["--log", path, "--plans"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("2 slow queries", result.output)
+        self.assertIn("#1 2 runs, 600.0 ms total", result.output)
+        self.assertIn("SCAN item", result.output)
+
+    @patch('service.common.cli_commands.seed_orders')
+    def test_seed_orders(self, seed_mock):
+        """It should parse the sizes and seed the orders"""
+        seed_mock.return_value = {"first_id": 1, "last_id": 2000000, "orders": 2000000, "items": 21000000}
+        result = self.runner.invoke(
+            seed_orders_command,
+            ["--orders", "2M", "--items-per-order", "1..20", "--until", "2024-06-01", "--processes", "4"],
+        )
+        self.assertEqual(result.exit_code, 0)
+        _, orders, generator, processes = seed_mock.call_args.args
+        self.assertEqual((orders, processes), (2000000, 4))
+        self.assertEqual(generator.items_per_order, (1, 20))
+        self.assertEqual(generator.now, datetime(2024, 6, 1))
+        self.assertIn("Seeded 2000000 orders (ids 1-2000000) with 21000000 items", result.output)
+
+    def test_seed_orders_bad_range(self):
+        """It should reject a malformed item range"""
+        result = self.runner.invoke(seed_orders_command, ["--items-per-order", "20..1"])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("Invalid range", result.output)
+
+    def test_memory_report(self):
+        """It should summarize the memory profile with the safe result size"""
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "memory.log")
+            result = self.runner.invoke(memory_report_command, ["--log", path])
+            self.assertIn("No memory profile", result.output)
+            with open(path, "w", encoding="utf-8") as log:
+                for results in (10, 20, 40):
+                    record = {"route": "GET /api/orders", "results": results, "peak_bytes": 1024 + results * 10240,
+                              "resident_bytes": 40 * 1024 * 1024, "operations": {"Order.all": results * 10240},
+                              "sites": [{"site": "service/models.py:270", "bytes": 2048, "blocks": 4}]}
+                    log.write(json.dumps(record) + "\n")
+            result = self.runner.invoke(memory_report_command, ["--log", path, "--limit-mb", "64"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("GET /api/orders: 3 requests, 10-40 results", result.output)
+        self.assertIn("peak ~ 1.0 KiB + 10.0 KiB per result", result.output)
+        self.assertIn("safe maximum: 2457 results with 40.0 MiB resident", result.output)
+        self.assertIn("Order.all: 400.0 KiB max", result.output)
+        self.assertIn("6.0 KiB  service/models.py:270", result.output)
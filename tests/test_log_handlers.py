@@ -0,0 +1,158 @@
+"""
+Log Handlers Test Suite
+"""
+import io
+import json
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from flask import Flask
+from service import app, config
+from service.common import log_handlers, tracing
+from service.common.log_handlers import JsonFormatter, LogRule, SamplingFilter, init_logging
+
+GUNICORN_LOGGER = "tests.gunicorn"
+
+
+def make_record(message: str, level: int = logging.INFO, created: float = 1000.0, **extra):
+    """A log record as the flask.app logger would make it"""
+    record = logging.makeLogRecord(
+        {"name": "flask.app", "msg": message, "args": (), "levelno": level, "levelname": logging.getLevelName(level)}
+    )
+    record.created = created
+    record.__dict__.update(extra)
+    return record
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogFilters(TestCase):
+    """Structured log formatting and sampling Tests"""
+
+    def test_json_format(self):
+        """It should write a record as one JSON object with its trace"""
+        record = make_record("Order %s", logging.ERROR, trace_id="abc", exc_info=(ValueError, ValueError("bad"), None))
+        record.args = (7,)
+        entry = json.loads(JsonFormatter().format(record))
+        self.assertEqual(entry["message"], "Order 7")
+        self.assertEqual(entry["level"], "ERROR")
+        self.assertEqual(entry["logger"], "flask.app")
+        self.assertEqual(entry["trace_id"], "abc")
+        self.assertIn("ValueError: bad", entry["exception"])
+        self.assertNotIn("suppressed", entry)
+
+    def test_sampling(self):
+        """It should keep a share of the matching messages and every warning"""
+        log_filter = SamplingFilter([LogRule("Processing lookup", rate=0.0), LogRule("Processing", rate=1.0)])
+        self.assertFalse(log_filter.filter(make_record("Processing lookup for id %s ...")))
+        self.assertTrue(log_filter.filter(make_record("Processing lookup for id %s ...", logging.WARNING)))
+        self.assertTrue(log_filter.filter(make_record("Processing all records")))
+        self.assertTrue(log_filter.filter(make_record("Creating an order")))
+
+    def test_sampled_share(self):
+        """It should mark the records it keeps with the share they stand for"""
+        log_filter = SamplingFilter([LogRule("Processing", rate=0.25)])
+        record = make_record("Processing all records")
+        with patch("service.common.log_handlers.random.random", return_value=0.1):
+            self.assertTrue(log_filter.filter(record))
+        self.assertEqual(record.sample_rate, 0.25)
+
+    def test_rate_limit(self):
+        """It should drop matching messages over the limit and count them"""
+        rule = LogRule("Processing", per_second=2)
+        allowed = [rule.allow(make_record("Processing", created=1000.0)) for _ in range(5)]
+        self.assertEqual(allowed, [True, True, False, False, False])
+        record = make_record("Processing", created=1001.0)
+        self.assertTrue(rule.allow(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_sampling_rules(self):
+        """It should group the settings by logger"""
+        rules = log_handlers.sampling_rules({"flask.app:Processing": 0.1, "sqlalchemy": 0.5}, {"flask.app:Processing": 5})
+        self.assertEqual(sorted(rules), ["flask.app", "sqlalchemy"])
+        rule = rules["flask.app"][0]
+        self.assertEqual((rule.prefix, rule.rate, rule.per_second), ("Processing", 0.1, 5))
+        self.assertEqual(rules["sqlalchemy"][0].prefix, "")
+
+
+class TestQueuedLogging(TestCase):
+    """Queued JSON logging Tests"""
+
+    def setUp(self):
+        self.output = io.StringIO()
+        self.gunicorn_logger = logging.getLogger(GUNICORN_LOGGER)
+        self.gunicorn_logger.handlers = [logging.StreamHandler(self.output)]
+        self.gunicorn_logger.setLevel(logging.INFO)
+        self.app = Flask("queued_logging")
+        self.app.config.from_object(config)
+        self.app.config.update(LOG_FORMAT="json", LOG_QUEUE=True, LOG_SAMPLING={"flask.app:Processing": 0.0})
+
+    def tearDown(self):
+        log_handlers.stop_queue()
+        self.gunicorn_logger.handlers = []
+        # back to the logging of the service app
+        init_logging(app, "gunicorn.error")
+
+    def _entries(self) -> list:
+        log_handlers.stop_queue()
+        return [json.loads(line) for line in self.output.getvalue().splitlines()]
+
+    def test_queued_json(self):
+        """It should write the app and service loggers through the queue as JSON"""
+        init_logging(self.app, GUNICORN_LOGGER)
+        self.assertIsInstance(self.app.logger.handlers[0], log_handlers.NonBlockingQueueHandler)
+        logging.getLogger("flask.app").info("Creating an order")
+        logging.getLogger("flask.app").info("Processing lookup for id %s ...", 1)
+        logging.getLogger("flask.app").warning("Processing took %d ms", 900)
+        messages = [entry["message"] for entry in self._entries()]
+        self.assertEqual(messages, ["Logging handler established", "Creating an order", "Processing took 900 ms"])
+
+    def test_trace_ids(self):
+        """It should stamp the records of a traced request with its ids"""
+        init_logging(self.app, GUNICORN_LOGGER)
+        tracer = tracing.Tracer(tracing.InMemoryExporter(), sample_rate=1.0)
+        span = tracer.start_trace("GET /")
+        self.app.logger.info("Request for Order list")
+        span.finish()
+        entry = self._entries()[-1]
+        self.assertEqual(entry["trace_id"], span.context.trace_id)
+        self.assertEqual(entry["span_id"], span.context.span_id)
+
+    def test_exception_after_fork(self):
+        """It should keep logging exceptions and stacks through a new queue in a forked worker"""
+        init_logging(self.app, GUNICORN_LOGGER)
+        handler = self.app.logger.handlers[0]
+        inherited = handler.queue
+        log_handlers._restart_after_fork()  # pylint: disable=protected-access
+        self.assertIsNot(handler.queue, inherited)
+        try:
+            raise ValueError("bad order")
+        except ValueError:
+            self.app.logger.exception("Order failed")
+        self.app.logger.warning("Slow order", stack_info=True)
+        entries = self._entries()
+        self.assertIn("ValueError: bad order", entries[-2]["exception"])
+        self.assertIn("test_exception_after_fork", entries[-1]["stack"])
+
+    def test_full_queue(self):
+        """It should drop records instead of waiting and report how many"""
+        self.app.config["LOG_QUEUE_SIZE"] = 1
+        init_logging(self.app, GUNICORN_LOGGER)
+        handler = self.app.logger.handlers[0]
+        log_handlers.stop_queue()  # nobody takes records off the queue now
+        handler.queue.put_nowait(make_record("filler"))
+        for _ in range(3):
+            self.app.logger.info("lost")
+        self.assertEqual(handler.dropped, 3)
+        handler.queue.get_nowait()
+        self.app.logger.info("kept")
+        self.assertEqual(handler.queue.get_nowait().dropped, 3)
+        self.assertEqual(handler.dropped, 0)
+
+    def test_text_without_queue(self):
+        """It should write text synchronously when the queue is off"""
+        self.app.config.update(LOG_FORMAT="text", LOG_QUEUE=False)
+        init_logging(self.app, GUNICORN_LOGGER)
+        self.assertIs(self.app.logger.handlers[0], self.gunicorn_logger.handlers[0])
+        self.assertIn("[INFO] [log_handlers] Logging handler established", self.output.getvalue())
@@ -0,0 +1,137 @@
+"""
+Memory Profiling Test Suite
+"""
+import os
+import tempfile
+import tracemalloc
+from unittest import TestCase
+from service.common import status  # HTTP Status Codes
+from service.common import memory_profiling, tracing
+from service.common.memory_profiling import RequestMemory, fit, safe_results, summarize
+from service.common.slow_queries import read_log
+from tests.factories import OrderFactory, ItemFactory
+from tests.helpers import AppTestCase, build_app
+
+BASE_URL = "/api/orders"
+KIB = 1024
+
+
+def record(route: str, results: int, peak: int, **extra) -> dict:
+    """A memory profile record as record_request writes it"""
+    return {"route": route, "results": results, "peak_bytes": peak, "resident_bytes": 40 * KIB * KIB,
+            "operations": {}, "sites": [], **extra}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRequestMemory(TestCase):
+    """Peak allocation accounting Tests"""
+
+    def setUp(self):
+        self.started = not tracemalloc.is_tracing()
+        if self.started:
+            tracemalloc.start()
+
+    def tearDown(self):
+        if self.started:
+            tracemalloc.stop()
+
+    def test_nested_peaks(self):
+        """It should keep the peak of an operation in the request's peak"""
+        memory = RequestMemory(sites=3)
+        scope = memory.enter("Order.all")
+        block = bytearray(512 * KIB)
+        del block
+        operation_peak = memory.exit(scope)
+        kept = bytearray(64 * KIB)
+        request_peak = memory.exit(memory.root)
+        self.assertGreaterEqual(operation_peak, 512 * KIB)
+        self.assertGreaterEqual(request_peak, operation_peak)
+        self.assertLess(request_peak, operation_peak + 64 * KIB * 4)
+        sites = memory.top_sites()
+        self.assertTrue(sites[0]["site"].startswith("tests/test_memory_profiling.py:"), sites)
+        self.assertGreaterEqual(sites[0]["bytes"], 64 * KIB)
+        self.assertEqual(len(kept), 64 * KIB)
+
+    def test_fit(self):
+        """It should fit peak memory against result size"""
+        curve = fit([10, 20, 40], [3000, 5000, 9000])
+        self.assertAlmostEqual(curve["intercept"], 1000)
+        self.assertAlmostEqual(curve["slope"], 200)
+        self.assertAlmostEqual(curve["r_squared"], 1.0)
+        self.assertIsNone(fit([5, 5], [100, 200]))
+        self.assertEqual(safe_results(curve, 5000, 21000), 75)
+        self.assertEqual(safe_results(curve, 30000, 21000), 0)
+        self.assertIsNone(safe_results(None, 0, 21000))
+
+    def test_summarize(self):
+        """It should group records by route, the biggest peak first"""
+        records = [
+            record("GET /api/orders", 100, 1024 * KIB, operations={"Order.all": 900 * KIB},
+                   sites=[{"site": "service/models.py:10", "bytes": 300, "blocks": 1}]),
+            record("GET /api/orders", 200, 2048 * KIB, operations={"Order.all": 1900 * KIB},
+                   sites=[{"site": "service/models.py:10", "bytes": 500, "blocks": 1}]),
+            record("GET /api/orders/<order_id>", 1, 20 * KIB),
+        ]
+        summary = summarize(records, 64 * KIB * KIB)
+        self.assertEqual([entry["route"] for entry in summary], ["GET /api/orders", "GET /api/orders/<order_id>"])
+        orders = summary[0]
+        self.assertEqual(orders["results"], (100, 200))
+        self.assertAlmostEqual(orders["curve"]["slope"], 1024 * KIB / 100)
+        self.assertEqual(orders["safe_results"], 2400)
+        self.assertEqual(orders["operations"], {"Order.all": 1900 * KIB})
+        self.assertEqual(orders["sites"], [("service/models.py:10", 800)])
+        self.assertIsNone(summary[1]["curve"])
+
+
+class TestMemoryProfiling(AppTestCase):
+    """Request memory profiling Tests"""
+
+    @classmethod
+    def setUpClass(cls):
+        """Builds an app of its own with memory profiling on"""
+        cls.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        cls.path = os.path.join(cls.folder.name, "memory.log")
+        cls.started = not tracemalloc.is_tracing()
+        cls.app = build_app(MEMORY_PROFILING=True, MEMORY_PROFILE_LOG=cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        tracing.operation_hooks.remove(memory_profiling.measure_operation)
+        memory_profiling.open_log(os.devnull, 0, 0)
+        if cls.started:
+            tracemalloc.stop()
+        cls.folder.cleanup()
+
+    def setUp(self):
+        """This runs before each test"""
+        super().setUp()
+        with open(self.path, "w", encoding="utf-8"):
+            pass
+
+    def test_records_requests(self):
+        """It should write the peak, result size and operations of every request"""
+        for customer_id in (1, 2):
+            for _ in range(customer_id * 3):
+                OrderFactory(id=None, customer_id=customer_id).create()
+        order = OrderFactory(id=None, customer_id=3)
+        order.items = ItemFactory.build_batch(4, id=None, order=None)
+        order.create()
+        for url in (f"{BASE_URL}?customer_id=1", f"{BASE_URL}?customer_id=2", f"{BASE_URL}/{order.id}"):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_200_OK)
+        records = read_log(self.path)
+        self.assertEqual([entry["results"] for entry in records], [3, 6, 4])
+        listing = records[0]
+        self.assertEqual(listing["route"], "GET /api/orders")
+        self.assertGreater(listing["peak_bytes"], 0)
+        self.assertGreaterEqual(listing["peak_bytes"], listing["operations"]["Order.find_by_customer_id"])
+        self.assertGreater(listing["response_bytes"], 0)
+        self.assertTrue(listing["sites"])
+        self.assertEqual(records[2]["route"], "GET /api/orders/<order_id>")
+        self.assertIn("Order.find", records[2]["operations"])
+
+    def test_outside_requests(self):
+        """It should not measure model operations called outside a request"""
+        OrderFactory(id=None).create()
+        self.assertEqual(read_log(self.path), [])
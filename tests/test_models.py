@@ -5,8 +5,10 @@ Test cases for YourResourceModel Model
 import os
 import logging
 import unittest
-from service import app
-from service.models import Order, Item, DataValidationError, db
+from unittest.mock import patch
+from sqlalchemy import create_engine, event, inspect, text
+from service import app, create_app
+from service.models import Order, Item, DataValidationError, db, dispose_engines, create_schema
 from tests.factories import OrderFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -159,6 +161,92 @@ class TestOrder(unittest.TestCase):
         self.assertEqual(same_account.id, order.id)
         self.assertEqual(same_account.status, order.status)
 
+    def test_find_by_cached_statement(self):
+        """It should bind new values into the cached lookup statements"""
+        first = OrderFactory(customer_id=1, status="NEW")
+        second = OrderFactory(customer_id=2, status="SHIPPED")
+        first.create()
+        second.create()
+        for order in (first, second, first):
+            found = Order.find_by_customer_id(order.customer_id)
+            self.assertEqual([same.id for same in found], [order.id])
+            found = Order.find_by_status(order.status)
+            self.assertEqual([same.id for same in found], [order.id])
+        self.assertEqual(Order.find_by_date("1999-01-01"), [])
+
+    def test_dispose_engines_after_fork(self):
+        """It should start a forked worker on a fresh pool and keep working"""
+        # an app of its own, since disposing an in-memory SQLite engine drops its database
+        worker = create_app()
+        with worker.app_context():
+            pool = db.engine.pool
+            db.session.execute(text("SELECT 1"))
+            db.session.remove()
+        dispose_engines(worker)
+        with worker.app_context():
+            self.assertIsNot(db.engine.pool, pool)
+            self.assertEqual(db.session.execute(text("SELECT 1")).scalar(), 1)
+            db.session.remove()
+
+    def test_item_order_creation_time(self):
+        """It should give Items the creation_time of their Order when partitioned"""
+        with patch.dict(app.config, ORDER_PARTITIONING=True):
+            order = OrderFactory()
+            order.items = [ItemFactory(order=None)]
+            order.create()
+            item = order.items[0]
+            self.assertEqual(item.order_creation_time, order.creation_time)
+            other = OrderFactory()
+            other.create()
+            item.order_id = other.id
+            item.update()
+            self.assertEqual(item.order_creation_time, other.creation_time)
+
+    def test_item_inserts_batched(self):
+        """It should insert the Items of an Order in one statement"""
+        inserts = []
+
+        def record(_connection, _cursor, statement, _parameters, _context, executemany):
+            if statement.startswith("INSERT INTO item"):
+                inserts.append(executemany)
+
+        order = OrderFactory()
+        order.items = ItemFactory.build_batch(5, order=None)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            with patch.dict(app.config, ORDER_PARTITIONING=True):
+                order.create()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(inserts, [True])
+
+    def test_unpartitioned_items(self):
+        """It should leave order_creation_time empty without partitioning"""
+        order = OrderFactory()
+        order.items = [ItemFactory(order=None)]
+        order.create()
+        self.assertIsNone(order.items[0].order_creation_time)
+
+    def test_find_by_date_partitioned(self):
+        """It should load only the items of the date's partitions when partitioned"""
+        with patch.dict(app.config, ORDER_PARTITIONING=True):
+            order = OrderFactory()
+            order.items = ItemFactory.build_batch(2, order=None)
+            order.create()
+            db.session.expire_all()
+            orders = Order.find_by_date(order.creation_time.strftime("%Y-%m-%d"))
+        self.assertEqual([len(found.items) for found in orders], [2])
+
+    def test_add_missing_columns(self):
+        """It should add order_creation_time to an item table made before it"""
+        engine = create_engine("sqlite://")
+        with engine.begin() as connection:
+            connection.execute(text('CREATE TABLE item (id INTEGER PRIMARY KEY, order_id INTEGER, name VARCHAR(64))'))
+            create_schema(connection, {})
+            columns = [column["name"] for column in inspect(connection).get_columns("item")]
+        self.assertIn("order_creation_time", columns)
+        engine.dispose()
+
     def test_find_by_date(self):
         """It should find all orders by date"""
         order = OrderFactory()
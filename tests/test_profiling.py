@@ -0,0 +1,98 @@
+"""
+Request Profiling Test Suite
+"""
+import os
+import time
+import tempfile
+from flask import Flask
+from werkzeug.test import Client
+from service import config
+from service.common import status  # HTTP Status Codes
+from service.common.profiling import (
+    PROFILE_HEADER, PROFILE_FILE_HEADER, ProfilingMiddleware, StackSampler, init_profiling
+)
+from tests.helpers import AppTestCase
+
+BASE_URL = "/api/orders"
+
+
+def busy_loop(seconds: float):
+    """Keeps the CPU busy in a frame of its own"""
+    until = time.perf_counter() + seconds
+    while time.perf_counter() < until:
+        pass
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestProfiling(AppTestCase):
+    """Request profiling Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+
+    def tearDown(self):
+        """This runs after each test"""
+        self.folder.cleanup()
+        super().tearDown()
+
+    def _client(self, **options):
+        return Client(ProfilingMiddleware(self.app.wsgi_app, self.folder.name, **options))
+
+    def test_profile_on_request(self):
+        """It should profile a request that sends the profiling token"""
+        client = self._client(token="secret", mode="trace")
+        resp = client.get(BASE_URL, headers={PROFILE_HEADER: "secret"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp.close()
+        name = resp.headers[PROFILE_FILE_HEADER]
+        self.assertEqual(os.listdir(self.folder.name), [name])
+        with open(os.path.join(self.folder.name, name), encoding="utf-8") as profile:
+            lines = profile.read().splitlines()
+        self.assertTrue(lines)
+        stack, weight = lines[0].rsplit(" ", 1)
+        self.assertGreater(int(weight), 0)
+        self.assertTrue(any("service/routes.py" in line for line in lines))
+        self.assertTrue(all(frame.endswith(")") for frame in stack.split(";")))
+
+    def test_not_profiled(self):
+        """It should leave requests alone without a valid token or a sample"""
+        client = self._client(token="secret")
+        for headers in ({}, {PROFILE_HEADER: "guess"}):
+            resp = client.get(BASE_URL, headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotIn(PROFILE_FILE_HEADER, resp.headers)
+        # without a token the header means nothing
+        self._client().get(BASE_URL, headers={PROFILE_HEADER: ""})
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+    def test_sampled(self):
+        """It should profile a share of the requests"""
+        resp = self._client(rate=1.0).get(BASE_URL)
+        resp.close()
+        self.assertIn(PROFILE_FILE_HEADER, resp.headers)
+        self.assertEqual(len(os.listdir(self.folder.name)), 1)
+
+    def test_stack_sampler(self):
+        """It should count the stacks the sampled thread is in"""
+        sampler = StackSampler(0.001)
+        sampler.start()
+        busy_loop(0.1)
+        sampler.stop()
+        self.assertTrue(sampler.stacks)
+        self.assertTrue(any("busy_loop" in stack[-1] for stack in sampler.stacks))
+
+    def test_init_profiling(self):
+        """It should only wrap the app when profiling is on"""
+        flask_app = Flask(__name__)
+        flask_app.config.from_object(config)
+        wsgi_app = flask_app.wsgi_app
+        init_profiling(flask_app)
+        self.assertNotIsInstance(flask_app.wsgi_app, ProfilingMiddleware)
+        flask_app.config["PROFILING"] = True
+        init_profiling(flask_app)
+        self.assertIsInstance(flask_app.wsgi_app, ProfilingMiddleware)
+        self.assertRaises(ValueError, ProfilingMiddleware, wsgi_app, self.folder.name, mode="cprofile")
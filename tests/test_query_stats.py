@@ -0,0 +1,86 @@
+"""
+Per-request Query Accounting Test Suite
+"""
+import logging
+from unittest import TestCase
+from unittest.mock import patch
+from service.common import status  # HTTP Status Codes
+from service.common.query_stats import RequestQueries, QueryBudgetExceeded
+from tests.factories import OrderFactory, ItemFactory
+from tests.helpers import AppTestCase
+
+BASE_URL = "/api/orders"
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRequestQueries(TestCase):
+    """Query accounting Tests"""
+
+    def test_statement_shapes(self):
+        """It should count statements that differ only in layout as one shape"""
+        queries = RequestQueries()
+        queries.record("SELECT item.id FROM item\n WHERE item.order_id = ?", 0.002)
+        queries.record("SELECT item.id  FROM item WHERE item.order_id = ?", 0.001)
+        self.assertEqual(queries.count, 2)
+        self.assertAlmostEqual(queries.duration, 0.003)
+        self.assertEqual(len(queries.shapes), 1)
+
+    def test_problems(self):
+        """It should report going over the budget and repeated statements"""
+        queries = RequestQueries()
+        for _ in range(3):
+            queries.record("SELECT 1", 0.0)
+        queries.record("SELECT 2", 0.0)
+        self.assertEqual(queries.problems(4, 3), ["3 times: SELECT 1"])
+        self.assertEqual(len(queries.problems(3, 0)), 1)
+        self.assertIn("over its budget of 3", queries.problems(3, 0)[0])
+        self.assertEqual(queries.problems(0, 0), [])
+
+    def test_server_timing(self):
+        """It should describe the database time in Server-Timing syntax"""
+        queries = RequestQueries()
+        queries.record("SELECT 1", 0.0125)
+        self.assertTrue(queries.server_timing().startswith('db;dur=12.5;desc="1 queries", app;dur='))
+
+
+class TestQueryBudgets(AppTestCase):
+    """Query budget enforcement Tests"""
+
+    def _create_orders(self, count: int):
+        for _ in range(count):
+            order = OrderFactory()
+            order.items = ItemFactory.build_batch(2)
+            order.create()
+
+    def test_server_timing_header(self):
+        """It should tell the client how many statements a request ran"""
+        self._create_orders(1)
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('desc="2 queries"', resp.headers["Server-Timing"])
+
+    def test_listing_does_not_fan_out(self):
+        """It should list any number of Orders with the same statements"""
+        self._create_orders(5)
+        with patch.dict(self.app.config, {"QUERY_STRICT": True, "QUERY_REPEAT_LIMIT": 2}):
+            resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 5)
+
+    def test_strict_budget(self):
+        """It should fail a request over its budget in strict mode"""
+        self._create_orders(1)
+        budgets = {"QUERY_STRICT": True, "QUERY_BUDGETS": {"orders_collection": 1}}
+        with patch.dict(self.app.config, budgets):
+            self.assertRaises(QueryBudgetExceeded, self.client.get, BASE_URL)
+
+    def test_budget_warning(self):
+        """It should only log a warning outside strict mode"""
+        self._create_orders(1)
+        with patch.dict(self.app.config, {"QUERY_BUDGETS": {"orders_collection": 1}}):
+            with self.assertLogs("flask.app", logging.WARNING) as logs:
+                resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn("over its budget of 1", logs.output[-1])
@@ -0,0 +1,251 @@
+"""
+Rate Limiting Test Suite
+"""
+import os
+from unittest import TestCase
+from unittest.mock import patch
+from sqlalchemy import event
+from service import config, create_app
+from service.models import db
+from service.common import status  # HTTP Status Codes
+from service.common.rate_limits import (
+    API_KEY_HEADER, TokenBuckets, RateLimiter, caller_keys, load_backend, init_rate_limits
+)
+from tests.factories import OrderFactory
+from tests.helpers import AppTestCase, build_app
+
+BASE_URL = "/api/orders"
+
+
+class Clock:
+    """A monotonic clock the tests move by hand"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds: float):
+        """Moves the clock forward"""
+        self.now += seconds
+
+
+class FailingBuckets:  # pylint: disable=too-few-public-methods
+    """A shared backend that cannot be reached"""
+
+    def take(self, key, capacity, rate):
+        """Fails like a lost Redis connection"""
+        raise ConnectionError(f"cannot take {key} {capacity} {rate}")
+
+
+def failing_backend(_app):
+    """A module:factory for RATE_LIMIT_BACKEND"""
+    return FailingBuckets()
+
+
+######################################################################
+#  T O K E N   B U C K E T S
+######################################################################
+class TestTokenBuckets(TestCase):
+    """Token bucket Tests"""
+
+    def setUp(self):
+        self.clock = Clock()
+        patcher = patch("service.common.rate_limits.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.buckets = TokenBuckets()
+
+    def test_burst_then_wait(self):
+        """It should allow a burst of the capacity and then tell how long to wait"""
+        waits = [self.buckets.take("caller", 3, 0.5) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 2.0)
+
+    def test_refill(self):
+        """It should refill at the rate, up to the capacity"""
+        for _ in range(3):
+            self.buckets.take("caller", 3, 1)
+        self.clock.advance(1.5)
+        self.assertEqual(self.buckets.take("caller", 3, 1), 0)
+        self.assertAlmostEqual(self.buckets.take("caller", 3, 1), 0.5)
+        self.clock.advance(3600)
+        waits = [self.buckets.take("caller", 3, 1) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertGreater(waits[3], 0)
+
+    def test_separate_callers(self):
+        """It should keep a bucket for every key"""
+        self.buckets.take("one", 1, 1)
+        self.assertGreater(self.buckets.take("one", 1, 1), 0)
+        self.assertEqual(self.buckets.take("two", 1, 1), 0)
+
+    def test_prune(self):
+        """It should forget the buckets that filled up again when tracking too many"""
+        buckets = TokenBuckets(max_keys=2)
+        buckets.take("busy", 1, 0.001)
+        buckets.take("idle", 2, 1)
+        self.clock.advance(2)
+        buckets.take("new", 2, 1)
+        self.assertGreater(buckets.take("busy", 1, 0.001), 0)
+        self.assertNotIn("idle", buckets._buckets)  # pylint: disable=protected-access
+
+
+######################################################################
+#  R A T E   L I M I T E R
+######################################################################
+class TestRateLimiter(TestCase):
+    """Rate limiter Tests"""
+
+    def test_limits(self):
+        """It should use the endpoint's own limit, the default, or none"""
+        limiter = RateLimiter(TokenBuckets(), {"*": (10, 1), "orders_collection": (2, 0.5), "export_resource": (5, 0)}, [])
+        self.assertEqual(limiter.limit("orders_collection"), (2, 0.5))
+        self.assertEqual(limiter.limit("orders_resource"), (10, 1))
+        self.assertIsNone(limiter.limit("export_resource"))
+        self.assertIsNone(limiter.limit("service.health"))
+        self.assertIsNone(RateLimiter(TokenBuckets(), {"orders_collection": (2, 1)}, []).limit("items_collection"))
+
+    def test_caller_keys(self):
+        """It should name the caller by the first key the request has, and always by its ip"""
+        app = create_app()
+        keys = ["api_key", "customer_id", "ip"]
+        known = RateLimiter(TokenBuckets(), {}, keys, ["secret"]).api_keys
+        address = {"REMOTE_ADDR": "10.0.0.9"}
+        with app.test_request_context(f"{BASE_URL}?customer_id=7", headers={API_KEY_HEADER: "secret"}, environ_base=address):
+            callers = caller_keys(keys, known)
+            self.assertTrue(callers[0].startswith("api_key:"))
+            self.assertNotIn("secret", callers[0])
+            self.assertEqual(callers[1], "ip:10.0.0.9")
+            # a key nobody configured is no key at all
+            self.assertEqual(caller_keys(keys), ["customer_id:7", "ip:10.0.0.9"])
+        with app.test_request_context(BASE_URL, method="POST", json={"customer_id": 8}, environ_base=address):
+            self.assertEqual(caller_keys(keys), ["customer_id:8", "ip:10.0.0.9"])
+        with app.test_request_context(BASE_URL, headers={API_KEY_HEADER: "guess"}, environ_base=address):
+            self.assertEqual(caller_keys(keys, known), ["ip:10.0.0.9"])
+            self.assertEqual(caller_keys(["customer_id"]), ["ip:10.0.0.9"])
+
+    def test_load_backend(self):
+        """It should build the memory backend, or one from module:factory"""
+        app = create_app()
+        self.assertIsInstance(load_backend(app), TokenBuckets)
+        app.config["RATE_LIMIT_BACKEND"] = "tests.test_rate_limits:failing_backend"
+        self.assertIsInstance(load_backend(app), FailingBuckets)
+        app.config["RATE_LIMIT_BACKEND"] = "nowhere"
+        self.assertRaises(ValueError, load_backend, app)
+
+    def test_unknown_key(self):
+        """It should refuse caller keys it cannot read"""
+        app = create_app()
+        app.config.update(RATE_LIMITS={"*": (1, 1)}, RATE_LIMIT_KEYS=["session"])
+        self.assertRaises(ValueError, init_rate_limits, app)
+
+    def test_read_limits(self):
+        """It should read the limits from the environment and name a malformed entry"""
+        read = config._limits  # pylint: disable=protected-access
+        with patch.dict(os.environ, {"RATE_LIMITS": "*=60:10, orders_collection=20:2,"}):
+            self.assertEqual(read("RATE_LIMITS"), {"*": (60, 10), "orders_collection": (20, 2)})
+        for value in ("orders_collection=20", "orders_collection=many:2"):
+            with patch.dict(os.environ, {"RATE_LIMITS": value}):
+                with self.assertRaises(ValueError) as raised:
+                    read("RATE_LIMITS")
+                self.assertIn(f"RATE_LIMITS entries are endpoint=capacity:rate, not '{value}'", str(raised.exception))
+
+    def test_trusted_proxies(self):
+        """It should tell callers apart by X-Forwarded-For only behind trusted proxies"""
+        for proxies, expected in ((0, [200, 429]), (1, [200, 200])):
+            client = build_app(RATE_LIMITS={"service.health": (1, 0.1)}, RATE_LIMIT_TRUSTED_PROXIES=proxies).test_client()
+            responses = [
+                client.get("/health", environ_base={"REMOTE_ADDR": "10.0.0.1"}, headers={"X-Forwarded-For": caller})
+                for caller in ("203.0.113.1", "203.0.113.2")
+            ]
+            self.assertEqual([response.status_code for response in responses], expected)
+
+    def test_off(self):
+        """It should not check anything without RATE_LIMITS"""
+        self.assertNotIn("rate_limiter", create_app().extensions)
+
+
+######################################################################
+#  T H R O T T L E D   R E Q U E S T S
+######################################################################
+class TestRateLimitedRequests(AppTestCase):
+    """Rate limited request Tests"""
+
+    CONFIG = {"RATE_LIMITS": {"*": (3, 0.1), "orders_collection": (2, 0.1)}}
+
+    def setUp(self):
+        """This runs before each test"""
+        super().setUp()
+        self.app.extensions["rate_limiter"].backend = TokenBuckets()
+
+    def test_throttled(self):
+        """It should answer a caller over its limit with 429 and Retry-After"""
+        for _ in range(2):
+            self.assertEqual(self.client.get(f"{BASE_URL}?customer_id=1").status_code, status.HTTP_200_OK)
+        response = self.client.get(f"{BASE_URL}?customer_id=1")
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(response.headers["Retry-After"], "10")
+        self.assertEqual(response.get_json()["status"], status.HTTP_429_TOO_MANY_REQUESTS)
+        # other callers and endpoints keep their own buckets
+        other = self.client.get(f"{BASE_URL}?customer_id=2", environ_base={"REMOTE_ADDR": "10.0.0.2"})
+        self.assertEqual(other.status_code, status.HTTP_200_OK)
+        order = OrderFactory()
+        created = self.client.post(BASE_URL, json=order.serialize(), environ_base={"REMOTE_ADDR": "10.0.0.3"})
+        self.assertEqual(created.status_code, status.HTTP_201_CREATED)
+
+    def test_client_keys_cannot_escape(self):
+        """It should hold a caller to its ip's limit whatever keys it makes up"""
+        codes = [
+            self.client.get(f"{BASE_URL}?customer_id={number}", headers={API_KEY_HEADER: f"key-{number}"}).status_code
+            for number in range(4)
+        ]
+        self.assertEqual(codes, [200, 200, 429, 429])
+        address = {"REMOTE_ADDR": "10.0.0.4"}
+        codes = [
+            self.client.post(BASE_URL, json=OrderFactory(customer_id=number).serialize(), environ_base=address).status_code
+            for number in range(3)
+        ]
+        self.assertEqual(codes, [201, 201, 429])
+
+    def test_known_api_key(self):
+        """It should keep a configured API key's own bucket alongside the ip's"""
+        limiter = self.app.extensions["rate_limiter"]
+        limiter.api_keys = RateLimiter(limiter.backend, {}, [], ["partner"]).api_keys
+        headers = {API_KEY_HEADER: "partner"}
+        for address in ("10.0.0.1", "10.0.0.2"):
+            response = self.client.get(BASE_URL, headers=headers, environ_base={"REMOTE_ADDR": address})
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(BASE_URL, headers=headers, environ_base={"REMOTE_ADDR": "10.0.0.3"})
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_no_database_work(self):
+        """It should turn a throttled request away before any SQL runs"""
+        for _ in range(2):
+            self.client.get(f"{BASE_URL}?customer_id=1")
+        statements = []
+
+        def record(_connection, _cursor, statement, *_):
+            statements.append(statement)
+
+        with self.app.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            response = self.client.get(f"{BASE_URL}?customer_id=1")
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertEqual(statements, [])
+
+    def test_exempt(self):
+        """It should never limit the health check under the default"""
+        for _ in range(5):
+            self.assertEqual(self.client.get("/health").status_code, status.HTTP_200_OK)
+
+    def test_backend_failure(self):
+        """It should let requests through when the backend fails"""
+        self.app.extensions["rate_limiter"].backend = FailingBuckets()
+        for _ in range(3):
+            self.assertEqual(self.client.get(f"{BASE_URL}?customer_id=1").status_code, status.HTTP_200_OK)
@@ -6,12 +6,16 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import io
+import csv
+import json
 import logging
 from unittest import TestCase
 from datetime import datetime
 from service import app
 from service.models import db, init_db, Order, Item
 from service.common import status  # HTTP Status Codes
+from service.common.representations import MSGPACK_MIMETYPE, packb, unpackb
 from tests.factories import OrderFactory, ItemFactory
 
 DATABASE_URI = os.getenv(
@@ -32,6 +36,8 @@ class TestOrderItemServer(TestCase):
         """This runs once before the entire test suite"""
         app.config["TESTING"] = True
         app.config["DEBUG"] = False
+        # fail any request that runs too many or repeated statements
+        app.config["QUERY_STRICT"] = True
         # Set up the test database
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
@@ -506,3 +512,123 @@ class TestOrderItemServer(TestCase):
         """It should not cancel an order when order doesn't exist"""
         resp = self.client.put(f"{BASE_URL}/0/cancel")
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    ######################################################################
+    #  M E S S A G E P A C K   T E S T   C A S E S
+    ######################################################################
+
+    def test_json_is_default_representation(self):
+        """It should answer in JSON when no Accept header is sent"""
+        self._create_orders(1)
+        resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/json")
+
+    def test_get_order_list_msgpack(self):
+        """It should Get a list of Orders as MessagePack"""
+        self._create_orders(3)
+        resp = self.client.get(BASE_URL, headers={"Accept": MSGPACK_MIMETYPE})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, MSGPACK_MIMETYPE)
+        data = unpackb(resp.data)
+        self.assertEqual(len(data), 3)
+        json_data = self.client.get(BASE_URL).get_json()
+        self.assertEqual(data, json_data)
+
+    def test_create_order_msgpack(self):
+        """It should Create an Order from a MessagePack body"""
+        order = OrderFactory()
+        resp = self.client.post(
+            BASE_URL,
+            data=packb(order.serialize()),
+            content_type=MSGPACK_MIMETYPE,
+            headers={"Accept": MSGPACK_MIMETYPE},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        new_order = unpackb(resp.data)
+        self.assertEqual(new_order["customer_id"], order.customer_id)
+        self.assertEqual(new_order["status"], order.status)
+
+        # the same order read back as JSON must carry the same timestamps
+        resp = self.client.get(f"{BASE_URL}/{new_order['id']}")
+        self.assertEqual(resp.get_json()["creation_time"], new_order["creation_time"])
+
+    def test_add_item_msgpack(self):
+        """It should Add an item to an order from a MessagePack body"""
+        order = self._create_orders(1)[0]
+        item = ItemFactory()
+        resp = self.client.post(
+            f"{BASE_URL}/{order.id}/items",
+            data=packb(item.serialize()),
+            content_type=MSGPACK_MIMETYPE,
+            headers={"Accept": MSGPACK_MIMETYPE},
+        )
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        data = unpackb(resp.data)
+        self.assertEqual(data["order_id"], order.id)
+        self.assertAlmostEqual(data["price"], item.price)
+
+        resp = self.client.get(
+            f"{BASE_URL}/{order.id}/items", headers={"Accept": MSGPACK_MIMETYPE}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(unpackb(resp.data)), 1)
+
+    def test_bad_msgpack_body(self):
+        """It should not Create when the MessagePack body is malformed"""
+        resp = self.client.post(
+            BASE_URL, data=b"\xc1\x00", content_type=MSGPACK_MIMETYPE
+        )
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    ######################################################################
+    #  E X P O R T   T E S T   C A S E S
+    ######################################################################
+
+    def _create_order_with_items(self, count):
+        """Creates an order holding `count` items through the API"""
+        order = self._create_orders(1)[0]
+        for _ in range(count):
+            item = ItemFactory(order_id=order.id)
+            resp = self.client.post(f"{BASE_URL}/{order.id}/items", json=item.serialize())
+            self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        return order
+
+    def test_export_orders_csv(self):
+        """It should export orders and items as CSV"""
+        order = self._create_order_with_items(3)
+        self._create_orders(1)
+        resp = self.client.get(f"{BASE_URL}/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "text/csv")
+        self.assertIn("orders.csv", resp.headers["Content-Disposition"])
+        rows = list(csv.DictReader(io.StringIO(resp.get_data(as_text=True))))
+        # one row per item plus one for the order without items
+        self.assertEqual(len(rows), 4)
+        items = [row for row in rows if row["order_id"] == str(order.id)]
+        self.assertEqual(len(items), 3)
+        self.assertTrue(all(row["item_id"] for row in items))
+
+    def test_export_orders_ndjson(self):
+        """It should export orders and items as NDJSON"""
+        order = self._create_order_with_items(2)
+        resp = self.client.get(f"{BASE_URL}/export?format=ndjson")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        rows = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual({row["order_id"] for row in rows}, {order.id})
+        self.assertEqual(rows[0]["customer_id"], order.customer_id)
+
+    def test_export_orders_empty(self):
+        """It should export just the CSV header when there are no orders"""
+        resp = self.client.get(f"{BASE_URL}/export?format=csv")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("order_id,customer_id"))
+
+    def test_export_orders_bad_format(self):
+        """It should not export to an unknown format"""
+        resp = self.client.get(f"{BASE_URL}/export?format=xml")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
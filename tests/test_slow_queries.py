@@ -0,0 +1,118 @@
+"""
+Slow Query Log Test Suite
+"""
+import os
+import json
+import tempfile
+from service.models import db
+from service.common import status  # HTTP Status Codes
+from service.common import slow_queries
+from tests.factories import OrderFactory
+from tests.helpers import AppTestCase
+
+BASE_URL = "/api/orders"
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSlowQueryLog(AppTestCase):
+    """Slow query log Tests"""
+
+    def setUp(self):
+        """This runs before each test"""
+        super().setUp()
+        self.folder = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.path = os.path.join(self.folder.name, "slow.log")
+        slow_queries.open_log(self.path, 1024 * 1024, 1)
+        # every statement counts as slow
+        slow_queries.recorder.threshold_ms = 1e-6
+        slow_queries.recorder.explain_rate = 1.0
+        slow_queries.recorder.parameters = True
+
+    def tearDown(self):
+        """This runs after each test"""
+        slow_queries.recorder.threshold_ms = self.app.config["SLOW_QUERY_MS"]
+        slow_queries.recorder.explain_rate = self.app.config["SLOW_QUERY_EXPLAIN_RATE"]
+        slow_queries.recorder.parameters = self.app.config["SLOW_QUERY_PARAMETERS"]
+        slow_queries.open_log(os.devnull, 0, 0)
+        self.folder.cleanup()
+        super().tearDown()
+
+    def test_records_slow_queries(self):
+        """It should log slow statements with their route and parameters"""
+        order = OrderFactory()
+        order.create()
+        resp = self.client.get(f"{BASE_URL}/{order.id}")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp.close()
+        records = slow_queries.read_log(self.path)
+        from_route = [record for record in records if record["route"] == "GET /api/orders/<order_id>"]
+        self.assertTrue(from_route)
+        self.assertTrue(all(record["statement"].lstrip().startswith("SELECT") for record in from_route))
+        self.assertIn(str(order.id), [str(value) for value in from_route[0]["parameters"]])
+
+    def test_no_parameters_by_default(self):
+        """It should leave the bind parameters out unless asked for them"""
+        slow_queries.recorder.parameters = False
+        order = OrderFactory()
+        order.create()
+        self.client.get(f"{BASE_URL}/{order.id}").close()
+        records = slow_queries.read_log(self.path)
+        self.assertTrue(records)
+        self.assertFalse(any("parameters" in record for record in records))
+
+    def test_explains_reads_after_the_response(self):
+        """It should capture plans for slow reads once the response is closed"""
+        if db.engine.dialect.name not in slow_queries.EXPLAIN:
+            self.skipTest(f"no EXPLAIN for {db.engine.dialect.name}")
+
+        def reads():
+            return [record for record in slow_queries.read_log(self.path) if record["statement"].startswith("SELECT")]
+
+        resp = self.client.get(BASE_URL, query_string={"customer_id": 1})
+        self.assertEqual(reads(), [])
+        resp.close()
+        self.assertTrue(reads())
+        self.assertTrue(all(record.get("plan") for record in reads()))
+
+    def test_no_plans_for_writes(self):
+        """It should never re-run statements that write"""
+        OrderFactory().create()
+        writes = [record for record in slow_queries.read_log(self.path) if record["statement"].startswith("INSERT")]
+        self.assertTrue(writes)
+        self.assertTrue(all("plan" not in record for record in writes))
+
+    def test_explain_failure(self):
+        """It should keep the reason instead of a plan when EXPLAIN fails"""
+        with self.app.app_context():
+            plan = slow_queries.explain(db.engine, "SELECT * FROM missing_table", ())
+        self.assertEqual(len(plan), 1)
+        self.assertTrue(plan[0].startswith("EXPLAIN failed: "))
+
+    def test_summarize(self):
+        """It should rank statement shapes by their total time"""
+        records = [
+            {"statement": "SELECT 1\n FROM a", "duration_ms": 300.0, "route": "GET /a", "parameters": []},
+            {"statement": "SELECT 1 FROM a", "duration_ms": 500.0, "route": "GET /b", "parameters": [],
+             "plan": ["Seq Scan on a"]},
+            {"statement": "SELECT 2", "duration_ms": 600.0, "route": None, "parameters": []},
+        ]
+        summary = slow_queries.summarize(records)
+        self.assertEqual([entry["statement"] for entry in summary], ["SELECT 1 FROM a", "SELECT 2"])
+        self.assertEqual(summary[0]["count"], 2)
+        self.assertEqual(summary[0]["total_ms"], 800.0)
+        self.assertEqual(summary[0]["max_ms"], 500.0)
+        self.assertEqual(summary[0]["routes"], ["GET /a", "GET /b"])
+        self.assertEqual(summary[0]["plan"], ["Seq Scan on a"])
+        self.assertIsNone(summary[1]["plan"])
+        self.assertEqual(len(slow_queries.summarize(records, limit=1)), 1)
+
+    def test_read_rotated_log(self):
+        """It should read the rotated backups before the current file"""
+        for name, duration in ((f"{self.path}.1", 1.0), (self.path, 2.0)):
+            with open(name, "w", encoding="utf-8") as log:
+                log.write(json.dumps({"statement": "SELECT 1", "duration_ms": duration}) + "\n")
+                log.write("not json\n")
+        records = slow_queries.read_log(self.path, backups=1)
+        self.assertEqual([record["duration_ms"] for record in records], [1.0, 2.0])
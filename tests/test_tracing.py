@@ -0,0 +1,186 @@
+"""
+Distributed Tracing Test Suite
+"""
+import os
+import json
+import tempfile
+import contextvars
+from unittest import TestCase
+from unittest.mock import patch, MagicMock
+from flask import Flask
+from service import config
+from service.models import db, Order, Item
+from service.common import status  # HTTP Status Codes
+from service.common import tracing
+from service.common.tracing import TRACEPARENT_HEADER, InMemoryExporter, JsonFileExporter, parse_traceparent
+from tests.factories import OrderFactory, ItemFactory
+from tests.helpers import AppTestCase
+
+BASE_URL = "/api/orders"
+TRACE_ID = "4bf92f3577b34da6a3ce929d0e0e4736"
+PARENT_ID = "00f067aa0ba902b7"
+
+
+def memory_exporter(_app):
+    """An exporter factory as TRACE_EXPORTER can name it"""
+    return InMemoryExporter()
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTraceparent(TestCase):
+    """W3C traceparent Tests"""
+
+    def test_parse(self):
+        """It should read the trace, parent and sampling flag of a traceparent"""
+        context = parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-01")
+        self.assertEqual(context, (TRACE_ID, PARENT_ID, True))
+        self.assertEqual(context.traceparent, f"00-{TRACE_ID}-{PARENT_ID}-01")
+        self.assertFalse(parse_traceparent(f"00-{TRACE_ID}-{PARENT_ID}-00").sampled)
+
+    def test_parse_invalid(self):
+        """It should ignore malformed traceparent headers"""
+        for value in (
+            None,
+            "",
+            "garbage",
+            f"ff-{TRACE_ID}-{PARENT_ID}-01",
+            f"00-{'0' * 32}-{PARENT_ID}-01",
+            f"00-{TRACE_ID}-{'0' * 16}-01",
+            f"00-{TRACE_ID[:-1]}-{PARENT_ID}-01",
+        ):
+            self.assertIsNone(parse_traceparent(value), value)
+
+
+class TestTracing(AppTestCase):
+    """Request tracing Tests"""
+
+    CONFIG = {"TRACE_EXPORTER": "memory", "TRACE_SAMPLE_RATE": 0.0}
+
+    @classmethod
+    def tearDownClass(cls):
+        tracing.tracer.exporter = None
+
+    def setUp(self):
+        """This runs before each test"""
+        super().setUp()
+        self.spans = tracing.tracer.exporter.spans
+        self.spans.clear()
+
+    def tearDown(self):
+        """This runs after each test"""
+        tracing.tracer.sample_rate = 0.0
+        super().tearDown()
+
+    def test_joins_the_callers_trace(self):
+        """It should nest the handler, model and SQL spans under the caller's span"""
+        order = OrderFactory()
+        order.items = ItemFactory.build_batch(2)
+        order.create()
+        resp = self.client.get(
+            f"{BASE_URL}/{order.id}/items", headers={TRACEPARENT_HEADER: f"00-{TRACE_ID}-{PARENT_ID}-01"}
+        )
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(self.spans)
+        self.assertTrue(all(span.context.trace_id == TRACE_ID for span in self.spans))
+        root = self.spans[-1]
+        self.assertEqual(root.name, "GET /api/orders/<order_id>/items")
+        self.assertEqual(root.parent_id, PARENT_ID)
+        self.assertEqual(root.attributes["http.status_code"], 200)
+        by_id = {span.context.span_id: span for span in self.spans}
+        find = next(span for span in self.spans if span.name == "Order.find")
+        self.assertIs(by_id[find.parent_id], root)
+        statements = [span for span in self.spans if span.kind == "CLIENT"]
+        self.assertTrue(statements)
+        self.assertTrue(all(span.name == "SELECT" for span in statements))
+        self.assertTrue(all(span.parent_id in by_id for span in statements))
+        self.assertIn(find.context.span_id, [span.parent_id for span in statements])
+        self.assertTrue(all(span.end >= span.start for span in self.spans))
+
+    def test_follows_the_callers_decision(self):
+        """It should not trace a request its caller did not sample"""
+        tracing.tracer.sample_rate = 1.0
+        self.client.get(BASE_URL, headers={TRACEPARENT_HEADER: f"00-{TRACE_ID}-{PARENT_ID}-00"})
+        self.assertEqual(self.spans, [])
+
+    def test_sampling(self):
+        """It should start traces of its own at the sample rate"""
+        self.client.get(BASE_URL)
+        self.assertEqual(self.spans, [])
+        tracing.tracer.sample_rate = 1.0
+        self.client.get(BASE_URL)
+        root = self.spans[-1]
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(len(root.context.trace_id), 32)
+
+    def test_failed_statement(self):
+        """It should mark a failed statement's span as an error"""
+        tracing.tracer.sample_rate = 1.0
+        with patch.object(Order, "all", side_effect=lambda *_: db.session.execute(db.text("SELECT * FROM missing"))):
+            resp = self.client.get(BASE_URL)
+        self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
+        failed = [span for span in self.spans if span.status == "ERROR"]
+        self.assertEqual(failed[0].kind, "CLIENT")
+        self.assertEqual(self.spans[-1].status, "ERROR")
+
+    def test_failed_operation(self):
+        """It should mark a model operation that raised as an error"""
+        tracing.tracer.sample_rate = 1.0
+        root = tracing.tracer.start_trace("GET /api/orders/1/items")
+        broken = MagicMock()
+        broken.all.side_effect = RuntimeError("lost")
+        with patch.object(Item, "query", broken):
+            self.assertRaises(RuntimeError, Item.all)
+        root.finish()
+        self.assertEqual([span.name for span in self.spans], ["Item.all", "GET /api/orders/1/items"])
+        self.assertEqual(self.spans[0].status, "ERROR")
+
+    def test_outside_requests(self):
+        """It should not trace model calls made outside a sampled request"""
+        OrderFactory().create()
+        self.assertEqual(self.spans, [])
+
+
+class TestExporters(TestCase):
+    """Span exporter Tests"""
+
+    def setUp(self):
+        self.tracer = tracing.Tracer(InMemoryExporter(), sample_rate=1.0)
+
+    def test_finished_elsewhere(self):
+        """It should export a span finished in another context, like a streamed body"""
+        span = contextvars.copy_context().run(self.tracer.start_trace, "GET /api/orders/export")
+        span.finish()
+        span.finish()  # once only
+        self.assertIsNone(tracing.current_span())
+        self.assertEqual(self.tracer.exporter.spans, [span])
+
+    def test_json_file_exporter(self):
+        """It should write one JSON object per span"""
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "traces.jsonl")
+            self.tracer.exporter = JsonFileExporter(path)
+            root = self.tracer.start_trace("GET /")
+            self.tracer.start_span("Order.all").finish()
+            root.finish()
+            with open(path, encoding="utf-8") as traces:
+                spans = [json.loads(line) for line in traces]
+        self.assertEqual([span["name"] for span in spans], ["Order.all", "GET /"])
+        self.assertEqual(spans[0]["parent_id"], spans[1]["span_id"])
+        self.assertIsNone(tracing.current_span())
+
+    def test_load_exporter(self):
+        """It should build the exporter TRACE_EXPORTER names"""
+        app = Flask(__name__)
+        app.config.from_object(config)
+        app.config["TRACE_EXPORTER"] = "tests.test_tracing:memory_exporter"
+        self.assertIsInstance(tracing.load_exporter(app), InMemoryExporter)
+        app.config["TRACE_EXPORTER"] = "zipkin"
+        self.assertRaises(ValueError, tracing.load_exporter, app)
+
+    def test_export_failure(self):
+        """It should never fail the traced work when exporting fails"""
+        with patch.object(self.tracer.exporter, "export", side_effect=OSError("disk full")):
+            self.tracer.start_trace("GET /").finish()
+        self.assertIsNone(tracing.current_span())